@@ -1,13 +1,19 @@
 from django.contrib import admin
-from devmason_server.models import Project, Build, BuildStep, BuildRequest, Repository
+from devmason_server.models import Project, Build, BuildStep, BuildRequest, Repository, Metric
 
 class BuildAdmin(admin.ModelAdmin):
     model = Build
     list_display = ('project', 'success', 'user', 'started')
     
+class BuildRequestAdmin(admin.ModelAdmin):
+    model = BuildRequest
+    list_display = ('repository', 'identifier', 'branch', 'arch', 'requested', 'leased_by',
+                    'completed')
+
 
 admin.site.register(Project)
 admin.site.register(Build, BuildAdmin)
 admin.site.register(BuildStep)
 admin.site.register(Repository)
-admin.site.register(BuildRequest)
+admin.site.register(BuildRequest, BuildRequestAdmin)
+admin.site.register(Metric)
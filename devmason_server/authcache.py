@@ -0,0 +1,126 @@
+"""
+A cache of verified Basic auth credentials.
+
+Build slaves post build after build with the same few credentials, and
+checking a password means hashing it. So once an `Authorization` header
+has checked out, the user it's for is remembered, for up to
+`DEVMASON_AUTH_CACHE_TTL` seconds, in a bounded in-process LRU of
+`DEVMASON_AUTH_CACHE_SIZE` entries. Entries are keyed by an HMAC of the
+header under `SECRET_KEY`, so the cache never holds passwords, and are
+dropped as soon as the user's password or active flag changes in this
+process; the TTL bounds how long a change made elsewhere can go unnoticed.
+"""
+
+import copy
+import hmac
+import time
+import hashlib
+import threading
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+class CredentialCache(object):
+    """Verified users by `Authorization` header, with hit and miss counts."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expiry time, user), least recently used first.
+        self.entries = OrderedDict()
+        # user pk -> keys of that user's entries, so they can be dropped.
+        self.by_user = {}
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, header):
+        return hmac.new(settings.SECRET_KEY, header, hashlib.sha256).hexdigest()
+
+    def get(self, header):
+        """The user `header` was verified for, or None."""
+        if self.max_entries <= 0:
+            return None
+        key = self.make_key(header)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] <= time.time():
+                self._forget(key, entry[1].pk)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        finally:
+            self.lock.release()
+        # A copy, so nothing done with it during one request leaks into others.
+        return copy.copy(entry[1])
+
+    def add(self, header, user):
+        """Remember that `header` checked out as `user`."""
+        if self.max_entries <= 0:
+            return
+        key = self.make_key(header)
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, copy.copy(user))
+            self.by_user.setdefault(user.pk, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                oldest = iter(self.entries).next()
+                self._forget(oldest, self.entries.pop(oldest)[1].pk)
+        finally:
+            self.lock.release()
+
+    def user_changed(self, user, deleted=False):
+        """Drop `user`'s entries if their password or active flag has changed."""
+        self.lock.acquire()
+        try:
+            for key in list(self.by_user.get(user.pk, ())):
+                cached = self.entries[key][1]
+                if deleted or cached.password != user.password \
+                   or cached.is_active != user.is_active:
+                    del self.entries[key]
+                    self._forget(key, user.pk)
+        finally:
+            self.lock.release()
+
+    def _forget(self, key, user_pk):
+        keys = self.by_user.get(user_pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_user[user_pk]
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.by_user.clear()
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+credential_cache = CredentialCache(
+    max_entries = getattr(settings, 'DEVMASON_AUTH_CACHE_SIZE', 1000),
+    ttl = getattr(settings, 'DEVMASON_AUTH_CACHE_TTL', 300),
+)
+
+def user_saved(sender, instance, **kwargs):
+    credential_cache.user_changed(instance)
+
+def user_deleted(sender, instance, **kwargs):
+    credential_cache.user_changed(instance, deleted=True)
+
+def connect_signals():
+    post_save.connect(user_saved, sender=User)
+    post_delete.connect(user_deleted, sender=User)
@@ -0,0 +1,192 @@
+"""
+A durable, on-disk queue of builds waiting to be ingested.
+
+With `DEVMASON_ASYNC_INGEST` on, `POST /<slug>/builds` checks the payload,
+writes it here and answers straight away; the `ingest_builds` command drains
+the queue in batches. Entries are plain files moved between directories
+with atomic renames, so any number of workers on the same box can share a
+queue without a broker:
+
+    tmp/      entries being written
+    pending/  entries waiting for a worker
+    claimed/  entries a worker is ingesting
+    done/     status of ingested entries: the new build's id
+    failed/   status of entries that couldn't be ingested: the error
+
+Entry ids start with the time they were queued, so sorting them gives the
+order they arrived in.
+"""
+
+import errno
+import os
+import time
+import uuid
+from django.conf import settings
+from django.utils import simplejson
+
+DIRECTORIES = ('tmp', 'pending', 'claimed', 'done', 'failed')
+
+def queue_root():
+    return getattr(settings, 'DEVMASON_INGEST_QUEUE',
+                   os.path.join(settings.MEDIA_ROOT, 'ingest_queue'))
+
+def _fsync_directory(path):
+    # Makes a rename durable. Not every platform can open a directory.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BuildQueue(object):
+    """The queue in the directory `root`, `DEVMASON_INGEST_QUEUE` by default."""
+
+    def __init__(self, root=None):
+        self.root = root or queue_root()
+        # The time each entry this worker holds was claimed at.
+        self.claims = {}
+
+    def path(self, directory, entry_id):
+        return os.path.join(self.root, directory, entry_id)
+
+    def make_directories(self):
+        """
+        Make the queue's directories. Only queueing a build does this, so
+        that reading the queue doesn't leave empty directories behind.
+        """
+        for name in DIRECTORIES:
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Somebody else made it first.
+                    if not os.path.isdir(path):
+                        raise
+
+    def listdir(self, directory):
+        """The entry ids in `directory`, which is empty until it's been made."""
+        try:
+            return os.listdir(os.path.join(self.root, directory))
+        except OSError:
+            return []
+
+    def enqueue(self, slug, data, user_id=None, logs=()):
+        """
+        Durably queue a validated build payload, returning its id. `logs` are
+        (index of the step, 'output' or 'errout', BuildLog id) for output
+        that's already in log storage.
+        """
+        self.make_directories()
+        entry_id = '%d-%s' % (time.time() * 1000000, uuid.uuid4().hex[:12])
+        tmp_path = self.path('tmp', entry_id)
+        fp = open(tmp_path, 'wb')
+        try:
+            simplejson.dump({'project': slug, 'user': user_id, 'build': data,
+                             'logs': list(logs)}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path('pending', entry_id))
+        _fsync_directory(os.path.join(self.root, 'pending'))
+        return entry_id
+
+    def claim(self, limit):
+        """
+        Claim up to `limit` of the oldest pending entries, returning a list of
+        (entry id, entry) pairs. Entries another worker got to first are
+        skipped.
+        """
+        claimed = []
+        for entry_id in sorted(self.listdir('pending')):
+            if len(claimed) >= limit:
+                break
+            path = self.path('claimed', entry_id)
+            try:
+                os.rename(self.path('pending', entry_id), path)
+            except OSError:
+                continue
+            # The claim time, for recover().
+            os.utime(path, None)
+            self.claims[entry_id] = os.path.getmtime(path)
+            fp = open(path, 'rb')
+            try:
+                claimed.append((entry_id, simplejson.load(fp)))
+            finally:
+                fp.close()
+        return claimed
+
+    def _finish(self, entry_id, directory, status):
+        path = self.path(directory, entry_id)
+        fp = open(path + '.tmp', 'wb')
+        try:
+            simplejson.dump(status, fp)
+        finally:
+            fp.close()
+        os.rename(path + '.tmp', path)
+        # If recover() requeued the entry, another worker may have claimed it
+        # since, and the claim is theirs to remove.
+        claimed_at = self.claims.pop(entry_id, None)
+        claimed = self.path('claimed', entry_id)
+        try:
+            if claimed_at is None or os.path.getmtime(claimed) == claimed_at:
+                os.unlink(claimed)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def complete(self, entry_id, build):
+        self._finish(entry_id, 'done', {'build': build.pk})
+
+    def fail(self, entry_id, error):
+        self._finish(entry_id, 'failed', {'error': error})
+
+    def status(self, entry_id):
+        """
+        Where an entry's got to: ('pending', None), ('done', build id),
+        ('failed', error message), or None for an unknown id.
+        """
+        for directory in ('done', 'failed'):
+            try:
+                fp = open(self.path(directory, entry_id), 'rb')
+            except IOError:
+                continue
+            try:
+                status = simplejson.load(fp)
+            finally:
+                fp.close()
+            return directory, status.get('build', status.get('error'))
+        for directory in ('pending', 'claimed'):
+            if os.path.exists(self.path(directory, entry_id)):
+                return 'pending', None
+        return None
+
+    def recover(self, timeout):
+        """
+        Put entries claimed more than `timeout` seconds ago back in the
+        queue: the worker that claimed them must have died.
+        """
+        cutoff = time.time() - timeout
+        for entry_id in self.listdir('claimed'):
+            path = self.path('claimed', entry_id)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.rename(path, self.path('pending', entry_id))
+            except OSError:
+                continue
+
+    def prune(self, age):
+        """Forget the status of entries finished more than `age` seconds ago."""
+        cutoff = time.time() - age
+        for directory in ('done', 'failed'):
+            for entry_id in self.listdir(directory):
+                path = self.path(directory, entry_id)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                except OSError:
+                    continue
@@ -0,0 +1,110 @@
+"""
+Multi-row insert helpers for build ingestion.
+
+The ORM only knows how to save one row at a time, which means a build with a
+few hundred steps costs a few hundred INSERT round trips. These helpers write
+many rows per statement instead.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction, IntegrityError
+from django.db.models import AutoField
+from tagging import settings as tagging_settings
+from tagging.models import Tag, TaggedItem
+from tagging.utils import parse_tag_input
+
+# SQLite refuses statements with more than 999 bound parameters, which is
+# the lowest limit of the backends we support.
+MAX_PARAMS = 999
+
+def bulk_insert(model, objects):
+    """
+    Insert unsaved `objects` of `model` using multi-row INSERT statements.
+
+    Primary keys aren't read back, and no signals are sent, so this is only
+    suitable for rows nothing needs to refer to straight away.
+    """
+    if not objects:
+        return
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    row_sql = "(%s)" % ", ".join(["%s"] * len(fields))
+    per_batch = max(1, MAX_PARAMS // len(fields))
+
+    cursor = connection.cursor()
+    for start in range(0, len(objects), per_batch):
+        batch = objects[start:start + per_batch]
+        params = []
+        for obj in batch:
+            params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+                          for f in fields)
+        cursor.execute("INSERT INTO %s (%s) VALUES %s" % (
+            qn(opts.db_table),
+            ", ".join(qn(f.column) for f in fields),
+            ", ".join([row_sql] * len(batch)),
+        ), params)
+    transaction.set_dirty()
+
+def bulk_insert_or_update(model, objects, update):
+    """
+    Like `bulk_insert`, for rows that a concurrent transaction may be adding
+    too. If any of `objects` clashes with a row on a unique key, they're
+    inserted one at a time instead, each under a savepoint, and `update` is
+    called with each one that clashes so that it can be added to the row
+    that got there first.
+    """
+    if not objects:
+        return
+    sid = transaction.savepoint()
+    try:
+        bulk_insert(model, objects)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+        return
+    for obj in objects:
+        sid = transaction.savepoint()
+        try:
+            bulk_insert(model, [obj])
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            update(obj)
+        else:
+            transaction.savepoint_commit(sid)
+
+def bulk_tag(obj, tag_input):
+    """
+    Tag a freshly created `obj` -- one that has no tags yet -- with the tags
+    in `tag_input`, parsed the same way django-tagging parses them.
+
+    Unlike assigning to `obj.tags`, this costs one query to look up existing
+    tags, one insert per brand new tag, and one insert for all the tagged
+    items together. Returns the tags.
+    """
+    names = parse_tag_input(tag_input)
+    if tagging_settings.FORCE_LOWERCASE_TAGS:
+        names = [name.lower() for name in names]
+    if not names:
+        return []
+
+    tags = dict((t.name, t) for t in Tag.objects.filter(name__in=names))
+    for name in names:
+        if name not in tags:
+            # Another build may be adding the same new tag.
+            sid = transaction.savepoint()
+            try:
+                tags[name] = Tag.objects.create(name=name)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                tags[name] = Tag.objects.get(name=name)
+            else:
+                transaction.savepoint_commit(sid)
+
+    ctype = ContentType.objects.get_for_model(obj)
+    bulk_insert(TaggedItem, [
+        TaggedItem(tag=tags[name], content_type=ctype, object_id=obj.pk)
+        for name in names
+    ])
+    return [tags[name] for name in names]
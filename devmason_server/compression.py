@@ -0,0 +1,163 @@
+"""
+gzip and deflate response bodies.
+
+Build lists and build details are JSON or HTML full of repeated keys and
+log text, and shrink to a tenth or less. Responses get whichever of gzip
+and deflate the client's `Accept-Encoding` prefers, if they're text of at
+least `DEVMASON_COMPRESS_MIN_SIZE` bytes; `DEVMASON_COMPRESS_LEVEL` is the
+zlib level, and 0 turns compression off.
+
+gzip and deflate differ only in the header and checksum around the same
+deflate stream. So a body is deflated once with `deflate`, and `encode`
+wraps the result for either coding without compressing again -- which is
+how the response cache stores its entries (see `responsecache`), so hot
+responses aren't recompressed for every request. Streamed responses are
+compressed as they're sent instead, by `compress_stream`.
+"""
+
+import zlib
+import struct
+import functools
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+ENCODINGS = ('gzip', 'deflate')
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml',
+                      'application/javascript', 'application/x-yaml')
+
+# The fixed parts of each coding's header: gzip with no file name or
+# modification time, and zlib's with a 32K window.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+ZLIB_HEADER = '\x78\x9c'
+
+def compress_level():
+    return getattr(settings, 'DEVMASON_COMPRESS_LEVEL', 6)
+
+def min_size():
+    return getattr(settings, 'DEVMASON_COMPRESS_MIN_SIZE', 1024)
+
+def choose_encoding(request):
+    """The coding to send `request` a response in, or None for none."""
+    if compress_level() <= 0:
+        return None
+    quality = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.strip().lower().split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, sep, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[params[0].strip()] = q
+    quality.setdefault('gzip', quality.get('x-gzip', quality.get('*', 0.0)))
+    quality.setdefault('deflate', quality.get('*', 0.0))
+    # Ties go to gzip, the more widely supported.
+    best = max(ENCODINGS, key=lambda e: (quality[e], e == 'gzip'))
+    if quality[best] <= 0:
+        return None
+    return best
+
+def compressible(response):
+    """
+    Whether `response` is worth compressing, whoever it's for. Streamed
+    responses are assumed to be big.
+    """
+    if response.status_code != 200 or response.has_header('Content-Encoding') \
+       or response.has_header('Content-Range'):
+        return False
+    content_type = response.get('Content-Type', '').lower()
+    if not [t for t in COMPRESSIBLE_TYPES if content_type.startswith(t)]:
+        return False
+    return not response._is_string or len(response.content) >= min_size()
+
+def deflate(data):
+    """
+    `data` deflated, along with what `encode` needs to wrap it up: (raw
+    deflate stream, CRC-32, Adler-32, length).
+    """
+    compressor = zlib.compressobj(compress_level(), zlib.DEFLATED, -zlib.MAX_WBITS)
+    raw = compressor.compress(data) + compressor.flush()
+    return (raw, zlib.crc32(data) & 0xffffffff, zlib.adler32(data) & 0xffffffff,
+            len(data) & 0xffffffff)
+
+def encode(deflated, encoding):
+    """A body in `encoding` from the output of `deflate`."""
+    raw, crc, adler, size = deflated
+    if encoding == 'gzip':
+        return GZIP_HEADER + raw + struct.pack('<II', crc, size)
+    return ZLIB_HEADER + raw + struct.pack('>I', adler)
+
+def compress_stream(chunks, encoding, charset='utf-8'):
+    """
+    Compress an iterable of `chunks` into `encoding` as it goes. Unicode
+    chunks are encoded in `charset` first.
+    """
+    wbits = encoding == 'gzip' and 16 + zlib.MAX_WBITS or zlib.MAX_WBITS
+    compressor = zlib.compressobj(compress_level(), zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(charset)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def encoded_etag(etag, encoding):
+    """
+    The ETag of the `encoding` version of a response: a strong ETag has to
+    differ between the two. See `strip_encoding`.
+    """
+    if not etag.endswith('"'):
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+def strip_encoding(etag):
+    """The ETag that `encoded_etag` made `etag` from."""
+    for encoding in ENCODINGS:
+        suffix = '-%s"' % encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+def set_body(response, body, encoding):
+    """Give `response` a `body` already in `encoding`."""
+    response.content = body
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(body))
+    if response.has_header('ETag'):
+        response['ETag'] = encoded_etag(response['ETag'], encoding)
+
+def compress_response(request, response):
+    """Compress `response` for `request`, if it's worth it and it's wanted."""
+    if response.has_header('Content-Encoding'):
+        # Already done, by the response cache.
+        return response
+    if not compressible(response):
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+    if response._is_string:
+        set_body(response, encode(deflate(response.content), encoding), encoding)
+    else:
+        # Compressed as it's sent, so it can't have a length up front.
+        response._container = compress_stream(response._container, encoding,
+                                               response._charset)
+        response['Content-Encoding'] = encoding
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+        if response.has_header('ETag'):
+            response['ETag'] = encoded_etag(response['ETag'], encoding)
+    return response
+
+def compressed(view):
+    """Decorator for views whose responses should be compressed."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return compress_response(request, view(request, *args, **kwargs))
+    return wrapper
@@ -1,8 +1,44 @@
+import ast
 from django.db import models
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import simplejson
 
+class JSONDescriptor(object):
+    """
+    Keeps a JSONField's JSON text as it came from the database and only
+    decodes it the first time the attribute is read. Text that's never read
+    is saved back exactly as it was.
+
+    Strings assigned to the attribute are taken to be JSON text; anything
+    else is taken to be the decoded value.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.raw_name = '_%s_json' % field.attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            raw = instance.__dict__.pop(self.raw_name, None)
+            instance.__dict__[attname] = self.field.decode(raw)
+        return instance.__dict__[attname]
+
+    def __set__(self, instance, value):
+        if isinstance(value, basestring):
+            instance.__dict__[self.raw_name] = value
+            instance.__dict__.pop(self.field.attname, None)
+        else:
+            instance.__dict__[self.field.attname] = value
+            instance.__dict__.pop(self.raw_name, None)
+
+    def raw(self, instance):
+        """The undecoded JSON text, or None if the value has been read."""
+        return instance.__dict__.get(self.raw_name)
+
 # JSONField is from Djblets
 # (http://code.google.com/p/reviewboard/wiki/Djblets), which is by
 # Christian Hammond and David Trowbridge.
@@ -35,24 +71,24 @@ class JSONField(models.TextField):
         setattr(cls, "get_%s_json" % self.name, get_json)
         setattr(cls, "set_%s_json" % self.name, set_json)
 
-        models.signals.post_init.connect(self.post_init, sender=cls)
+        self.descriptor = JSONDescriptor(self)
+        setattr(cls, self.attname, self.descriptor)
 
     def pre_save(self, model_instance, add):
+        raw = self.descriptor.raw(model_instance)
+        if raw:
+            return raw
         return self.dumps(getattr(model_instance, self.attname, None))
 
-    def post_init(self, instance=None, **kwargs):
-        value = self.value_from_object(instance)
-
-        if value:
-            try:
-                value = self.loads(value)
-            except (ValueError, SyntaxError):
-                #Was getting "''", and breaking
-                pass
-        else:
-            value = {}
-
-        setattr(instance, self.attname, value)
+    def decode(self, value):
+        """Decode JSON text from the database, or from an assignment."""
+        if not value:
+            return {}
+        try:
+            return self.loads(value)
+        except (ValueError, SyntaxError):
+            #Was getting "''", and breaking
+            return value
 
     def get_db_prep_save(self, value):
         if not isinstance(value, basestring):
@@ -79,7 +115,7 @@ class JSONField(models.TextField):
                 val = simplejson.loads(val, encoding=settings.DEFAULT_CHARSET)
         except ValueError:
             # There's probably embedded unicode markers (like u'foo') in the
-            # string. We have to eval it.
-            val = eval(val)
+            # string, so it's a Python literal rather than JSON.
+            val = ast.literal_eval(val)
 
         return val
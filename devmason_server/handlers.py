@@ -1,30 +1,60 @@
+import base64
+import datetime
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q, Count, Max
+from django.db.models.query import QuerySet
 from django.core.paginator import Paginator, InvalidPage
 from django.core import urlresolvers
-from django.http import Http404, HttpResponseForbidden, HttpResponseBadRequest
+from django.http import Http404, HttpResponseForbidden, HttpResponseBadRequest, HttpResponseGone
 from django.shortcuts import get_object_or_404, redirect
-from django.utils import simplejson
 from piston.handler import BaseHandler
 from piston.utils import require_mime
 from tagging.models import Tag
-from .models import Project, Build, BuildStep
+from .buildqueue import BuildQueue
+from .ingest import add_step, finish_build, open_build, parse_build, save_build, update_step
+from .jsonstream import JSONStreamReader
+from .logstore import LogSpool, attach_spools
+from .models import Project, Build, BuildRequest, BuildStep
+from .prefetch import BuildStream, prefetch_builds
+from .rollups import project_stats
+from .tagindex import TaggedBuilds
 from .utils import (link, allow_404, authentication_required,
-                    authentication_optional, format_dt, HttpResponseCreated,
-                    HttpResponseNoContent, mk_datetime)
+                    authentication_optional, format_dt, HttpResponseAccepted,
+                    HttpResponseConflict, HttpResponseCreated,
+                    HttpResponseNoContent, HTMLTemplateEmitter, request_body,
+                    request_emitter, selected_fields, streams_builds)
+
+# How many builds the project's HTML page lists.
+PROJECT_PAGE_BUILDS = 25
+
+def build_prefetch(request):
+    """
+    What `prefetch_builds` should load for the build fields `request` will
+    get: steps only for `results`, and tags only for `tags` and `links`.
+    """
+    fields = selected_fields(request, BuildHandler)
+    return {'steps': 'results' in fields, 'tags': 'tags' in fields or 'links' in fields}
 
 class ProjectListHandler(BaseHandler):
     allowed_methods = ['GET']
     viewname = 'project_list'
 
     def read(self, request):
-        latest_builds = Build.objects.order_by('-pk')[:10]
-        projects =  Project.objects.filter(builds__isnull=False).distinct()
-        builds = {}
-        for project in projects:
-            try:
-                builds[project.name] = list(project.builds.order_by('-pk'))[0]
-            except:
-                pass
+        latest_builds = list(Build.objects.filter(in_progress=False)
+                                          .select_related('project', 'user').order_by('-pk')[:10])
+        projects = list(Project.objects.filter(latest_build_id__isnull=False)
+                                       .select_related('owner'))
+        # Projects' newest builds are usually among the newest builds
+        # overall, so only the rest need loading.
+        by_pk = dict((build.pk, build) for build in latest_builds)
+        missing = [project.latest_build_id for project in projects
+                   if project.latest_build_id not in by_pk]
+        if missing:
+            by_pk.update(Build.objects.select_related('project', 'user').in_bulk(missing))
+        builds = dict((project.name, by_pk[project.latest_build_id])
+                      for project in projects if project.latest_build_id in by_pk)
+        prefetch_builds(by_pk.values(), **build_prefetch(request))
         return {
             'projects': projects,
             'latest_builds': latest_builds,
@@ -40,7 +70,12 @@ class ProjectHandler(BaseHandler):
 
     @allow_404
     def read(self, request, slug):
-        return  get_object_or_404(Project, slug=slug)
+        project = get_object_or_404(Project, slug=slug)
+        # The HTML page lists the newest builds, and links to the rest.
+        if request_emitter(request) is HTMLTemplateEmitter:
+            project.recent_builds = prefetch_builds(
+                project.builds.order_by('-finished', '-pk')[:PROJECT_PAGE_BUILDS], steps=False)
+        return project
 
     @require_mime('json')
     @authentication_required
@@ -105,15 +140,64 @@ class ProjectHandler(BaseHandler):
             link('tag-list', ProjectTagListHandler, project.slug),
         ]
 
+def build_list_validators(slug):
+    """
+    Conditional GET validators for resources listing a project's builds.
+    Builds never change once they're posted (or finished, if they're
+    incremental), so these only need to change when a build is added or
+    deleted, or the project itself is edited.
+    """
+    try:
+        project = Project.objects.values('pk', 'name', 'owner').get(slug=slug)
+    except Project.DoesNotExist:
+        return None
+    stats = Build.objects.filter(project=project['pk'], in_progress=False).order_by() \
+                         .aggregate(count=Count('pk'), newest=Max('pk'), modified=Max('finished'))
+    token = u'%s:%s:%s:%s:%s' % (project['pk'], project['name'], project['owner'],
+                                  stats['count'], stats['newest'])
+    return token, stats['modified']
+
+def encode_cursor(build):
+    """An opaque cursor pointing just past `build` in -finished order."""
+    position = '%s,%s' % (build.finished.strftime('%Y-%m-%dT%H:%M:%S.%f'), build.pk)
+    return base64.urlsafe_b64encode(position).rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor back into a (finished, pk) pair. Raises ValueError if it
+    isn't a valid cursor.
+    """
+    try:
+        position = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor")
+    finished, pk = position.split(',')
+    return datetime.datetime.strptime(finished, '%Y-%m-%dT%H:%M:%S.%f'), int(pk)
+
 class PaginatedBuildHandler(BaseHandler):
-    """Helper base class to provide paginated builds"""
+    """
+    Helper base class to provide paginated builds, from a queryset or from
+    `TaggedBuilds`.
+
+    Pass `stream` as True if the response's format can stream builds (see
+    `utils.streams_builds`); pages of more than `DEVMASON_STREAMING_PAGE_SIZE`
+    builds then come as a `BuildStream` rather than a list.
+    """
 
-    def handle_paginated_builds(self, builds, qdict, link_callback, extra={}):
+    def handle_paginated_builds(self, builds, qdict, link_callback, extra={}, prefetch={},
+                                stream=False):
         try:
             per_page = int(qdict['per_page'])
         except (ValueError, KeyError):
             per_page = 25
+        stream = stream and per_page > getattr(settings, 'DEVMASON_STREAMING_PAGE_SIZE', 100)
 
+        if 'after' in qdict:
+            return self.handle_cursor_builds(builds, qdict, link_callback, per_page,
+                                             extra, prefetch, stream)
+
+        if isinstance(builds, QuerySet):
+            builds = builds.select_related('project', 'user')
         paginator = Paginator(builds, per_page)
 
         try:
@@ -121,7 +205,7 @@ class PaginatedBuildHandler(BaseHandler):
         except (KeyError, InvalidPage):
             page = paginator.page(1)
 
-        if not page.object_list:
+        if not paginator.count:
             raise Http404("No builds")
 
         link_callback('self', page=page.number, per_page=per_page)
@@ -134,8 +218,16 @@ class PaginatedBuildHandler(BaseHandler):
             if page.has_next():
                 link_callback('next', page=page.next_page_number(), per_page=per_page)
 
+        if stream:
+            object_list = page.object_list
+            if isinstance(object_list, QuerySet):
+                object_list = object_list.iterator()
+            object_list = BuildStream(object_list, **prefetch)
+        else:
+            object_list = prefetch_builds(page.object_list, **prefetch)
+
         response = {
-            'builds': page.object_list,
+            'builds': object_list,
             'count': paginator.count,
             'num_pages': paginator.num_pages,
             'page': page.number,
@@ -144,6 +236,55 @@ class PaginatedBuildHandler(BaseHandler):
         }
         return dict(response, **extra)
 
+    def handle_cursor_builds(self, builds, qdict, link_callback, per_page, extra, prefetch,
+                             stream):
+        """
+        Keyset pagination: rather than counting and OFFSETing into the whole
+        list, each page picks up where the `after` cursor left off, so the
+        thousandth page costs the same as the first. The total count is only
+        worked out if asked for with `count=1`.
+        """
+        cursor = qdict['after']
+        position = None
+        if cursor:
+            try:
+                position = decode_cursor(cursor)
+            except ValueError:
+                # As with a bad page number, fall back on the first page.
+                cursor = ''
+
+        # Fetch one extra build to find out if there's a next page.
+        if isinstance(builds, TaggedBuilds):
+            count_builds = builds
+            object_list = builds.after(position, per_page + 1)
+        else:
+            builds = count_builds = builds.order_by('-finished', '-pk')
+            if position:
+                finished, pk = position
+                builds = builds.filter(Q(finished__lt=finished) |
+                                       Q(finished=finished, pk__lt=pk))
+            object_list = list(builds.select_related('project', 'user')[:per_page + 1])
+        has_next = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        if not object_list:
+            raise Http404("No builds")
+
+        link_callback('self', after=cursor, per_page=per_page)
+        if cursor or has_next:
+            link_callback('first', after='', per_page=per_page)
+        if has_next:
+            link_callback('next', after=encode_cursor(object_list[-1]), per_page=per_page)
+
+        response = {
+            'builds': stream and BuildStream(object_list, **prefetch)
+                             or prefetch_builds(object_list, **prefetch),
+            'paginated': bool(cursor) or has_next,
+            'per_page': per_page,
+        }
+        if qdict.get('count'):
+            response['count'] = count_builds.count()
+        return dict(response, **extra)
+
 class ProjectBuildListHandler(PaginatedBuildHandler):
     allowed_methods = ['GET', 'POST']
     viewname = 'project_build_list'
@@ -151,7 +292,7 @@ class ProjectBuildListHandler(PaginatedBuildHandler):
     @allow_404
     def read(self, request, slug):
         project = get_object_or_404(Project, slug=slug)
-        builds = project.builds.all()
+        builds = project.builds.filter(in_progress=False)
 
         links = [
             link('project', ProjectHandler, project.slug),
@@ -164,79 +305,139 @@ class ProjectBuildListHandler(PaginatedBuildHandler):
             l['allowed_methods'] = ['GET']
             links.append(l)
 
-        response = self.handle_paginated_builds(builds, request.GET, make_link)
+        response = self.handle_paginated_builds(builds, request.GET, make_link,
+                                                prefetch=build_prefetch(request),
+                                                stream=streams_builds(request))
         response['links'] = links
         response['project'] = project
         return response
 
+    def validators(self, request, slug):
+        return build_list_validators(slug)
+
     @allow_404
     @require_mime('json')
     @authentication_optional
     @transaction.commit_on_success
     def create(self, request, slug):
         project = get_object_or_404(Project, slug=slug)
-
-        # Construct us the dict of "extra" info from the request
         data = request.data
-        extra = request.data['client'].copy()
-        for k in ('success', 'started', 'finished', 'client', 'results', 'tags'):
-            extra.pop(k, None)
+        if data.get('incremental'):
+            return self.open_incremental(request, project, data)
 
-        # Create the Build object
+        # Check the whole payload before writing anything, so that a bad
+        # step can't leave half a build behind.
         try:
-            build = Build.objects.create(
-                project = project,
-                success = data['success'],
-                started = mk_datetime(data.get('started', '')),
-                finished = mk_datetime(data.get('finished', '')),
-                host = data['client']['host'],
-                arch = data['client']['arch'],
-                user = request.user.is_authenticated() and request.user or None,
-
-                # Because of some weirdness with the way fields are handled in
-                # __init__, we have to encode extra as JSON manually here.
-                # TODO: investiage why and fix JSONField
-                extra_info = simplejson.dumps(extra),
-            )
+            build, steps = parse_build(data)
         except (KeyError, ValueError), ex:
-            # We'll get a KeyError from request.data[k] if the given key
-            # is missing and ValueError from improperly formatted dates.
-            # Treat either of these as improperly formatted requests
-            # and return a 400 (Bad Request)
+            # We'll get a KeyError from data[k] if the given key is missing
+            # and ValueError from improperly formatted dates. Treat either of
+            # these as improperly formatted requests and return a 400 (Bad
+            # Request)
             return HttpResponseBadRequest(str(ex))
 
-        # Tag us a build
-        if 'tags' in data:
-            build.tags = ",".join(data['tags'])
+        # In async mode the build is queued for the `ingest_builds` workers
+        # instead, and the client gets a URL to check up on it at.
+        if getattr(settings, 'DEVMASON_ASYNC_INGEST', False):
+            return self.build_queued(request, project, data)
 
-        # Create each build step
-        for result in request.data.get('results', []):
-            # extra_info logic as above
-            extra = result.copy()
-            for k in ('success', 'started', 'finished', 'name', 'output', 'errout'):
-                extra.pop(k, None)
+        return self.build_created(save_build(
+            project, build, steps, data.get('tags'), self.build_user(request)))
 
-            # Create the BuildStep, handling errors as above
-            try:
-                BuildStep.objects.create(
-                    build = build,
-                    success = result['success'],
-                    started = mk_datetime(getattr(result, 'started', '')),
-                    finished = mk_datetime(getattr(result, 'finished', '')),
-                    name = result['name'],
-                    output = result.get('output', ''),
-                    errout = result.get('errout', ''),
-                    extra_info = simplejson.dumps(extra),
-                )
-            except (KeyError, ValueError), ex:
-                # We'll get a KeyError from request.data[k] if the given key
-                # is missing and ValueError from improperly formatted dates.
-                # Treat either of these as improperly formatted requests
-                # and return a 400 (Bad Request)
-                return HttpResponseBadRequest(str(ex))
-
-        # It worked! Return a 201 created
-        url = urlresolvers.reverse(BuildHandler.viewname, args=[project.slug, build.pk])
+    @allow_404
+    @require_mime('json')
+    @authentication_optional
+    @transaction.commit_on_success
+    def create_streaming(self, request, slug):
+        """
+        Like `create`, but reads the request body a chunk at a time and
+        spools step output to log storage as it arrives, so memory use
+        doesn't grow with the size of the build. `Resource` sends large
+        uploads here instead of letting piston parse them.
+        """
+        project = get_object_or_404(Project, slug=slug)
+        chunk_size = getattr(settings, 'DEVMASON_STREAMING_CHUNK_SIZE', 64 * 1024)
+        reader = JSONStreamReader(request_body(request), chunk_size)
+
+        data = {}
+        results = []
+        # (index of the step, 'output' or 'errout', LogSpool) for each
+        # piece of output
+        spools = []
+        try:
+            for key in reader.iter_object():
+                if key != 'results':
+                    data[key] = reader.read_value()
+                    continue
+                for index in reader.iter_array():
+                    result = {}
+                    for step_key in reader.iter_object():
+                        if step_key in ('output', 'errout') and reader.peek() == u'"':
+                            spool = LogSpool()
+                            spools.append((index, step_key, spool))
+                            reader.read_string(spool.write)
+                            spool.close()
+                        else:
+                            result[step_key] = reader.read_value()
+                    results.append(result)
+            reader.finish()
+            if data.get('incremental'):
+                for index, attr, spool in spools:
+                    spool.discard()
+                return self.open_incremental(request, project, data)
+
+            build, steps = parse_build(data, results)
+        except (KeyError, ValueError), ex:
+            # As in create(), plus ValueError for malformed JSON.
+            for index, attr, spool in spools:
+                spool.discard()
+            return HttpResponseBadRequest(str(ex))
+
+        # The payload's good, so keep the output.
+        attach_spools([(steps[index], attr, spool) for index, attr, spool in spools])
+
+        if getattr(settings, 'DEVMASON_ASYNC_INGEST', False):
+            # Queue the build as in create(), with the output that went to
+            # log storage referred to rather than copied into the queue.
+            logs = []
+            for index, attr, spool in spools:
+                log = getattr(steps[index], attr + '_log')
+                if log is None:
+                    results[index][attr] = getattr(steps[index], attr)
+                else:
+                    results[index][attr] = u''
+                    logs.append((index, attr, log.pk))
+            data['results'] = results
+            return self.build_queued(request, project, data, logs)
+
+        return self.build_created(save_build(
+            project, build, steps, data.get('tags'), self.build_user(request)))
+
+    def open_incremental(self, request, project, data):
+        """
+        Start an incremental build, even in async mode: its steps need
+        somewhere to go straight away.
+        """
+        try:
+            build = open_build(project, data, self.build_user(request))
+        except (KeyError, ValueError), ex:
+            return HttpResponseBadRequest(str(ex))
+        return HttpResponseCreated(urlresolvers.reverse(
+            BuildProgressHandler.viewname, args=[project.slug, build.pk]))
+
+    @staticmethod
+    def build_user(request):
+        return request.user.is_authenticated() and request.user or None
+
+    def build_queued(self, request, project, data, logs=()):
+        user = self.build_user(request)
+        entry_id = BuildQueue().enqueue(project.slug, data, user and user.pk, logs)
+        return HttpResponseAccepted(urlresolvers.reverse(
+            QueuedBuildHandler.viewname, args=[project.slug, entry_id]))
+
+    @staticmethod
+    def build_created(build):
+        url = urlresolvers.reverse(BuildHandler.viewname, args=[build.project.slug, build.pk])
         return HttpResponseCreated(url)
 
 class BuildHandler(BaseHandler):
@@ -244,15 +445,37 @@ class BuildHandler(BaseHandler):
     model = Build
     fields = ('success', 'started', 'finished', 'tags',
               'client', 'results', 'links')
+    # The fields ?expand= picks from; see `utils.requested_fields`.
+    expandable = ('results', 'tags', 'client')
     viewname = 'build_detail'
+    immutable = True
 
     @allow_404
     def read(self, request, slug, build_id):
-        return get_object_or_404(Build, project__slug=slug, pk=build_id)
+        builds = prefetch_builds(Build.objects.filter(project__slug=slug, pk=build_id).order_by(),
+                                 **build_prefetch(request))
+        if not builds:
+            raise Http404("No such build")
+        if builds[0].in_progress:
+            return redirect(BuildProgressHandler.viewname, slug, build_id)
+        # With ?summary=1, steps link to their output rather than include it.
+        builds[0].summary = bool(request.GET.get('summary'))
+        return builds[0]
+
+    def validators(self, request, slug, build_id):
+        try:
+            finished = Build.objects.filter(project__slug=slug, pk=build_id, in_progress=False) \
+                                    .order_by() \
+                                    .values_list('finished', flat=True)[0]
+        except IndexError:
+            return None
+        if request.GET.get('summary'):
+            return 'build:%s:summary' % build_id, finished
+        return 'build:%s' % build_id, finished
 
     @classmethod
     def tags(cls, build):
-        return [t.name for t in build.tags]
+        return [t.name for t in build.get_tags()]
 
     @classmethod
     def started(cls, build):
@@ -276,15 +499,25 @@ class BuildHandler(BaseHandler):
     @classmethod
     def results(cls, build):
         rv = []
-        for step in build.steps.all():
+        for step in build.get_steps():
             step_data = {
                 'success': step.success,
                 'started': format_dt(step.started),
-                'finished': format_dt(step.finished),
                 'name': step.name,
-                'output': step.output,
-                'errout': step.errout,
             }
+            # Running steps of incremental builds haven't finished yet.
+            if not step.in_progress:
+                step_data['finished'] = format_dt(step.finished)
+            if getattr(build, 'summary', False):
+                step_data['output_size'] = step.get_output_size()
+                step_data['errout_size'] = step.get_errout_size()
+                step_data['links'] = [
+                    {'rel': 'output', 'href': step.get_output_url(), 'allowed_methods': ['GET']},
+                    {'rel': 'errout', 'href': step.get_errout_url(), 'allowed_methods': ['GET']},
+                ]
+            else:
+                step_data['output'] = step.get_output()
+                step_data['errout'] = step.get_errout()
             step_data.update(step.extra_info)
             rv.append(step_data)
         return rv
@@ -295,10 +528,133 @@ class BuildHandler(BaseHandler):
             link('self', BuildHandler, build.project.slug, build.pk),
             link('project', ProjectHandler, build.project.slug),
         ]
-        for tag in build.tags:
+        for tag in build.get_tags():
             links.append(link('tag', TagHandler, build.project.slug, tag.name))
         return links
 
+class BuildProgressHandler(BaseHandler):
+    """
+    An incremental build while it's running (see `ingest.open_build`): POST
+    steps to it, and DELETE it to finish the build. It's gone after that.
+    """
+    allowed_methods = ['GET', 'POST', 'DELETE']
+    viewname = 'build_progress'
+    # Step output grows without anything in the database changing.
+    cache_responses = False
+
+    def get_build(self, slug, build_id):
+        return get_object_or_404(Build.objects.select_related('project', 'user'),
+                                 project__slug=slug, pk=build_id)
+
+    @allow_404
+    def read(self, request, slug, build_id):
+        build = self.get_build(slug, build_id)
+        if not build.in_progress:
+            return HttpResponseGone()
+        prefetch_builds([build])
+        # Steps link to their output, to follow while it's being written.
+        build.summary = True
+        return {
+            'started': format_dt(build.started),
+            'tags': BuildHandler.tags(build),
+            'client': BuildHandler.client(build),
+            'results': BuildHandler.results(build),
+            'links': [
+                link('self', BuildProgressHandler, slug, build.pk),
+                link('project', ProjectHandler, slug),
+            ],
+        }
+
+    @allow_404
+    @require_mime('json')
+    @authentication_optional
+    @transaction.commit_on_success
+    def create(self, request, slug, build_id):
+        """
+        Add a step, or with the `id` of a running step, add to its output
+        and finish it. See `ingest.add_step`.
+        """
+        build = self.get_build(slug, build_id)
+        refused = self.refuse(request, build)
+        if refused:
+            return refused
+
+        result = request.data
+        try:
+            if result.get('id'):
+                step = get_object_or_404(BuildStep, pk=result['id'], build=build)
+                if not step.in_progress:
+                    return HttpResponseConflict()
+                update_step(step, result)
+            else:
+                step = add_step(build, result)
+        except (KeyError, ValueError), ex:
+            return HttpResponseBadRequest(str(ex))
+
+        # A new running step's output is where to follow it from, and where
+        # its id is.
+        if step.in_progress and not result.get('id'):
+            return HttpResponseCreated(step.get_output_url())
+        return self.build_location(HttpResponseNoContent(), build)
+
+    @allow_404
+    @authentication_optional
+    @transaction.commit_on_success
+    def delete(self, request, slug, build_id):
+        build = self.get_build(slug, build_id)
+        refused = self.refuse(request, build)
+        if refused:
+            return refused
+        if not finish_build(build):
+            return HttpResponseGone()
+        return self.build_location(HttpResponseNoContent(), build)
+
+    @staticmethod
+    def refuse(request, build):
+        """
+        The response to refuse to change `build` with, if it's finished or
+        it was opened by somebody else.
+        """
+        if not build.in_progress:
+            return HttpResponseGone()
+        if build.user_id and build.user_id != request.user.id:
+            return HttpResponseForbidden()
+        return None
+
+    @staticmethod
+    def build_location(response, build):
+        response['Location'] = urlresolvers.reverse(BuildHandler.viewname,
+                                                    args=[build.project.slug, build.pk])
+        return response
+
+class QueuedBuildHandler(BaseHandler):
+    """The status of a build queued by an async POST to a build list."""
+    allowed_methods = ['GET']
+    viewname = 'queued_build'
+    # The status changes without anything in the database changing.
+    cache_responses = False
+
+    @allow_404
+    def read(self, request, slug, entry_id):
+        project = get_object_or_404(Project, slug=slug)
+        status = BuildQueue().status(entry_id)
+        if status is None:
+            raise Http404("No such queued build")
+
+        state, detail = status
+        if state == 'done':
+            return redirect('build_detail', project.slug, detail)
+        response = {
+            'status': state,
+            'links': [
+                link('self', QueuedBuildHandler, project.slug, entry_id),
+                link('project', ProjectHandler, project.slug),
+            ],
+        }
+        if state == 'failed':
+            response['error'] = detail
+        return response
+
 class LatestBuildHandler(BaseHandler):
     allowed_methods = ['GET']
     viewname = 'latest_build'
@@ -306,8 +662,9 @@ class LatestBuildHandler(BaseHandler):
     @allow_404
     def read(self, request, slug):
         project = get_object_or_404(Project, slug=slug)
-        build = list(project.builds.all().order_by('-pk'))[0]
-        return redirect('build_detail', slug, build.pk)
+        if not project.latest_build_id:
+            raise Http404("No builds")
+        return redirect('build_detail', slug, project.latest_build_id)
 
 class ProjectTagListHandler(BaseHandler):
     allowed_methods = ['GET']
@@ -316,19 +673,69 @@ class ProjectTagListHandler(BaseHandler):
     @allow_404
     def read(self, request, slug):
         project = get_object_or_404(Project, slug=slug)
-        tags = Tag.objects.usage_for_model(Build, filters={'project': project})
+        # Sorted here rather than by the database, which would need a join.
+        usage = sorted(project.tag_usage.select_related('tag'), key=lambda u: u.tag.name)
 
         links = [
             link('self', ProjectTagListHandler, project.slug),
             link('project', ProjectHandler, project.slug),
         ]
-        links.extend(link('tag', TagHandler, project.slug, tag.name) for tag in tags)
+        links.extend(link('tag', TagHandler, project.slug, u.tag.name) for u in usage)
 
         return {
-            'tags': [tag.name for tag in tags],
+            'tags': [u.tag.name for u in usage],
+            'usage': [{
+                'tag': u.tag.name,
+                'builds': u.builds,
+                'last_used': format_dt(u.last_used),
+            } for u in usage],
             'links': links,
         }
 
+    def validators(self, request, slug):
+        return build_list_validators(slug)
+
+class ProjectStatsHandler(BaseHandler):
+    """
+    Pass rate, build count and build durations for each recent day or week
+    (`?period=week`), overall and by arch and host. Read only from the
+    rollups kept by `devmason_server.rollups`.
+    """
+    allowed_methods = ['GET']
+    viewname = 'project_stats'
+
+    # Periods shown by default, and at most.
+    default_counts = {'day': 30, 'week': 12}
+    max_count = 366
+
+    @allow_404
+    def read(self, request, slug):
+        project = get_object_or_404(Project, slug=slug)
+        period = request.GET.get('period', 'day')
+        if period not in self.default_counts:
+            return HttpResponseBadRequest("period must be day or week")
+        count = self.default_counts[period]
+        if 'count' in request.GET:
+            try:
+                count = int(request.GET['count'])
+            except ValueError:
+                count = 0
+            if count < 1:
+                return HttpResponseBadRequest("count must be a whole number of at least 1")
+            count = min(count, self.max_count)
+
+        return {
+            'period': period,
+            'stats': project_stats(project, period, count),
+            'links': [
+                link('self', ProjectStatsHandler, project.slug),
+                link('project', ProjectHandler, project.slug),
+            ],
+        }
+
+    def validators(self, request, slug):
+        return build_list_validators(slug)
+
 class TagHandler(PaginatedBuildHandler):
     allowed_methods = ['GET']
     viewname = 'tag_detail'
@@ -338,16 +745,20 @@ class TagHandler(PaginatedBuildHandler):
     def read(self, request, slug, tags):
         project = get_object_or_404(Project, slug=slug)
         tag_list = tags.split(';')
-        builds = Build.tagged.with_all(tags, queryset=project.builds.all())
+        builds = TaggedBuilds(project, tag_list)
 
         links = []
         def make_link(rel, **kwargs):
             links.append(link(rel, self, project.slug, tags, **kwargs))
 
-        response = self.handle_paginated_builds(builds, request.GET, make_link, {'tags': tag_list})
+        response = self.handle_paginated_builds(builds, request.GET, make_link, {'tags': tag_list},
+                                                build_prefetch(request), streams_builds(request))
         response['links'] = links
         return response
 
+    def validators(self, request, slug, tags):
+        return build_list_validators(slug)
+
 class ProjectLatestTaggedBuildHandler(BaseHandler):
     allowed_methods = ['GET']
     viewname = 'latest_tagged_build'
@@ -355,10 +766,70 @@ class ProjectLatestTaggedBuildHandler(BaseHandler):
     @allow_404
     def read(self, request, slug, tags):
         project = get_object_or_404(Project, slug=slug)
-        tag_list = tags.split(';')
-        builds = Build.tagged.with_all(tags, queryset=project.builds.all())
-        try:
-            b = builds[0]
-        except IndexError:
+        b = TaggedBuilds(project, tags.split(';')).latest()
+        if b is None:
             raise Http404("No builds")
         return redirect('build_detail', project.slug, b.pk)
+
+def build_request_data(build_request):
+    """What a build worker is told about a build request it has leased."""
+    repository = build_request.repository
+    return {
+        'id': build_request.pk,
+        'project': repository.project.slug,
+        'repository': repository.url,
+        'vcs': repository.type,
+        'identifier': build_request.identifier,
+        'arch': build_request.arch,
+        'requested': format_dt(build_request.requested),
+        'lease_token': build_request.lease_token,
+        'lease_expires': format_dt(build_request.available_at),
+    }
+
+class BuildRequestLeaseHandler(BaseHandler):
+    """Lets build workers lease pending build requests."""
+    allowed_methods = ['POST']
+    viewname = 'lease_build_requests'
+
+    @require_mime('json')
+    @authentication_required
+    def create(self, request):
+        # Only known build workers get to take requests off the queue.
+        if request.user.is_new_user:
+            return HttpResponseForbidden()
+        try:
+            arch = request.data['arch']
+            worker = request.data['worker']
+            count = int(request.data.get('count', 1))
+            duration = None
+            if 'lease_time' in request.data:
+                duration = int(request.data['lease_time'])
+            if count < 1 or (duration is not None and duration < 1):
+                raise ValueError("count and lease_time must be at least 1")
+        except (TypeError, KeyError, ValueError, AttributeError), ex:
+            return HttpResponseBadRequest(str(ex))
+
+        leased = BuildRequest.objects.lease(arch, worker, count, duration)
+        return {
+            'build_requests': [build_request_data(r) for r in leased],
+        }
+
+class BuildRequestCompleteHandler(BaseHandler):
+    """Lets build workers hand back a leased build request once it's built."""
+    allowed_methods = ['POST']
+    viewname = 'complete_build_request'
+
+    @require_mime('json')
+    @authentication_required
+    def create(self, request, request_id):
+        if request.user.is_new_user:
+            return HttpResponseForbidden()
+        try:
+            lease_token = request.data['lease_token']
+        except (TypeError, KeyError), ex:
+            return HttpResponseBadRequest(str(ex))
+
+        if BuildRequest.objects.complete(request_id, lease_token):
+            return HttpResponseNoContent()
+        # The lease ran out and somebody else has the request now.
+        return HttpResponseConflict()
@@ -0,0 +1,197 @@
+"""
+Build ingestion: turning a reported build into rows in the database.
+
+The REST API, XML-RPC and the `ingest_builds` workers all save builds
+through here, so there's one place that knows what a build looks like.
+
+Incremental builds are reported a piece at a time instead: `open_build`
+starts one, `add_step` and `update_step` report its steps and their output
+as they run, and `finish_build` makes it a build like any other.
+"""
+
+from django.db.models import Q
+from .bulk import bulk_insert, bulk_tag
+from .logstore import attach_spools, move_output_to_logs
+from .models import Project, Build, BuildStep
+from .prefetch import prefetch_builds
+from .rollups import count_build
+from .tagindex import index_build
+from .utils import mk_datetime
+
+def build_from_data(data):
+    """Make an unsaved Build from a posted build representation."""
+    # Construct us the dict of "extra" info from the request
+    extra = data['client'].copy()
+    for k in ('success', 'started', 'finished', 'client', 'results', 'tags'):
+        extra.pop(k, None)
+
+    return Build(
+        success = data['success'],
+        started = mk_datetime(data.get('started', '')),
+        finished = mk_datetime(data.get('finished', '')),
+        host = data['client']['host'],
+        arch = data['client']['arch'],
+        extra_info = extra,
+    )
+
+def step_from_data(result):
+    """Make an unsaved BuildStep from one entry of a build's results."""
+    # extra_info logic as above
+    extra = result.copy()
+    for k in ('success', 'started', 'finished', 'name', 'output', 'errout'):
+        extra.pop(k, None)
+
+    return BuildStep(
+        success = result['success'],
+        started = mk_datetime(result.get('started', '')),
+        finished = mk_datetime(result.get('finished', '')),
+        name = result['name'],
+        output = result.get('output', ''),
+        errout = result.get('errout', ''),
+        extra_info = extra,
+    )
+
+def parse_build(data, results=None):
+    """
+    Check a whole build representation before anything is written, so that
+    a bad step can't leave half a build behind. Returns an unsaved (build,
+    steps) pair. `results` are the build's steps, if they're not in `data`.
+
+    We'll get a KeyError from data[k] if the given key is missing and
+    ValueError from improperly formatted dates; callers should treat either
+    as a bad request.
+    """
+    if results is None:
+        results = data.get('results', [])
+    return build_from_data(data), [step_from_data(result) for result in results]
+
+def save_build(project, build, steps, tags=None, user=None):
+    """Write a validated build and its steps, returning the build."""
+    build.project = project
+    build.user = user
+    build.save()
+
+    # Tag us a build, and index it under its tags.
+    if tags is not None:
+        index_build(build, bulk_tag(build, ",".join(tags)))
+
+    # Write every build step in as few INSERTs as possible, with any
+    # large output compressed into log storage.
+    move_output_to_logs(steps)
+    for step in steps:
+        step.build = build
+    bulk_insert(BuildStep, steps)
+
+    publish_build(build)
+    return build
+
+def publish_build(build):
+    """Point the project at a newly saved `build`, and count it."""
+    # Point the project at its newest build; this is what the project
+    # list shows, so it's updated in the same transaction as the build.
+    # The pk check keeps a slow concurrent request from moving it back.
+    Project.objects.filter(pk=build.project_id) \
+                   .filter(Q(latest_build_id__isnull=True) | Q(latest_build_id__lt=build.pk)) \
+                   .update(latest_build_id=build.pk)
+
+    # Add it to the project's build statistics.
+    count_build(build)
+
+def ingest_build(project, data, user=None):
+    """Check and save a build representation, returning the new Build."""
+    build, steps = parse_build(data)
+    return save_build(project, build, steps, data.get('tags'), user)
+
+def open_build(project, data, user=None):
+    """
+    Start an incremental build from its representation: a build's, without
+    `success`, `finished` or `results`. Returns the build, which is tagged
+    but kept out of build lists, the tag index and statistics until
+    `finish_build`.
+    """
+    build = build_from_data(dict(data, success=False, finished=data.get('started', '')))
+    build.in_progress = True
+    build.project = project
+    build.user = user
+    build.save()
+    if data.get('tags'):
+        bulk_tag(build, ",".join(data['tags']))
+    return build
+
+def add_step(build, result):
+    """
+    Add a step to an incremental `build`, returning it. A step without a
+    `finished` time is still running: its output goes to a `RunningLog`, and
+    `update_step` adds to it and finishes it.
+    """
+    running = not result.get('finished')
+    if running:
+        result = dict(result, success=False, finished=result.get('started', ''))
+    step = step_from_data(result)
+    step.build = build
+    step.in_progress = running
+    if not running:
+        move_output_to_logs([step])
+        step.save()
+        return step
+
+    output, errout = step.output, step.errout
+    step.output = step.errout = ''
+    step.save()
+    for attr, text in (('output', output), ('errout', errout)):
+        if text:
+            step.running_log(attr).append(text)
+    return step
+
+def update_step(step, result):
+    """
+    Append any `output` and `errout` in `result` to a running `step`, and
+    finish it if `result` has a `finished` time.
+    """
+    # Checked before anything's written, like a whole build.
+    finished = result.get('finished') and step_from_data(dict(result, name=step.name))
+    for attr in ('output', 'errout'):
+        if result.get(attr):
+            step.running_log(attr).append(result[attr])
+    if not finished:
+        return
+    step.success = finished.success
+    step.finished = finished.finished
+    extra = dict(finished.extra_info)
+    extra.pop('id', None)
+    if extra:
+        info = dict(step.extra_info or {})
+        info.update(extra)
+        step.extra_info = info
+    finish_step(step)
+
+def finish_step(step):
+    """Keep a running `step`'s output like any other step's."""
+    logs = [(attr, step.running_log(attr)) for attr in ('output', 'errout')]
+    attach_spools([(step, attr, log.spool()) for attr, log in logs])
+    step.in_progress = False
+    step.save()
+    for attr, log in logs:
+        log.discard()
+
+def finish_build(build):
+    """
+    Finish an incremental `build`. Steps still running are finished as
+    failed; the build succeeded if every step did, and finished when its
+    last step did. Returns False if somebody else finished it first.
+    """
+    if not Build.objects.filter(pk=build.pk, in_progress=True).update(in_progress=False):
+        return False
+    prefetch_builds([build])
+    steps = build.get_steps()
+    for step in steps:
+        if step.in_progress:
+            finish_step(step)
+    build.success = all(step.success for step in steps)
+    build.finished = max([build.started] + [step.finished for step in steps])
+    build.in_progress = False
+    build.save()
+
+    index_build(build, build.get_tags())
+    publish_build(build)
+    return True
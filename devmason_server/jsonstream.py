@@ -0,0 +1,229 @@
+"""
+An incremental JSON reader.
+
+simplejson wants the whole document in memory at once. This reads from a
+file-like object a chunk at a time, so that callers can walk a document whose
+string values are far bigger than they'd like to hold in memory, handing
+those strings off in pieces instead.
+"""
+
+import re
+import codecs
+
+WHITESPACE = u' \t\n\r'
+STRING_SPECIAL = re.compile(ur'["\\\x00-\x1f]')
+LITERAL = re.compile(ur'[\w+\-.]*', re.UNICODE)
+NUMBER = re.compile(ur'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?$')
+ESCAPES = {
+    u'"': u'"', u'\\': u'\\', u'/': u'/', u'b': u'\b',
+    u'f': u'\f', u'n': u'\n', u'r': u'\r', u't': u'\t',
+}
+CONSTANTS = {u'true': True, u'false': False, u'null': None}
+
+class JSONStreamError(ValueError):
+    pass
+
+class JSONStreamReader(object):
+    """
+    Pull-style reader over a UTF-8 encoded JSON document.
+
+    Containers are walked with `iter_object` and `iter_array`; everything
+    else is read with `read_value`, or `read_string` to have a string passed
+    to a callback in pieces rather than returned whole.
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read another chunk into the buffer. False at the end of input."""
+        while not self.eof:
+            data = self.stream.read(self.chunk_size)
+            if not data:
+                self.eof = True
+            try:
+                text = self.decoder.decode(data, self.eof)
+            except UnicodeDecodeError, ex:
+                raise JSONStreamError(str(ex))
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def _ensure(self, count):
+        """Make sure at least `count` unread characters are buffered."""
+        while len(self.buf) - self.pos < count:
+            if not self._fill():
+                raise JSONStreamError('Unexpected end of input')
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it,
+        or an empty string at the end of input.
+        """
+        while True:
+            while self.pos < len(self.buf):
+                if self.buf[self.pos] not in WHITESPACE:
+                    return self.buf[self.pos]
+                self.pos += 1
+            if not self._fill():
+                return u''
+
+    def _expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise JSONStreamError('Expected %r but found %r' % (char, found or 'end of input'))
+        self.pos += 1
+
+    def _error(self, message):
+        return JSONStreamError('%s near %r' % (message, self.buf[self.pos:self.pos + 20]))
+
+    def iter_object(self):
+        """
+        Walk an object, yielding its keys. The caller must read the value
+        belonging to each key before asking for the next one.
+        """
+        self._expect(u'{')
+        if self.peek() == u'}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != u'"':
+                raise self._error('Expected an object key')
+            key = self.read_string()
+            self._expect(u':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == u'}':
+                return
+            if char != u',':
+                raise self._error('Expected "," or "}"')
+
+    def iter_array(self):
+        """
+        Walk an array, yielding its indexes. The caller must read each
+        element before asking for the next one.
+        """
+        self._expect(u'[')
+        if self.peek() == u']':
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            char = self.peek()
+            self.pos += 1
+            if char == u']':
+                return
+            if char != u',':
+                raise self._error('Expected "," or "]"')
+
+    def read_string(self, write=None):
+        """
+        Read a string. If `write` is given it's called with successive pieces
+        of the string -- none longer than a chunk -- and nothing is returned.
+        """
+        self._expect(u'"')
+        pieces = None
+        if write is None:
+            pieces = []
+            write = pieces.append
+
+        while True:
+            match = STRING_SPECIAL.search(self.buf, self.pos)
+            if match is None:
+                if self.pos < len(self.buf):
+                    write(self.buf[self.pos:])
+                    self.pos = len(self.buf)
+                if not self._fill():
+                    raise JSONStreamError('Unterminated string')
+                continue
+
+            if match.start() > self.pos:
+                write(self.buf[self.pos:match.start()])
+            self.pos = match.start()
+            char = self.buf[self.pos]
+            if char == u'"':
+                self.pos += 1
+                break
+            if char != u'\\':
+                raise self._error('Invalid control character in string')
+            write(self._read_escape())
+
+        if pieces is not None:
+            return u''.join(pieces)
+
+    def _read_escape(self):
+        self._ensure(2)
+        escape = self.buf[self.pos + 1]
+        if escape in ESCAPES:
+            self.pos += 2
+            return ESCAPES[escape]
+        if escape != u'u':
+            raise self._error('Invalid escape')
+
+        codepoint = self._read_codepoint()
+        if 0xd800 <= codepoint < 0xdc00:
+            # A surrogate pair encodes a character outside the BMP.
+            self._ensure(2)
+            if self.buf[self.pos:self.pos + 2] == u'\\u':
+                low = self._read_codepoint()
+                if not 0xdc00 <= low < 0xe000:
+                    raise self._error('Invalid surrogate pair')
+                codepoint = 0x10000 + ((codepoint - 0xd800) << 10) + (low - 0xdc00)
+        # Works on both narrow and wide Python builds, unlike unichr().
+        return ('\\U%08x' % codepoint).decode('unicode-escape')
+
+    def _read_codepoint(self):
+        self._ensure(6)
+        try:
+            codepoint = int(self.buf[self.pos + 2:self.pos + 6], 16)
+        except ValueError:
+            raise self._error('Invalid \\u escape')
+        self.pos += 6
+        return codepoint
+
+    def _read_literal(self):
+        pieces = []
+        while True:
+            match = LITERAL.match(self.buf, self.pos)
+            pieces.append(match.group())
+            self.pos = match.end()
+            if self.pos < len(self.buf) or not self._fill():
+                break
+        token = u''.join(pieces)
+
+        if token in CONSTANTS:
+            return CONSTANTS[token]
+        match = NUMBER.match(token)
+        if not match:
+            raise JSONStreamError('Invalid value %r' % token[:20])
+        if match.group(1) or match.group(2):
+            return float(token)
+        return int(token)
+
+    def read_value(self):
+        """Read a complete value of any type."""
+        char = self.peek()
+        if char == u'{':
+            return dict((key, self.read_value()) for key in self.iter_object())
+        if char == u'[':
+            return [self.read_value() for index in self.iter_array()]
+        if char == u'"':
+            return self.read_string()
+        if not char:
+            raise JSONStreamError('Unexpected end of input')
+        return self._read_literal()
+
+    def finish(self):
+        """Check that nothing but whitespace follows the document."""
+        if self.peek():
+            raise self._error('Extra data after document')
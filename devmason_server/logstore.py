@@ -0,0 +1,498 @@
+"""
+Compressed, content-addressed storage for build step output.
+
+Step output can run to tens of megabytes, and nightly builds of a project
+tend to produce the same output over and over. Output bigger than
+`DEVMASON_LOG_INLINE_LIMIT` is compressed and kept in a Django file storage,
+named by the SHA-1 of its uncompressed content, with a `BuildLog` row to
+refer to it by -- so identical output is only ever stored once.
+
+So that part of a big log can be read without decompressing all of it,
+zlib logs are flushed to a fresh start at the beginning of a line every
+`CHECKPOINT_SIZE` bytes or so, and the `BuildLog` keeps an index of these
+checkpoints: the line number, offset, and offset in storage of each.
+`LogReader` uses it to read byte ranges and runs of lines.
+
+Output of a step that's still running is appended to a plain file, a
+`RunningLog`, until the step finishes and it's kept like any other.
+"""
+
+import os
+import bz2
+import codecs
+import zlib
+import hashlib
+import tempfile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, get_storage_class
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# codec name -> (compressor factory, decompressor factory). The empty codec
+# is for logs stored uncompressed by older versions.
+CODECS = {
+    '': (None, None),
+    'zlib': (lambda: zlib.compressobj(9), zlib.decompressobj),
+    'bz2': (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+if lzma:
+    CODECS['lzma'] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+# Codecs that can start decompressing at a checkpoint.
+SEEKABLE_CODECS = ('', 'zlib')
+
+READ_SIZE = 64 * 1024
+CHECKPOINT_SIZE = 256 * 1024
+
+def inline_limit():
+    """Output up to this many bytes long stays in the database."""
+    return getattr(settings, 'DEVMASON_LOG_INLINE_LIMIT', 1024)
+
+def default_codec():
+    return getattr(settings, 'DEVMASON_LOG_CODEC', 'zlib')
+
+def log_storage():
+    """
+    The storage step logs are kept in: `DEVMASON_LOG_STORAGE` if it names a
+    storage class, otherwise the filesystem under `DEVMASON_LOG_ROOT`.
+    """
+    import_path = getattr(settings, 'DEVMASON_LOG_STORAGE', None)
+    if import_path:
+        return get_storage_class(import_path)()
+    root = getattr(settings, 'DEVMASON_LOG_ROOT',
+                   os.path.join(settings.MEDIA_ROOT, 'build_logs'))
+    return FileSystemStorage(location=root)
+
+def running_log_root():
+    """
+    Where output of running steps is kept. Every server process has to see
+    the same directory.
+    """
+    return getattr(settings, 'DEVMASON_RUNNING_LOG_ROOT',
+                   os.path.join(settings.MEDIA_ROOT, 'running_logs'))
+
+def log_name(digest):
+    return '%s/%s' % (digest[:2], digest)
+
+def _decompress(fp, codec, raw=False):
+    decompressor = CODECS[codec][1]
+    if raw:
+        # From a checkpoint: deflate data without the zlib header.
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        decompressor = decompressor and decompressor()
+    while True:
+        data = fp.read(READ_SIZE)
+        if not data:
+            break
+        if decompressor:
+            data = decompressor.decompress(data)
+        if data:
+            yield data
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def iter_content(log):
+    """Yield the uncompressed content of a `BuildLog`, a piece at a time."""
+    fp = log_storage().open(log.name)
+    try:
+        for data in _decompress(fp, log.codec):
+            yield data
+    finally:
+        fp.close()
+
+class LogSpool(object):
+    """
+    Collects one piece of output in a compressed temporary file, hashing it
+    on the way in. Hand spools to `save_spools()` to keep them, or call
+    `discard()` to throw them away.
+    """
+
+    def __init__(self, codec=None):
+        if codec is None:
+            codec = default_codec()
+        self.codec = codec
+        compressor = CODECS[codec][0]
+        self.compressor = compressor and compressor()
+        fd, self.path = tempfile.mkstemp(prefix='devmason-log-')
+        self.file = os.fdopen(fd, 'wb')
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.stored = 0
+        # Checkpoints as [line, offset, stored offset], and how far we are
+        # past the last one.
+        self.lines = 0
+        self.checkpoints = [[0, 0, 0]]
+        self.since_checkpoint = 0
+        self.at_line_start = True
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sha1.update(data)
+        if self.codec not in SEEKABLE_CODECS:
+            self._write(data)
+            return
+        while data:
+            if self.since_checkpoint < CHECKPOINT_SIZE:
+                room = CHECKPOINT_SIZE - self.since_checkpoint
+                self._write(data[:room])
+                data = data[room:]
+            elif self.at_line_start:
+                self._checkpoint()
+            else:
+                # Carry on to the end of the line.
+                end = data.find('\n') + 1 or len(data)
+                self._write(data[:end])
+                data = data[end:]
+
+    def _write(self, data):
+        self.size += len(data)
+        self.lines += data.count('\n')
+        self.since_checkpoint += len(data)
+        if data:
+            self.at_line_start = data.endswith('\n')
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.stored += len(data)
+        self.file.write(data)
+
+    def _checkpoint(self):
+        if self.compressor:
+            data = self.compressor.flush(zlib.Z_FULL_FLUSH)
+            self.stored += len(data)
+            self.file.write(data)
+        self.checkpoints.append([self.lines, self.size, self.stored])
+        self.since_checkpoint = 0
+
+    @property
+    def line_index(self):
+        """The index kept with the log: its checkpoints, and how many lines."""
+        lines = self.lines + (not self.at_line_start and 1 or 0)
+        return {'lines': lines, 'checkpoints': self.checkpoints}
+
+    def close(self):
+        if not self.file.closed:
+            if self.compressor:
+                self.file.write(self.compressor.flush())
+            self.file.close()
+
+    @property
+    def digest(self):
+        return self.sha1.hexdigest()
+
+    @property
+    def stored_size(self):
+        self.close()
+        return os.path.getsize(self.path)
+
+    def read(self):
+        """The spooled output, decompressed and decoded."""
+        self.close()
+        fp = open(self.path, 'rb')
+        try:
+            return ''.join(_decompress(fp, self.codec)).decode('utf-8')
+        finally:
+            fp.close()
+
+    def store(self, name):
+        """Copy the spooled file into log storage as `name`."""
+        self.close()
+        storage = log_storage()
+        if storage.exists(name):
+            storage.delete(name)
+        fp = open(self.path, 'rb')
+        try:
+            storage.save(name, File(fp))
+        finally:
+            fp.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def save_spools(spools):
+    """
+    Keep the output in `spools`, returning a `BuildLog` -- or None, for empty
+    output -- for each of them. Output that's already stored is reused rather
+    than stored again. The spools are discarded either way.
+    """
+    from .models import BuildLog
+    try:
+        digests = list(set(s.digest for s in spools if s.size))
+        logs = {}
+        # Look up what's already stored in batches that keep us under
+        # SQLite's limit on query parameters.
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            logs.update((l.digest, l) for l in BuildLog.objects.filter(digest__in=batch))
+
+        for spool in spools:
+            if not spool.size or spool.digest in logs:
+                continue
+            # get_or_create, because a concurrent upload may have just
+            # stored the very same output.
+            log, created = BuildLog.objects.get_or_create(digest=spool.digest, defaults={
+                'size': spool.size,
+                'codec': spool.codec,
+                'stored_size': spool.stored_size,
+                'line_index': spool.line_index,
+            })
+            if created or not log_storage().exists(log.name):
+                spool.store(log.name)
+                if log.codec != spool.codec or not log.line_index:
+                    log.codec, log.stored_size = spool.codec, spool.stored_size
+                    log.line_index = spool.line_index
+                    log.save()
+            logs[spool.digest] = log
+
+        return [spool.size and logs[spool.digest] or None for spool in spools]
+    finally:
+        for spool in spools:
+            spool.discard()
+
+def store_logs(texts):
+    """Like `save_spools`, for output that's already in memory."""
+    spools = []
+    for text in texts:
+        spool = LogSpool()
+        spools.append(spool)
+        spool.write(text)
+        spool.close()
+    return save_spools(spools)
+
+def attach_spools(pending):
+    """
+    Attach spooled output to unsaved `BuildStep`s. `pending` is a list of
+    (step, 'output' or 'errout', spool) tuples. Output short enough to keep
+    inline goes back in the step's field; the rest goes to log storage.
+    """
+    limit = inline_limit()
+    stored = []
+    for step, attr, spool in pending:
+        if spool.size > limit:
+            stored.append((step, attr, spool))
+        else:
+            setattr(step, attr, spool.read())
+            spool.discard()
+
+    logs = save_spools([spool for step, attr, spool in stored])
+    for (step, attr, spool), log in zip(stored, logs):
+        setattr(step, attr, '')
+        setattr(step, attr + '_log', log)
+
+def move_output_to_logs(steps):
+    """
+    Move the output and errout of unsaved `BuildStep`s that's too big to
+    keep inline into log storage.
+    """
+    pending = []
+    limit = inline_limit()
+    for step in steps:
+        for attr in ('output', 'errout'):
+            text = getattr(step, attr)
+            if text and len(text.encode('utf-8')) > limit:
+                spool = LogSpool()
+                pending.append((step, attr, spool))
+                spool.write(text)
+                spool.close()
+    attach_spools(pending)
+
+class RunningLog(object):
+    """
+    The output or errout of a running step: a file under
+    `DEVMASON_RUNNING_LOG_ROOT` that output is appended to as it arrives.
+    A log nothing has been written to yet has no file, and reads as empty.
+    """
+
+    def __init__(self, step_id, attr):
+        self.path = os.path.join(running_log_root(), '%s.%s' % (step_id, attr))
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, text):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Somebody else made it first.
+                if not os.path.isdir(directory):
+                    raise
+        fp = open(self.path, 'ab')
+        try:
+            fp.write(text.encode('utf-8'))
+        finally:
+            fp.close()
+
+    def iter_from(self, offset):
+        """Yield the bytes from `offset` up to the end of what's there now."""
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            fp.seek(offset)
+            while True:
+                data = fp.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            fp.close()
+
+    def read(self):
+        """The output so far, decoded."""
+        return ''.join(self.iter_from(0)).decode('utf-8', 'replace')
+
+    def spool(self):
+        """The output in a `LogSpool`, to keep with `attach_spools`."""
+        spool = LogSpool()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for data in self.iter_from(0):
+            spool.write(decoder.decode(data))
+        spool.write(decoder.decode('', True))
+        spool.close()
+        return spool
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class LogReader(object):
+    """
+    Reads a byte range or a run of lines from one piece of step output,
+    whether it's kept inline or in log storage, without reading any more of
+    it than it has to. Content is yielded as UTF-8 in pieces.
+    """
+
+    def __init__(self, text=None, log=None, running=None):
+        self.log = log
+        self.running = running
+        if running is not None:
+            # Still growing, so it has no digest, and no index of its lines.
+            self.size = running.size
+            self.digest = None
+            self.index = None
+        elif log is None:
+            self.data = (text or u'').encode('utf-8')
+            self.size = len(self.data)
+            self.digest = hashlib.sha1(self.data).hexdigest()
+            self.index = None
+        else:
+            self.size = log.size
+            self.digest = log.digest
+            self.index = log.line_index or None
+
+    @classmethod
+    def for_step(cls, step, attr):
+        """A reader for a `BuildStep`'s 'output' or 'errout'."""
+        if step.in_progress:
+            return cls(running=step.running_log(attr))
+        log = getattr(step, attr + '_log')
+        if log is not None:
+            return cls(log=log)
+        return cls(text=getattr(step, attr))
+
+    @property
+    def lines(self):
+        if self.index is not None:
+            return self.index['lines']
+        # An old log, stored without an index: count them the slow way.
+        lines = 0
+        last = '\n'
+        for data in self._iter_from([0, 0, 0]):
+            if data:
+                lines += data.count('\n')
+                last = data[-1]
+        self.index = {'lines': lines + (last != '\n' and 1 or 0), 'checkpoints': [[0, 0, 0]]}
+        return self.index['lines']
+
+    def _checkpoint(self, column, value):
+        """The last checkpoint at or before `value` in `column`."""
+        checkpoints = self.index and self.index['checkpoints'] or [[0, 0, 0]]
+        if self.log is not None and self.log.codec not in SEEKABLE_CODECS:
+            checkpoints = checkpoints[:1]
+        best = checkpoints[0]
+        for checkpoint in checkpoints:
+            if checkpoint[column] > value:
+                break
+            best = checkpoint
+        return best
+
+    def _iter_from(self, checkpoint):
+        line, offset, stored_offset = checkpoint
+        if self.running is not None:
+            for data in self.running.iter_from(offset):
+                yield data
+            return
+        if self.log is None:
+            yield self.data[offset:]
+            return
+        fp = log_storage().open(self.log.name)
+        try:
+            if stored_offset:
+                fp.seek(stored_offset)
+            for data in _decompress(fp, self.log.codec,
+                                    raw=bool(stored_offset) and self.log.codec == 'zlib'):
+                yield data
+        finally:
+            fp.close()
+
+    def iter_range(self, start, end):
+        """Yield bytes `start` up to (but not including) `end`."""
+        if end <= start:
+            return
+        checkpoint = self._checkpoint(1, start)
+        skip, left = start - checkpoint[1], end - start
+        for data in self._iter_from(checkpoint):
+            if skip:
+                data, skip = data[skip:], max(0, skip - len(data))
+            data = data[:left]
+            left -= len(data)
+            if data:
+                yield data
+            if not left:
+                return
+
+    def iter_lines(self, first, count=None):
+        """Yield `count` lines (or all of them) from line `first`, counting from 0."""
+        if count == 0:
+            return
+        checkpoint = self._checkpoint(0, first)
+        skip, left = first - checkpoint[0], count
+        for data in self._iter_from(checkpoint):
+            while skip and data:
+                end = data.find('\n')
+                if end == -1:
+                    data = ''
+                else:
+                    data, skip = data[end + 1:], skip - 1
+            if not data:
+                continue
+            if left is not None:
+                # Find where the last line we want ends.
+                end = -1
+                while left and end < len(data):
+                    end = data.find('\n', end + 1)
+                    if end == -1:
+                        break
+                    left -= 1
+                if end != -1 and not left:
+                    yield data[:end + 1]
+                    return
+            yield data
@@ -0,0 +1,29 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Max
+from devmason_server.models import Project, Build
+
+class Command(NoArgsCommand):
+    help = "Point every project's latest_build at its newest build."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        # One grouped query for the newest build of every project, rather
+        # than walking each project's build history.
+        latest = dict(
+            (row['project'], row['latest'])
+            for row in Build.objects.filter(in_progress=False).order_by().values('project')
+                                    .annotate(latest=Max('pk'))
+        )
+
+        updated = 0
+        for project in Project.objects.all():
+            build_id = latest.get(project.pk)
+            if project.latest_build_id != build_id:
+                Project.objects.filter(pk=project.pk).update(latest_build_id=build_id)
+                updated += 1
+
+        if verbosity > 0:
+            print "Updated latest build for %s of %s projects." % (updated, Project.objects.count())
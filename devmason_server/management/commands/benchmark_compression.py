@@ -0,0 +1,129 @@
+import time
+import random
+import datetime
+from optparse import make_option
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.test.client import Client
+from django.utils import simplejson
+from devmason_server import compression
+from devmason_server.models import BuildStep
+from devmason_server.responsecache import response_cache
+from devmason_server.management.commands import benchmark_reads
+from devmason_server.management.commands.benchmark_reads import ROUTES, check_routes
+
+# Borrows benchmark_reads' choice of project, builds and tags.
+class Command(benchmark_reads.Command):
+    help = ("Compress a response from every GET route at several zlib levels, "
+            "against the data in the database (see generate_builds), and report "
+            "the CPU time it takes against the bytes it saves.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', default=None,
+                    help='Slug of the project to read; the one with the most builds by default.'),
+        make_option('--output', default=None,
+                    help='File to write the results to, as JSON.'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed for choosing builds and tags.'),
+        make_option('--levels', default='1,6,9',
+                    help='Comma-separated zlib levels to try.'),
+        make_option('--repeat', type='int', default=20,
+                    help='Number of times to compress each response.'),
+    )
+
+    def handle_noargs(self, **options):
+        check_routes()
+        verbosity = int(options.get('verbosity', 1))
+        levels = [int(l) for l in options['levels'].split(',')]
+        self.random = random.Random(options['seed'])
+        project = self.choose_project(options['project'])
+        build_ids = list(project.builds.filter(in_progress=False).values_list('pk', flat=True))
+        tags = self.popular_tags(build_ids)
+        self.steps = list(BuildStep.objects.filter(build__project=project).order_by('-pk')
+                          .values_list('build', 'pk')[:1000])
+
+        if verbosity > 0:
+            print "%-20s  %-4s  %-10s  %9s" % ('route', 'fmt', 'query', 'bytes') + \
+                  ''.join("  %9s  %7s" % ('l%d bytes' % l, 'l%d ms' % l) for l in levels) + \
+                  "  %8s" % ('cached ms')
+        results = []
+        totals = dict((level, [0, 0.0]) for level in levels)
+        total_bytes = 0
+        for name in sorted(ROUTES):
+            formats, queries = ROUTES[name]
+            for em_format in formats:
+                for query in queries:
+                    content = self.fetch(name, em_format, query,
+                                         self.url_args(name, project, build_ids, tags))
+                    if content is None:
+                        continue
+                    result = self.measure(content, levels, options['repeat'])
+                    result.update(route=name, format=em_format, query=query)
+                    results.append(result)
+                    total_bytes += result['bytes']
+                    for level in levels:
+                        totals[level][0] += result['levels'][level]['bytes']
+                        totals[level][1] += result['levels'][level]['ms']
+                    if verbosity > 0:
+                        print "%-20s  %-4s  %-10s  %9d" % (name, em_format, query[:10],
+                                                           result['bytes']) + \
+                              ''.join("  %9d  %7.2f" % (result['levels'][l]['bytes'],
+                                                        result['levels'][l]['ms'])
+                                      for l in levels) + \
+                              "  %8.3f" % result['cached_ms']
+        if verbosity > 0:
+            print "%-38s  %9d" % ('total', total_bytes) + \
+                  ''.join("  %9d  %7.2f" % tuple(totals[l]) for l in levels)
+
+        if options['output']:
+            report = {
+                'when': datetime.datetime.now().isoformat(),
+                'database': connection.__module__,
+                'project': project.slug,
+                'repeat': options['repeat'],
+                'results': results,
+            }
+            fp = open(options['output'], 'w')
+            try:
+                simplejson.dump(report, fp, indent=2, sort_keys=True)
+            finally:
+                fp.close()
+
+    def fetch(self, name, em_format, query, args):
+        """The uncompressed body of one response from a route, or None if it's empty."""
+        response_cache.clear()
+        path = urlresolvers.reverse(name, args=args)
+        em_format_query = em_format != 'text' and 'format=%s' % em_format or ''
+        path += '?' + '&'.join(q for q in (em_format_query, query) if q)
+        response = Client().get(path)
+        return response.content or None
+
+    def measure(self, content, levels, repeat):
+        """
+        Bytes and milliseconds to compress `content` at each of `levels`,
+        and the milliseconds to serve it from a precompressed cache entry.
+        """
+        old_level = getattr(settings, 'DEVMASON_COMPRESS_LEVEL', None)
+        result = {'bytes': len(content), 'levels': {}}
+        try:
+            for level in levels:
+                settings.DEVMASON_COMPRESS_LEVEL = level
+                start = time.time()
+                for i in range(repeat):
+                    deflated = compression.deflate(content)
+                elapsed = (time.time() - start) / repeat
+                result['levels'][level] = {
+                    'bytes': len(compression.encode(deflated, 'gzip')),
+                    'ms': elapsed * 1000,
+                }
+        finally:
+            if old_level is None:
+                del settings.DEVMASON_COMPRESS_LEVEL
+            else:
+                settings.DEVMASON_COMPRESS_LEVEL = old_level
+        start = time.time()
+        for i in range(repeat):
+            compression.encode(deflated, 'gzip')
+        result['cached_ms'] = (time.time() - start) / repeat * 1000
+        return result
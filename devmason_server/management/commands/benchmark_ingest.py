@@ -0,0 +1,83 @@
+import time
+import datetime
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from devmason_server.bulk import bulk_insert, bulk_tag
+from devmason_server.ingest import build_from_data, step_from_data
+from devmason_server.models import Project, BuildStep
+
+def make_payload(steps):
+    now = datetime.datetime.now().strftime('%a, %d %b %Y %H:%M:%S')
+    return {
+        'success': True,
+        'started': now,
+        'finished': now,
+        'tags': ['python2.6', 'linux', 'postgres'],
+        'client': {'host': 'bench.example.com', 'arch': 'linux-x86_64'},
+        'results': [{
+            'success': True,
+            'started': now,
+            'finished': now,
+            'name': 'test_%s' % i,
+            'output': 'ok\n' * 20,
+            'errout': '',
+        } for i in range(steps)],
+    }
+
+def ingest_per_row(project, data):
+    """The pre-batching ingestion path: one INSERT per step and tag."""
+    build = build_from_data(data)
+    build.project = project
+    build.save()
+    build.tags = ",".join(data['tags'])
+    for result in data['results']:
+        step = step_from_data(result)
+        step.build = build
+        step.save()
+
+def ingest_batched(project, data):
+    build = build_from_data(data)
+    steps = [step_from_data(result) for result in data['results']]
+    build.project = project
+    build.save()
+    bulk_tag(build, ",".join(data['tags']))
+    for step in steps:
+        step.build = build
+    bulk_insert(BuildStep, steps)
+
+class Command(NoArgsCommand):
+    help = "Compare per-row and batched build ingestion. Nothing is committed."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', default='10,100,1000',
+                    help='Comma-separated step counts to benchmark.'),
+        make_option('--repeat', type='int', default=5,
+                    help='Number of builds to ingest per measurement.'),
+    )
+
+    def handle_noargs(self, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        repeat = options['repeat']
+
+        # Query counting needs the debug cursor.
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            project = Project.objects.create(name='Ingest benchmark', slug='ingest-benchmark')
+            print "%6s  %-8s  %10s  %8s" % ('steps', 'path', 'ms/build', 'queries')
+            for size in sizes:
+                data = make_payload(size)
+                for label, ingest in (('per-row', ingest_per_row), ('batched', ingest_batched)):
+                    connection.queries = []
+                    start = time.time()
+                    for i in range(repeat):
+                        ingest(project, data)
+                    elapsed = (time.time() - start) / repeat
+                    print "%6s  %-8s  %10.1f  %8s" % (size, label, elapsed * 1000,
+                                                      len(connection.queries) // repeat)
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            settings.DEBUG = old_debug
@@ -0,0 +1,60 @@
+import time
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db.models.signals import post_init
+from django.utils import simplejson
+from devmason_server.models import BuildStep
+
+def make_rows(count):
+    """Rows as the database would hand them to the ORM."""
+    now = datetime.datetime.now()
+    extra = simplejson.dumps({'duration': 1.5, 'command': 'python setup.py test',
+                              'env': {'PYTHON': '2.6', 'DB': 'postgres'}})
+    values = {'build_id': 1, 'success': True, 'started': now, 'finished': now,
+              'name': 'test', 'output': 'ok', 'errout': '', 'extra_info': extra}
+    return [[i if f.attname == 'id' else values.get(f.attname)
+             for f in BuildStep._meta.fields] for i in range(count)]
+
+def decode_eagerly(sender, instance, **kwargs):
+    # What the field used to do in its post_init handler.
+    instance.extra_info
+
+class Command(NoArgsCommand):
+    help = "Compare eager and lazy decoding of BuildStep.extra_info."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rows', type='int', default=10000,
+                    help='Number of BuildStep rows to instantiate.'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of runs to take the best of.'),
+    )
+
+    def handle_noargs(self, **options):
+        rows = make_rows(options['rows'])
+
+        def instantiate():
+            return [BuildStep(*row) for row in rows]
+
+        def instantiate_and_read():
+            for step in instantiate():
+                step.extra_info
+
+        def instantiate_eagerly():
+            post_init.connect(decode_eagerly, sender=BuildStep)
+            try:
+                instantiate()
+            finally:
+                post_init.disconnect(decode_eagerly, sender=BuildStep)
+
+        print "%-22s  %10s" % ('%s rows' % len(rows), 'ms')
+        for label, run in (('eager (post_init)', instantiate_eagerly),
+                           ('lazy, never read', instantiate),
+                           ('lazy, all read', instantiate_and_read)):
+            best = None
+            for i in range(options['repeat']):
+                start = time.time()
+                run()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print "%-22s  %10.1f" % (label, best * 1000)
@@ -0,0 +1,189 @@
+import time
+import random
+import datetime
+from optparse import make_option
+from django.contrib.contenttypes.models import ContentType
+from django.core import urlresolvers
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.client import Client
+from django.utils import simplejson
+from tagging.models import TaggedItem
+from devmason_server.models import Project, Build, BuildStep
+from devmason_server.responsecache import response_cache
+from devmason_server.stats import Histogram, QueryCounter
+
+# Just enough of each build to list them; see `utils.requested_fields`.
+SPARSE = 'fields=success,finished,links'
+
+# URL name -> (formats, query strings) for each GET route that's benchmarked.
+ROUTES = {
+    'project_list': (('html', 'json'), ('', SPARSE)),
+    'project_detail': (('html', 'json'), ('',)),
+    'project_build_list': (('html', 'json'), ('', 'page=last', 'after=', SPARSE)),
+    'build_detail': (('html', 'json'), ('', 'summary=1')),
+    'step_log': (('text',), ('', 'tail=200')),
+    'latest_build': (('json',), ('',)),
+    'queued_build': (('json',), ('',)),
+    'project_stats': (('html', 'json'), ('', 'period=week')),
+    'project_tag_list': (('html', 'json'), ('',)),
+    'tag_detail': (('html', 'json'), ('', 'after=', SPARSE)),
+    'latest_tagged_build': (('json',), ('',)),
+    'project_add': (('html',), ('',)),
+    'xmlrpc': (('html',), ('',)),
+}
+
+# URL names that aren't, and why.
+SKIPPED = {
+    'claim_project': 'changes the project',
+    'view_stats': 'staff only',
+    'github_build': 'POST only',
+    'bitbucket_build': 'POST only',
+    'request_build': 'POST only',
+    'lease_build_requests': 'POST only',
+    'complete_build_request': 'POST only',
+    'build_progress': 'only there while a build is running',
+}
+
+def check_routes():
+    """Complain about URLs that are neither benchmarked nor skipped."""
+    names = set(p.name for p in urlresolvers.get_resolver('devmason_server.urls').url_patterns)
+    missing = names - set(ROUTES) - set(SKIPPED)
+    if missing:
+        raise CommandError("Don't know how to benchmark %s" % ', '.join(sorted(missing)))
+
+class Command(NoArgsCommand):
+    help = ("Time every GET route, in HTML and JSON, against the data in the "
+            "database (see generate_builds), and report latency percentiles "
+            "queries and bytes per request.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', type='int', default=50,
+                    help='Number of requests per route and format.'),
+        make_option('--project', default=None,
+                    help='Slug of the project to read; the one with the most builds by default.'),
+        make_option('--warm-cache', action='store_true', default=False,
+                    help='Leave the response cache on between requests.'),
+        make_option('--output', default=None,
+                    help='File to write the results to, as JSON.'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed for choosing builds and tags.'),
+    )
+
+    def handle_noargs(self, **options):
+        check_routes()
+        verbosity = int(options.get('verbosity', 1))
+        self.random = random.Random(options['seed'])
+        project = self.choose_project(options['project'])
+        build_ids = list(project.builds.filter(in_progress=False).values_list('pk', flat=True))
+        tags = self.popular_tags(build_ids)
+        self.steps = list(BuildStep.objects.filter(build__project=project).order_by('-pk')
+                          .values_list('build', 'pk')[:1000])
+        num_pages = (len(build_ids) + 24) // 25
+
+        results = []
+        if verbosity > 0:
+            print "%-20s  %-4s  %-10s  %8s  %8s  %8s  %8s  %8s" % (
+                'route', 'fmt', 'query', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'bytes')
+        for name in sorted(ROUTES):
+            formats, queries = ROUTES[name]
+            for em_format in formats:
+                for query in queries:
+                    query = query.replace('page=last', 'page=%d' % num_pages)
+                    result = self.run(name, em_format, query, options['requests'],
+                                      options['warm_cache'],
+                                      lambda: self.url_args(name, project, build_ids, tags))
+                    results.append(result)
+                    if verbosity > 0:
+                        print "%-20s  %-4s  %-10s  %8.1f  %8.1f  %8.1f  %8.1f  %8.0f" % (
+                            name, em_format, query[:10], result['latency_ms']['p50'],
+                            result['latency_ms']['p95'], result['latency_ms']['p99'],
+                            result['queries']['mean'], result['bytes']['mean'])
+
+        if options['output']:
+            report = {
+                'when': datetime.datetime.now().isoformat(),
+                'database': connection.__module__,
+                'project': project.slug,
+                'builds': len(build_ids),
+                'requests': options['requests'],
+                'warm_cache': options['warm_cache'],
+                'results': results,
+            }
+            fp = open(options['output'], 'w')
+            try:
+                simplejson.dump(report, fp, indent=2, sort_keys=True)
+            finally:
+                fp.close()
+
+    def choose_project(self, slug):
+        if slug:
+            try:
+                return Project.objects.get(slug=slug)
+            except Project.DoesNotExist:
+                raise CommandError("No project %r" % slug)
+        projects = Project.objects.annotate(count=Count('builds')).order_by('-count')
+        if not projects or not projects[0].count:
+            raise CommandError("No builds to benchmark against; try generate_builds.")
+        return projects[0]
+
+    def popular_tags(self, build_ids):
+        """The project's tags, most used first."""
+        ctype = ContentType.objects.get_for_model(Build)
+        items = TaggedItem.objects.filter(content_type=ctype, object_id__in=build_ids[-1000:]) \
+                                  .values('tag__name').annotate(count=Count('pk'))
+        return [i['tag__name'] for i in sorted(items, key=lambda i: -i['count'])]
+
+    def url_args(self, name, project, build_ids, tags):
+        """Arguments for a request to `name`, chosen afresh for each request."""
+        if name in ('project_list', 'project_add', 'xmlrpc'):
+            return []
+        if name == 'build_detail':
+            return [project.slug, self.random.choice(build_ids)]
+        if name == 'step_log':
+            build_id, step_id = self.random.choice(self.steps)
+            return [project.slug, build_id, step_id, 'output']
+        if name == 'queued_build':
+            return [project.slug, '0-unknown']
+        if name in ('tag_detail', 'latest_tagged_build'):
+            # Mostly one tag, sometimes two together.
+            if len(tags) > 1 and self.random.random() < 0.3:
+                return [project.slug, ';'.join(self.random.sample(tags[:5], 2))]
+            return [project.slug, self.random.choice(tags[:5])]
+        return [project.slug]
+
+    def run(self, name, em_format, query, count, warm_cache, make_args):
+        client = Client()
+        latency = Histogram(count)
+        queries = Histogram(count)
+        size = Histogram(count)
+        statuses = {}
+        for i in range(count):
+            path = urlresolvers.reverse(name, args=make_args())
+            # Step logs are always plain text.
+            em_format_query = em_format != 'text' and 'format=%s' % em_format or ''
+            path += '?' + '&'.join(q for q in (em_format_query, query) if q)
+            if not warm_cache:
+                response_cache.clear()
+            counter = QueryCounter()
+            counter.start()
+            start = time.time()
+            try:
+                response = client.get(path)
+            finally:
+                elapsed = time.time() - start
+                counter.stop()
+            latency.add(elapsed * 1000)
+            queries.add(counter.queries)
+            size.add(len(response.content))
+            status = str(response.status_code)
+            statuses[status] = statuses.get(status, 0) + 1
+        return {
+            'route': name,
+            'format': em_format,
+            'query': query,
+            'statuses': statuses,
+            'latency_ms': latency.summary(),
+            'queries': queries.summary(),
+            'bytes': size.summary(),
+        }
@@ -0,0 +1,19 @@
+from django.core.management.base import NoArgsCommand
+from devmason_server.models import BuildRequest, Metric
+
+class Command(NoArgsCommand):
+    help = "Report on build requests, and how many builds coalescing has saved."
+
+    def handle_noargs(self, **options):
+        created = Metric.get('build_requests.created')
+        duplicate = Metric.get('build_requests.duplicate')
+        superseded = Metric.get('build_requests.superseded')
+        saved = duplicate + superseded
+
+        print "Build requests received:  %s" % (created + duplicate)
+        print "  duplicates ignored:     %s" % duplicate
+        print "  superseded by newer:    %s" % superseded
+        print "Waiting to be built:      %s" % BuildRequest.objects.filter(
+            available_at__isnull=False, completed__isnull=True).count()
+        print "Builds saved:             %s (%.1f%%)" % (
+            saved, created + duplicate and 100.0 * saved / (created + duplicate) or 0)
@@ -0,0 +1,96 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Max, Q
+from devmason_server import logstore
+from devmason_server.models import BuildLog, BuildStep
+
+def filesizeformat(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return unit == 'bytes' and '%d bytes' % size or '%.1f %s' % (size, unit)
+
+class Command(NoArgsCommand):
+    help = ("Move step output stored in the database into compressed, "
+            "deduplicated log storage, and compress and index any logs "
+            "stored uncompressed or without a line index.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=200,
+                    help='Number of build steps to move per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.before = self.after = 0
+
+        self.compress_logs()
+        moved = self.move_steps(options['batch_size'])
+
+        if self.verbosity > 0:
+            saved = self.before - self.after
+            print "Moved output of %s build steps into log storage." % moved
+            print "%s before, %s after: saved %s (%.1f%%)." % (
+                filesizeformat(self.before), filesizeformat(self.after),
+                filesizeformat(saved), self.before and 100.0 * saved / self.before or 0)
+
+    @transaction.commit_on_success
+    def compress_logs(self):
+        """
+        Compress logs that were stored before compression existed, and
+        rewrite those stored before line indexes existed with one.
+        """
+        codec = logstore.default_codec()
+        logs = BuildLog.objects.filter(Q(codec='') | Q(line_index='') | Q(line_index='{}'))
+        for log in logs:
+            spool = logstore.LogSpool(codec)
+            try:
+                for data in logstore.iter_content(log):
+                    spool.write(data.decode('utf-8'))
+                spool.store(log.name)
+                self.before += log.codec and log.stored_size or log.size
+                log.codec, log.stored_size = codec, spool.stored_size
+                log.line_index = spool.line_index
+                self.after += log.stored_size
+                log.save()
+            finally:
+                spool.discard()
+
+    def move_steps(self, batch_size):
+        limit = logstore.inline_limit()
+        moved = 0
+        last_pk = 0
+        while True:
+            # Walk the table in primary key order, a batch at a time, so we
+            # never hold more than a batch's worth of output in memory.
+            steps = list(BuildStep.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not steps:
+                return moved
+            last_pk = steps[-1].pk
+            moved += self.move_batch(steps, limit)
+
+    @transaction.commit_on_success
+    def move_batch(self, steps, limit):
+        pending = []
+        for step in steps:
+            for attr in ('output', 'errout'):
+                text = getattr(step, attr)
+                if getattr(step, attr + '_log_id') is None and text and \
+                   len(text.encode('utf-8')) > limit:
+                    pending.append((step, attr, text))
+        if not pending:
+            return 0
+
+        # Only logs created by this batch cost any space; output that was
+        # already stored is shared.
+        newest = BuildLog.objects.aggregate(newest=Max('pk'))['newest'] or 0
+        logs = logstore.store_logs([text for step, attr, text in pending])
+        counted = set()
+        for (step, attr, text), log in zip(pending, logs):
+            self.before += len(text.encode('utf-8'))
+            if log.pk > newest and log.pk not in counted:
+                counted.add(log.pk)
+                self.after += log.stored_size
+            BuildStep.objects.filter(pk=step.pk).update(**{attr: '', attr + '_log': log})
+        return len(set(step.pk for step, attr, text in pending))
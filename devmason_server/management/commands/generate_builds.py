@@ -0,0 +1,122 @@
+import math
+import random
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from devmason_server.ingest import save_build
+from devmason_server.models import Project, Build, BuildStep
+
+TAGS = ['python2.4', 'python2.5', 'python2.6', 'python2.7', 'linux', 'darwin',
+        'freebsd', 'win32', 'x86_64', 'i386', 'postgres', 'mysql', 'sqlite',
+        'django1.0', 'django1.1', 'django1.2', 'trunk', 'release', 'nightly', 'slow']
+
+HOSTS = ['buildbot%d.example.com' % i for i in range(1, 9)]
+ARCHES = ['linux-x86_64', 'linux-i386', 'macosx-10.6-universal', 'win32']
+
+class Generator(object):
+    """Makes up builds that look like the real thing, from a seeded random."""
+
+    def __init__(self, steps, log_size, tags, seed):
+        self.random = random.Random(seed)
+        self.steps = steps
+        self.log_size = log_size
+        self.tags = TAGS[:tags] + ['tag%d' % i for i in range(len(TAGS), tags)]
+        # Zipf-ish: a few tags are on most builds, most tags on only a few.
+        self.tag_weights = [1.0 / (rank + 1) for rank in range(len(self.tags))]
+
+    def pick_tags(self):
+        count = min(len(self.tags), self.random.randint(1, 4))
+        tags = set()
+        while len(tags) < count:
+            point = self.random.random() * sum(self.tag_weights)
+            for tag, weight in zip(self.tags, self.tag_weights):
+                point -= weight
+                if point <= 0:
+                    break
+            tags.add(tag)
+        return sorted(tags)
+
+    def output(self, name, success):
+        """Step output of roughly log-normally distributed size."""
+        size = int(self.random.lognormvariate(math.log(self.log_size), 1.0))
+        size = min(size, 100 * self.log_size)
+        lines = []
+        written = 0
+        while written < size:
+            line = '%s.test_%06d (%s.tests.Tests) ... ok' % (
+                name, self.random.randint(0, 999999), name)
+            lines.append(line)
+            written += len(line) + 1
+        if not success:
+            lines.append('FAILED (failures=%d)' % self.random.randint(1, 5))
+        return '\n'.join(lines)
+
+    def build(self, finished):
+        success = self.random.random() < 0.8
+        started = finished - datetime.timedelta(minutes=self.steps)
+        build = Build(
+            success = success,
+            started = started,
+            finished = finished,
+            host = self.random.choice(HOSTS),
+            arch = self.random.choice(ARCHES),
+            extra_info = {'generated': True},
+        )
+        steps = []
+        for i in range(self.steps):
+            step_success = success or i < self.steps - 1
+            name = 'step%d' % i
+            steps.append(BuildStep(
+                success = step_success,
+                started = started + datetime.timedelta(minutes=i),
+                finished = started + datetime.timedelta(minutes=i + 1),
+                name = name,
+                output = self.output(name, step_success),
+                errout = not step_success and 'Traceback (most recent call last):\n  ...\n' or '',
+                extra_info = {'command': 'python setup.py %s' % name},
+            ))
+        return build, steps, self.pick_tags()
+
+class Command(NoArgsCommand):
+    help = ("Fill the database with made-up projects and builds, for benchmarking "
+            "against. Builds go through the same path as uploaded ones.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--projects', type='int', default=10,
+                    help='Number of projects to create.'),
+        make_option('--builds', type='int', default=100,
+                    help='Number of builds per project.'),
+        make_option('--steps', type='int', default=5,
+                    help='Number of steps per build.'),
+        make_option('--log-size', type='int', default=2048,
+                    help='Median size of a step\'s output, in bytes.'),
+        make_option('--tags', type='int', default=len(TAGS),
+                    help='Number of different tags to use.'),
+        make_option('--prefix', default='generated',
+                    help='Slug prefix for the projects created.'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed, so runs can be repeated exactly.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        generator = Generator(options['steps'], options['log_size'],
+                              options['tags'], options['seed'])
+        now = datetime.datetime.now().replace(microsecond=0)
+
+        for p in range(options['projects']):
+            slug = '%s-%d' % (options['prefix'], p)
+            project = self.make_project(slug, generator, options['builds'], now)
+            if verbosity > 0:
+                print "Created %s builds for %s." % (options['builds'], project.slug)
+
+    @transaction.commit_on_success
+    def make_project(self, slug, generator, builds, now):
+        project, created = Project.objects.get_or_create(slug=slug, defaults={'name': slug})
+        for i in range(builds):
+            # Oldest first, an hour or so apart, as a build server would see them.
+            finished = now - datetime.timedelta(hours=builds - i,
+                                                minutes=generator.random.randint(0, 59))
+            build, steps, tags = generator.build(finished)
+            save_build(project, build, steps, tags)
+        return project
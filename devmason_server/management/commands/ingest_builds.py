@@ -0,0 +1,136 @@
+import os
+import time
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection, transaction
+from devmason_server.buildqueue import BuildQueue
+from devmason_server.ingest import parse_build, save_build
+from devmason_server.models import Project, Build
+from devmason_server.responsecache import response_cache
+
+def ingest(entry_id, entry):
+    """Save one queued build, returning the new Build."""
+    project = Project.objects.get(slug=entry['project'])
+    user = entry['user'] and User.objects.get(pk=entry['user']) or None
+    build, steps = parse_build(entry['build'])
+    # Output that a streamed upload already put in log storage.
+    for index, attr, log_id in entry.get('logs', ()):
+        setattr(steps[index], attr + '_log_id', log_id)
+    # Marks the build as this entry's, so it's never ingested twice.
+    build.queue_id = entry_id
+    return save_build(project, build, steps, entry['build'].get('tags'), user)
+
+class Command(NoArgsCommand):
+    help = "Ingest builds queued by asynchronous build uploads."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=1,
+                    help='Number of worker processes to run.'),
+        make_option('--batch-size', type='int', default=50,
+                    help='Number of builds to ingest per transaction.'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds to wait before checking an empty queue again.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty.'),
+        make_option('--claim-timeout', type='int', default=600,
+                    help='Seconds after which builds claimed by a dead worker are requeued.'),
+        make_option('--recover-interval', type='int', default=60,
+                    help='Seconds between checks for builds claimed by a dead worker.'),
+        make_option('--keep-status', type='int', default=24 * 60 * 60,
+                    help='Seconds to keep the status of ingested builds for.'),
+    )
+
+    def handle_noargs(self, **options):
+        # Workers invalidate cached responses through the shared backend;
+        # a single process's own cache would never hear of their builds.
+        if response_cache.single_process and not response_cache.shared:
+            raise CommandError("DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS can't be used "
+                               "with ingest_builds; set DEVMASON_RESPONSE_CACHE_BACKEND.")
+        self.verbosity = int(options.get('verbosity', 1))
+        self.queue = BuildQueue()
+        self.queue.recover(options['claim_timeout'])
+        self.queue.prune(options['keep_status'])
+
+        if options['workers'] <= 1:
+            self.work(options)
+            return
+
+        # Children mustn't share the parent's database connection.
+        connection.close()
+        children = []
+        for i in range(options['workers']):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.work(options)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+    def work(self, options):
+        recovered = time.time()
+        while True:
+            # Other workers can die while this one carries on.
+            if time.time() - recovered >= options['recover_interval']:
+                self.queue.recover(options['claim_timeout'])
+                recovered = time.time()
+            entries = self.queue.claim(options['batch_size'])
+            if entries:
+                self.ingest_batch(entries)
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['interval'])
+
+    def ingest_batch(self, entries):
+        """
+        Ingest a batch of builds in one transaction. If any of them fails,
+        fall back on one transaction per build so the rest still go in.
+        """
+        # Entries whose builds were committed, but which weren't marked
+        # done before a worker died, are only marked done now.
+        ingested = dict((build.queue_id, build) for build in
+                        Build.objects.filter(queue_id__in=[entry_id for entry_id, entry in entries]))
+        for entry_id, build in ingested.items():
+            self.queue.complete(entry_id, build)
+        entries = [(entry_id, entry) for entry_id, entry in entries if entry_id not in ingested]
+        if not entries:
+            return
+
+        try:
+            builds = self.save_all(entries)
+        except Exception:
+            for entry_id, entry in entries:
+                self.ingest_one(entry_id, entry)
+        else:
+            self.invalidate(entry for entry_id, entry in entries)
+            for (entry_id, entry), build in zip(entries, builds):
+                self.queue.complete(entry_id, build)
+            if self.verbosity > 0:
+                print "Ingested %s builds." % len(builds)
+
+    @transaction.commit_on_success
+    def save_all(self, entries):
+        return [ingest(entry_id, entry) for entry_id, entry in entries]
+
+    def ingest_one(self, entry_id, entry):
+        try:
+            build = transaction.commit_on_success(ingest)(entry_id, entry)
+        except Exception, ex:
+            self.queue.fail(entry_id, '%s: %s' % (ex.__class__.__name__, ex))
+            if self.verbosity > 0:
+                print "Couldn't ingest build %s: %s" % (entry_id, ex)
+        else:
+            self.invalidate([entry])
+            self.queue.complete(entry_id, build)
+
+    def invalidate(self, entries):
+        """
+        Drop cached responses for the projects of newly committed builds.
+        The signals fired mid-transaction, so a reader could have cached
+        what it saw before the commit.
+        """
+        for slug in set(entry['project'] for entry in entries):
+            response_cache.invalidate(slug)
@@ -0,0 +1,55 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from devmason_server.bulk import bulk_insert
+from devmason_server.models import Build, BuildRollup, Project
+from devmason_server.responsecache import response_cache
+from devmason_server.rollups import rollup_keys, seconds
+
+class Command(NoArgsCommand):
+    help = ("Recount every project's build statistics from scratch, for builds "
+            "posted before statistics were kept or if they've got out of step.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of builds to read at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        totals = {}
+        last_pk = 0
+        counted = 0
+        while True:
+            # Only the totals are kept in memory, never more than a batch of builds.
+            builds = list(Build.objects.filter(pk__gt=last_pk, in_progress=False).order_by('pk')
+                          .only('project', 'success', 'started', 'finished', 'host', 'arch')
+                          [:options['batch_size']])
+            if not builds:
+                break
+            last_pk = builds[-1].pk
+            counted += len(builds)
+            for build in builds:
+                duration = max(0, seconds(build.finished - build.started))
+                for key in rollup_keys(build):
+                    key = tuple(sorted(key.items()))
+                    total = totals.setdefault(key, [0, 0, 0.0])
+                    total[0] += 1
+                    total[1] += build.success and 1 or 0
+                    total[2] += duration
+        self.replace(totals)
+        # The rollups are written in bulk, without the signals that would
+        # usually drop cached responses.
+        for slug in Project.objects.values_list('slug', flat=True):
+            response_cache.invalidate(slug)
+        if verbosity > 0:
+            print "Counted %s builds into %s rollups." % (counted, len(totals))
+
+    @transaction.commit_on_success
+    def replace(self, totals):
+        BuildRollup.objects.all().delete()
+        rollups = []
+        for key, (builds, successes, duration) in totals.items():
+            key = dict(key)
+            rollups.append(BuildRollup(project_id=key.pop('project'), builds=builds,
+                                       successes=successes, duration=duration, **key))
+        bulk_insert(BuildRollup, rollups)
@@ -0,0 +1,58 @@
+from optparse import make_option
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from tagging.models import TaggedItem
+from devmason_server.bulk import bulk_insert
+from devmason_server.models import Build, BuildTag, TagUsage
+
+class Command(NoArgsCommand):
+    help = ("Rebuild the index of builds by tag, and each project's tag counts, "
+            "from django-tagging's tags, for databases with builds tagged "
+            "before the index existed.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help='Number of builds to index per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        self.ctype = ContentType.objects.get_for_model(Build)
+        indexed = 0
+        last_pk = 0
+        while True:
+            builds = list(Build.objects.filter(pk__gt=last_pk, in_progress=False).order_by('pk')
+                          .values_list('pk', 'project', 'finished')[:options['batch_size']])
+            if not builds:
+                break
+            last_pk = builds[-1][0]
+            indexed += self.index_batch(builds)
+        counted = self.count_usage()
+        if verbosity > 0:
+            print "Indexed %s tags on builds." % indexed
+            print "Counted %s tags in use across projects." % counted
+
+    @transaction.commit_on_success
+    def index_batch(self, builds):
+        by_pk = dict((pk, (project_id, finished)) for pk, project_id, finished in builds)
+        BuildTag.objects.filter(build__in=by_pk.keys()).delete()
+        items = TaggedItem.objects.filter(content_type=self.ctype, object_id__in=by_pk.keys()) \
+                                  .values_list('object_id', 'tag')
+        entries = []
+        for build_id, tag_id in set(items):
+            project_id, finished = by_pk[build_id]
+            entries.append(BuildTag(project_id=project_id, tag_id=tag_id,
+                                    build_id=build_id, finished=finished))
+        bulk_insert(BuildTag, entries)
+        return len(entries)
+
+    @transaction.commit_on_success
+    def count_usage(self):
+        TagUsage.objects.all().delete()
+        usage = BuildTag.objects.values('project', 'tag') \
+                                .annotate(builds=Count('pk'), last_used=Max('finished'))
+        bulk_insert(TagUsage, [TagUsage(project_id=u['project'], tag_id=u['tag'],
+                                        builds=u['builds'], last_used=u['last_used'])
+                               for u in usage])
+        return len(usage)
@@ -1,13 +1,26 @@
+import uuid
+import datetime
 import tagging
+from django.conf import settings
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
+from tagging.models import Tag
 from .fields import JSONField
+from . import logstore
 
 class Project(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(unique=True)
     owner = models.ForeignKey(User, related_name='projects', blank=True, null=True)
 
+    # Denormalized pointer to the newest build, kept up to date by build
+    # ingestion so that the project list doesn't have to dig through every
+    # project's build history. See the `backfill_latest_builds` command.
+    # A plain id rather than a ForeignKey: deleting the build would cascade
+    # to the project, and queryset deletes don't give us a chance to stop it.
+    latest_build_id = models.IntegerField(blank=True, null=True, editable=False)
+
     class Meta:
         ordering = ['name']
 
@@ -18,6 +31,12 @@ class Project(models.Model):
     def get_absolute_url(self):
         return ('project_detail', [self.slug])
 
+    @property
+    def latest_build(self):
+        if self.latest_build_id is None:
+            return None
+        return self.builds.get(pk=self.latest_build_id)
+
 class Build(models.Model):
     project = models.ForeignKey(Project, related_name='builds')
     success = models.BooleanField()
@@ -28,6 +47,17 @@ class Build(models.Model):
     user = models.ForeignKey(User, blank=True, null=True, related_name='builds')
     extra_info = JSONField()
 
+    # Set while an incremental build is being reported, until it's finished;
+    # `finished` is just `started` until then. In-progress builds are left
+    # out of build lists, the tag index and statistics. See `ingest.open_build`.
+    in_progress = models.BooleanField(default=False, editable=False)
+
+    # The id of the `buildqueue` entry an asynchronously uploaded build came
+    # from, so that a worker that dies before marking the entry done doesn't
+    # get it ingested twice.
+    queue_id = models.CharField(max_length=40, blank=True, null=True, unique=True,
+                                editable=False)
+
     class Meta:
         ordering = ['-finished']
 
@@ -38,8 +68,116 @@ class Build(models.Model):
     def get_absolute_url(self):
         return ('build_detail', [self.project.slug, self.pk])
 
+    def get_steps(self):
+        """This build's steps, as loaded by `prefetch_builds` if it was."""
+        if hasattr(self, '_prefetched_steps'):
+            return self._prefetched_steps
+        return self.steps.all()
+
+    def get_tags(self):
+        """This build's tags, as loaded by `prefetch_builds` if it was."""
+        if hasattr(self, '_prefetched_tags'):
+            return self._prefetched_tags
+        return self.tags
+
 tagging.register(Build)
 
+class BuildTag(models.Model):
+    """
+    An inverted index from each project's tags to its builds: a row for
+    every tag of every build, with the build's finish time so that a tag's
+    builds can be read newest first straight off the index in
+    sql/buildtag.sql. Kept in step with django-tagging's own table by
+    `devmason_server.tagindex`.
+    """
+    project = models.ForeignKey(Project, related_name='build_tags')
+    tag = models.ForeignKey(Tag, related_name='build_index')
+    build = models.ForeignKey(Build, related_name='tag_index')
+    finished = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('build', 'tag')]
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.build_id, self.tag)
+
+class TagUsage(models.Model):
+    """
+    How many of a project's builds have a tag, and when the latest of them
+    finished. Counted up and down by `devmason_server.tagindex` as builds
+    are indexed and removed, so listing a project's tags needn't count them.
+    """
+    project = models.ForeignKey(Project, related_name='tag_usage')
+    tag = models.ForeignKey(Tag, related_name='usage')
+    builds = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('project', 'tag')]
+
+    def __unicode__(self):
+        return u"%s: %s (%s)" % (self.project, self.tag, self.builds)
+
+ROLLUP_PERIODS = (
+    ('day', 'Day'),
+    ('week', 'Week'),
+)
+
+ROLLUP_DIMENSIONS = (
+    ('all', 'All builds'),
+    ('arch', 'Architecture'),
+    ('host', 'Host'),
+)
+
+class BuildRollup(models.Model):
+    """
+    Running totals for a project's builds that finished in one day or week:
+    all of them, or those on one `arch` or `host`. Each row also covers just
+    one `bucket` of build durations (see `devmason_server.rollups`), so that
+    every total can be kept with atomic increments, and percentiles found
+    from the counts per bucket.
+    """
+    project = models.ForeignKey(Project, related_name='rollups')
+    period = models.CharField(max_length=10, choices=ROLLUP_PERIODS)
+    start = models.DateField()
+    dimension = models.CharField(max_length=10, choices=ROLLUP_DIMENSIONS)
+    value = models.CharField(max_length=250, blank=True)
+    bucket = models.IntegerField()
+    builds = models.PositiveIntegerField(default=0)
+    successes = models.PositiveIntegerField(default=0)
+    duration = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [('project', 'period', 'start', 'dimension', 'value', 'bucket')]
+
+    def __unicode__(self):
+        return u"%s %s of %s, %s %s" % (self.project, self.period, self.start,
+                                        self.dimension, self.value)
+
+class BuildLog(models.Model):
+    """
+    Step output kept, compressed, in log storage rather than in the database.
+    Logs are named by the SHA-1 of their content, so identical output is
+    stored once no matter how many steps produced it.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    size = models.IntegerField()
+    codec = models.CharField(max_length=10, blank=True)
+    stored_size = models.IntegerField(default=0)
+    # Where to start reading to get to a given line or offset; see logstore.
+    line_index = JSONField()
+
+    def __unicode__(self):
+        return self.digest
+
+    @property
+    def name(self):
+        return logstore.log_name(self.digest)
+
+    def read(self):
+        """The whole log, decompressed and decoded."""
+        return ''.join(logstore.iter_content(self)).decode('utf-8')
+
 class BuildStep(models.Model):
     build = models.ForeignKey(Build, related_name='steps')
     success = models.BooleanField()
@@ -50,12 +188,65 @@ class BuildStep(models.Model):
     errout = models.TextField(blank=True)
     extra_info = JSONField()
 
+    # Output too big to keep in the database lives in log storage instead;
+    # use get_output()/get_errout() to read it from wherever it is.
+    output_log = models.ForeignKey(BuildLog, blank=True, null=True, related_name='output_steps')
+    errout_log = models.ForeignKey(BuildLog, blank=True, null=True, related_name='errout_steps')
+
+    # Set for a step of an incremental build that's still running. Its output
+    # so far is in a `logstore.RunningLog` rather than either of the above.
+    in_progress = models.BooleanField(default=False, editable=False)
+
     class Meta:
-        ordering = ['build', 'started']
+        # Not by build first: that would join in the build table to sort by
+        # its ordering. Steps are almost always read a build's worth at a time.
+        ordering = ['started', 'id']
 
     def __unicode__(self):
         return "%s: %s" % (self.build, self.name)
 
+    def running_log(self, attr):
+        """Where 'output' or 'errout' of a step in progress is kept."""
+        return logstore.RunningLog(self.pk, attr)
+
+    def get_output(self):
+        if self.in_progress:
+            return self.running_log('output').read()
+        if self.output_log_id:
+            return self.output_log.read()
+        return self.output
+
+    def get_errout(self):
+        if self.in_progress:
+            return self.running_log('errout').read()
+        if self.errout_log_id:
+            return self.errout_log.read()
+        return self.errout
+
+    # Sizes in bytes, and URLs to read the output from a piece at a time.
+
+    def get_output_size(self):
+        if self.in_progress:
+            return self.running_log('output').size
+        if self.output_log_id:
+            return self.output_log.size
+        return len(self.output.encode('utf-8'))
+
+    def get_errout_size(self):
+        if self.in_progress:
+            return self.running_log('errout').size
+        if self.errout_log_id:
+            return self.errout_log.size
+        return len(self.errout.encode('utf-8'))
+
+    @models.permalink
+    def get_output_url(self):
+        return ('step_log', [self.build.project.slug, self.build_id, self.pk, 'output'])
+
+    @models.permalink
+    def get_errout_url(self):
+        return ('step_log', [self.build.project.slug, self.build_id, self.pk, 'errout'])
+
 
 VCS_TYPES = (
     ('none', 'None'),
@@ -77,17 +268,191 @@ class Repository(models.Model):
     def __unicode__(self):
         return self.url
 
+class BuildRequestManager(models.Manager):
+
+    def lease(self, arch, worker, count=1, duration=None, project=None):
+        """
+        Lease up to `count` of the longest waiting build requests that can be
+        built on `arch`, for `duration` seconds, on behalf of `worker`.
+        Returns the leased requests; each has a `lease_token` that must be
+        handed back to `complete()`. Requests whose lease has run out without
+        being completed are up for grabs again.
+
+        Leasing is a conditional UPDATE, so concurrent workers never lease the
+        same request; a worker that loses a race just tries the next ones.
+        """
+        if duration is None:
+            duration = getattr(settings, 'DEVMASON_BUILD_LEASE_TIME', 60 * 60)
+        count = min(count, getattr(settings, 'DEVMASON_MAX_LEASE_COUNT', 100))
+        if count < 1:
+            return []
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=duration)
+        token = uuid.uuid4().hex
+
+        pending = self.filter(available_at__lte=now)
+        if project is not None:
+            pending = pending.filter(repository__project=project)
+
+        tried = set()
+        leased = []
+        for attempt in range(3):
+            # One query per arch, rather than arch__in, so each can walk the
+            # (arch, available_at) index in order and stop after a few rows.
+            candidates = []
+            untried = tried and pending.exclude(pk__in=tried) or pending
+            for a in set([arch, '']):
+                candidates.extend(untried.filter(arch=a).order_by('available_at')
+                                         .values_list('available_at', 'pk')[:count * 2])
+            candidates.sort()
+            ids = [pk for available_at, pk in candidates[:count - len(leased)]]
+            if not ids:
+                break
+            tried.update(ids)
+            self.filter(pk__in=ids, available_at__lte=now) \
+                .update(available_at=expires, leased_by=worker, lease_token=token)
+            leased.extend(self.filter(pk__in=ids, lease_token=token).order_by()
+                              .select_related('repository__project'))
+            if len(leased) >= count:
+                break
+        leased.sort(key=lambda r: r.requested)
+        return leased
+
+    def request(self, repository, identifier, branch=''):
+        """
+        Ask for `identifier` of `repository` to be built, returning the
+        (build request, created) pair.
+
+        Asking twice for the same revision -- say, when a hook delivers the
+        same push again -- just returns the original request. A new request
+        for a branch supersedes any for the same branch that are still
+        waiting for a worker, since there's no point building them any more.
+        """
+        build_request, created = self.get_or_create(
+            repository=repository, identifier=identifier,
+            defaults={'branch': branch, 'requested': datetime.datetime.utcnow()},
+        )
+        if not created:
+            Metric.increment('build_requests.duplicate')
+            return build_request, False
+
+        Metric.increment('build_requests.created')
+        if branch:
+            superseded = self.filter(repository=repository, branch=branch,
+                                     available_at__lte=datetime.datetime.now()) \
+                             .exclude(pk=build_request.pk) \
+                             .update(available_at=None, superseded_by=build_request)
+            if superseded:
+                Metric.increment('build_requests.superseded', superseded)
+        return build_request, True
+
+    def complete(self, pk, lease_token):
+        """
+        Mark a leased request built. False if the lease ran out and somebody
+        else has leased the request since.
+        """
+        if not lease_token:
+            return False
+        return bool(self.filter(pk=pk, lease_token=lease_token, completed__isnull=True)
+                        .update(completed=datetime.datetime.now(), available_at=None))
+
+    def complete_leased_by(self, slug, worker):
+        """
+        Mark the requests for the project `slug` that `worker` holds a lease
+        on built, for clients that lease without keeping track of tokens.
+        """
+        now = datetime.datetime.now()
+        return self.filter(repository__project__slug=slug, leased_by=worker,
+                           available_at__gt=now, completed__isnull=True) \
+                   .update(completed=now, available_at=None)
+
 class BuildRequest(models.Model):
     repository = models.ForeignKey(Repository, related_name='build_requests')
     identifier = models.CharField(max_length=200)
+    branch = models.CharField(max_length=200, blank=True)
     requested = models.DateTimeField()
 
+    # Set instead of `available_at` when a newer request for the same branch
+    # came in before this one was built. See `BuildRequestManager.request`.
+    superseded_by = models.ForeignKey('self', blank=True, null=True, editable=False,
+                                      related_name='superseded')
+
+    # Build requests are leased out to build workers. A request can be leased
+    # from `available_at` on: when it was made, or when the last lease on it
+    # runs out. It's NULL once the request has been built. See
+    # sql/buildrequest.sql for the index that keeps leasing cheap.
+    arch = models.CharField(max_length=250, blank=True,
+                            help_text='Leave blank to build on any architecture.')
+    available_at = models.DateTimeField(blank=True, null=True)
+    leased_by = models.CharField(max_length=250, blank=True)
+    lease_token = models.CharField(max_length=32, blank=True)
+    completed = models.DateTimeField(blank=True, null=True)
+
+    objects = BuildRequestManager()
 
     def __unicode__(self):
         return "Build for %s: %s" % (self.repository.project, self.identifier)
 
     class Meta:
         ordering = ['-requested']
+        unique_together = [('repository', 'identifier')]
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and self.available_at is None and self.completed is None:
+            # Not `requested`: that's UTC when it comes from a webhook.
+            self.available_at = datetime.datetime.now()
+        super(BuildRequest, self).save(*args, **kwargs)
+
+class Metric(models.Model):
+    """A named running count of something worth keeping an eye on."""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.name, self.value)
+
+    @classmethod
+    def increment(cls, name, amount=1):
+        metric, created = cls.objects.get_or_create(name=name, defaults={'value': amount})
+        if not created:
+            # Atomic, so concurrent increments aren't lost.
+            cls.objects.filter(pk=metric.pk).update(value=F('value') + amount)
+
+    @classmethod
+    def get(cls, name):
+        try:
+            return cls.objects.get(name=name).value
+        except cls.DoesNotExist:
+            return 0
+
+def repoint_latest_build(sender, instance, **kwargs):
+    """Point a project whose latest build was just deleted at its next newest."""
+    projects = Project.objects.filter(latest_build_id=instance.pk)
+    if not projects.exists():
+        return
+    newest = Build.objects.filter(project=instance.project_id, in_progress=False) \
+                          .order_by('-pk').values_list('pk', flat=True)[:1]
+    projects.update(latest_build_id=newest[0] if newest else None)
 
 #import signals
 #Make sure signals get reg'd
+
+# post_delete rather than an override of Build.delete, so that queryset
+# deletes and the admin's bulk delete keep the pointer right too.
+models.signals.post_delete.connect(repoint_latest_build, sender=Build)
+
+# Keeps cached API responses in step with writes from anywhere, not just the API.
+from .responsecache import connect_signals
+connect_signals()
+
+# Likewise the tag index.
+from . import tagindex
+tagindex.connect_signals()
+
+# And build statistics.
+from . import rollups
+rollups.connect_signals()
+
+# And cached credentials with users' passwords.
+from . import authcache
+authcache.connect_signals()
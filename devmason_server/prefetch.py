@@ -0,0 +1,96 @@
+"""
+Batch loading for lists of builds.
+
+Serializing a build touches its steps, tags, user and project, and the ORM
+fetches each of those lazily -- so a page of builds costs several queries per
+build. `prefetch_builds` loads all of it for a whole list up front, in a
+fixed number of queries, and leaves it where `Build.get_steps()` and
+`Build.get_tags()` will find it.
+
+For long pages, `BuildStream` does the same a batch at a time, so that only
+one batch's steps are ever in memory.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.query import QuerySet
+from tagging.models import TaggedItem
+from .models import Build, BuildStep
+
+# Builds whose steps and tags a `BuildStream` loads at a time.
+STREAM_BATCH_SIZE = 10
+
+def prefetch_builds(builds, steps=True, tags=True):
+    """
+    Load the steps and tags of `builds` -- a list or queryset -- in two
+    queries, returning the builds as a list. Querysets also get their
+    projects and users joined in. Pass `steps` or `tags` as False to skip
+    loading what won't be used.
+    """
+    if isinstance(builds, QuerySet):
+        builds = builds.select_related('project', 'user')
+    builds = list(builds)
+    if not builds:
+        return builds
+
+    by_pk = dict((b.pk, b) for b in builds)
+
+    if steps:
+        for build in builds:
+            build._prefetched_steps = []
+        steps = BuildStep.objects.filter(build__in=by_pk.keys()) \
+                                 .select_related('output_log', 'errout_log') \
+                                 .order_by()
+        for step in steps:
+            # Saves each step a query when it refers back to its build.
+            step._build_cache = by_pk[step.build_id]
+            by_pk[step.build_id]._prefetched_steps.append(step)
+        # Sorted here rather than in the database, which would have to sort
+        # every step of the list in one go.
+        for build in builds:
+            build._prefetched_steps.sort(key=lambda step: (step.started, step.pk))
+
+    if tags:
+        for build in builds:
+            build._prefetched_tags = []
+        ctype = ContentType.objects.get_for_model(Build)
+        items = TaggedItem.objects.filter(content_type=ctype, object_id__in=by_pk.keys()) \
+                                  .select_related('tag')
+        for item in items:
+            by_pk[item.object_id]._prefetched_tags.append(item.tag)
+        for build in builds:
+            build._prefetched_tags.sort(key=lambda tag: tag.name)
+
+    return builds
+
+class BuildStream(object):
+    """
+    The builds in `builds` -- any iterable -- with their steps and tags
+    loaded by `prefetch_builds(batch, **prefetch)` a batch at a time as
+    they're iterated over, and let go of again once the next batch is
+    wanted. The JSON emitter writes these out one build at a time.
+    """
+
+    def __init__(self, builds, batch_size=STREAM_BATCH_SIZE, **prefetch):
+        self.builds = builds
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        batch = []
+        for build in self.builds:
+            batch.append(build)
+            if len(batch) == self.batch_size:
+                for build in self._load(batch):
+                    yield build
+                batch = []
+        for build in self._load(batch):
+            yield build
+
+    def _load(self, batch):
+        prefetch_builds(batch, **self.prefetch)
+        for build in batch:
+            yield build
+        # In case whatever `builds` came from holds on to them.
+        for build in batch:
+            build.__dict__.pop('_prefetched_steps', None)
+            build.__dict__.pop('_prefetched_tags', None)
@@ -0,0 +1,286 @@
+"""
+A cache of rendered API responses.
+
+Most read traffic is for a handful of URLs -- the project list and each
+project's first page of builds -- so `Resource` keeps rendered GET responses
+here. There are two tiers: a bounded, in-process LRU, and optionally a Django
+cache backend shared between processes, named by
+`DEVMASON_RESPONSE_CACHE_BACKEND`. Entries in either tier last at most
+`DEVMASON_RESPONSE_CACHE_TIMEOUT` seconds.
+
+Entries belong to a scope: the project whose slug is in the URL, or the
+global scope for everything else. Each scope has a generation number that's
+part of every key in it, and writing a build, step, project or tag bumps the
+generation of the project's scope and the global scope, so stale entries are
+simply never looked up again. Generations are kept in the shared backend, so
+that a write in one process is seen by all of them. Without one, a process
+can't hear about writes made by any other -- an `ingest_builds` worker, say
+-- so nothing is cached unless `DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS` says
+there is only one process.
+
+Entries are kept deflated as well (see `compression`), so they can be
+handed out gzipped or deflated without compressing them again.
+"""
+
+import time
+import hashlib
+import threading
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import urlencode
+from tagging.models import TaggedItem
+from .compression import compressible, deflate, encode, set_body
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+GLOBAL_SCOPE = ''
+CACHEABLE_STATUS = (200, 301, 302)
+
+# Memcached's longest relative timeout.
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+class LRUCache(object):
+    """
+    A thread-safe dict that forgets the least recently used entries, and
+    entries more than `timeout` seconds old (if `timeout` isn't None).
+    """
+
+    def __init__(self, max_entries, timeout=None):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self.entries[key] = (expires, value)
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        expires = self.timeout is not None and time.time() + self.timeout or None
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_entries:
+                del self.entries[iter(self.entries).next()]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+class ResponseCache(object):
+    """The two cache tiers, and the generation numbers of each scope."""
+
+    def __init__(self, max_entries=500, backend=None, timeout=300):
+        self.local = LRUCache(max_entries, timeout)
+        self.shared = backend and get_cache(backend) or None
+        self.timeout = timeout
+        # Without a shared backend, generations are only known in-process.
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.recording = threading.local()
+
+    @property
+    def enabled(self):
+        """
+        Whether responses are cached at all: only if every process hears
+        about every write.
+        """
+        return bool(self.shared) or self.single_process
+
+    @property
+    def single_process(self):
+        return getattr(settings, 'DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS', False)
+
+    def generation(self, scope):
+        if not self.shared:
+            return self.generations.get(scope, 0)
+        key = self._generation_key(scope)
+        generation = self.shared.get(key)
+        if generation is None:
+            # Start from the clock rather than zero, so that a generation
+            # that was evicted can't come back and match old entries.
+            self.shared.add(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+            generation = self.shared.get(key)
+        return generation
+
+    def invalidate(self, scope):
+        """Forget every entry in `scope`, and in the global scope."""
+        recorded = getattr(self.recording, 'scopes', None)
+        if recorded is not None:
+            recorded.add(scope)
+        for scope in set([scope, GLOBAL_SCOPE]):
+            if self.shared:
+                key = self._generation_key(scope)
+                try:
+                    self.shared.incr(key)
+                except ValueError:
+                    # Not set yet, or evicted: either way a new generation
+                    # from the clock will do.
+                    self.shared.set(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+            self.lock.acquire()
+            try:
+                self.generations[scope] = self.generations.get(scope, 0) + 1
+            finally:
+                self.lock.release()
+
+    def record(self):
+        """Start noting which scopes this thread invalidates, for `replay`."""
+        self.recording.scopes = set()
+
+    def replay(self):
+        """
+        Invalidate the scopes noted since `record` again, and stop noting
+        them. Signals invalidate mid-transaction, so a concurrent reader can
+        cache what it saw before the commit; replaying after the commit
+        drops that too.
+        """
+        scopes = getattr(self.recording, 'scopes', None) or ()
+        self.recording.scopes = None
+        for scope in scopes:
+            self.invalidate(scope)
+
+    def clear(self):
+        self.local.clear()
+        self.generations.clear()
+
+    def _generation_key(self, scope):
+        return 'devmason:generation:%s' % scope
+
+    def make_key(self, request, scope, em_format):
+        """
+        The cache key for a request: its path and query, the output format
+        and who's asking, in the current generation of `scope`.
+        """
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            auth = '%s:%s' % (user.pk, auth)
+        query = urlencode(sorted(request.GET.lists()), doseq=True)
+        key = u'%s|%s?%s|%s|%s' % (self.generation(scope), request.path, query, em_format, auth)
+        return 'devmason:response:%s:%s' % (scope, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key, encoding=None):
+        """
+        A fresh copy of the cached response for `key`, or None. See
+        `respond` for `encoding`.
+        """
+        if not self.enabled:
+            return None
+        entry = self.local.get(key)
+        if entry is None and self.shared:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is None:
+            return None
+        return self.respond(entry, encoding)
+
+    def set(self, key, response):
+        """Cache `response`, returning its entry, or None if it can't be cached."""
+        if not self.enabled:
+            return None
+        # Streamed responses are too big to keep, and reading them uses them up.
+        if response.status_code not in CACHEABLE_STATUS or not response._is_string:
+            return None
+        # Deflated now, once, so it can be sent compressed any number of
+        # times without compressing it again.
+        deflated = None
+        if compressible(response):
+            patch_vary_headers(response, ('Accept-Encoding',))
+            deflated = deflate(response.content)
+        entry = (response.status_code, response.content, response.items(), deflated)
+        self.local.set(key, entry)
+        if self.shared:
+            self.shared.set(key, entry, self.timeout)
+        return entry
+
+    def respond(self, entry, encoding=None):
+        """
+        A response from a cache entry, with its body in `encoding` -- one of
+        `compression.ENCODINGS`, or None for none -- if it was compressible.
+        """
+        status, content, headers = entry[:3]
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        # Entries cached before compression was added have no fourth item.
+        deflated = len(entry) > 3 and entry[3] or None
+        if deflated is not None and encoding is not None:
+            set_body(response, encode(deflated, encoding), encoding)
+        return response
+
+response_cache = ResponseCache(
+    max_entries = getattr(settings, 'DEVMASON_RESPONSE_CACHE_SIZE', 500),
+    backend = getattr(settings, 'DEVMASON_RESPONSE_CACHE_BACKEND', None),
+    timeout = getattr(settings, 'DEVMASON_RESPONSE_CACHE_TIMEOUT', 300),
+)
+
+def _project_slug(project_id):
+    from .models import Project
+    try:
+        return Project.objects.filter(pk=project_id).values_list('slug', flat=True)[0]
+    except IndexError:
+        return GLOBAL_SCOPE
+
+def invalidate_project(sender, instance, **kwargs):
+    response_cache.invalidate(instance.slug)
+
+def invalidate_build(sender, instance, **kwargs):
+    response_cache.invalidate(_project_slug(instance.project_id))
+
+def invalidate_step(sender, instance, **kwargs):
+    from .models import Build
+    try:
+        project_id = Build.objects.filter(pk=instance.build_id) \
+                                  .values_list('project', flat=True)[0]
+    except IndexError:
+        project_id = None
+    response_cache.invalidate(_project_slug(project_id))
+
+def invalidate_tagged_item(sender, instance, **kwargs):
+    from .models import Build
+    if instance.content_type_id != ContentType.objects.get_for_model(Build).pk:
+        return
+    try:
+        project_id = Build.objects.filter(pk=instance.object_id) \
+                                  .values_list('project', flat=True)[0]
+    except IndexError:
+        project_id = None
+    response_cache.invalidate(_project_slug(project_id))
+
+def connect_signals():
+    """Invalidate on writes to any of the models responses are made from."""
+    from .models import Project, Build, BuildStep
+    for signal in (post_save, post_delete):
+        signal.connect(invalidate_project, sender=Project)
+        signal.connect(invalidate_build, sender=Build)
+        signal.connect(invalidate_step, sender=BuildStep)
+        signal.connect(invalidate_tagged_item, sender=TaggedItem)
@@ -0,0 +1,155 @@
+"""
+Pre-aggregated build statistics.
+
+Working out a project's pass rate and build times from its `Build` rows
+means reading every one of them, so `BuildRollup` keeps running totals
+instead: for each day and each week, for all of a project's builds and for
+each `arch` and `host` on their own. `count_build` adds a build to its
+totals as it's saved (see `ingest.save_build`), and builds are counted out
+again when they're deleted.
+
+Percentiles can't be kept as running totals, so each row is further split
+by duration `bucket`. Each bucket is a quarter of a doubling wider than
+the last -- up to a second, up to 1.19 seconds, up to 1.41 and so on -- and
+percentiles are reported as the top of their bucket, so they're at most a
+fifth too high.
+"""
+
+import math
+import datetime
+from django.db.models import F
+from django.db.models.signals import post_delete
+from .bulk import bulk_insert_or_update
+
+# Models are imported where they're used: models.py imports this module to
+# connect its signal handlers.
+
+DIMENSIONS = ('arch', 'host')
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+def seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1000000.0
+
+def duration_bucket(duration):
+    """The bucket for a build that took `duration` seconds."""
+    if duration <= 1:
+        return 0
+    return int(math.ceil(math.log(duration, 2) * 4))
+
+def bucket_limit(bucket):
+    """The longest duration in `bucket`, in seconds."""
+    return 2 ** (bucket / 4.0)
+
+def period_starts(finished):
+    """The (period, start) of each period a build finished at `finished` is in."""
+    day = finished.date()
+    return [('day', day), ('week', day - datetime.timedelta(days=day.weekday()))]
+
+def rollup_keys(build):
+    """The key of every rollup `build` counts towards."""
+    bucket = duration_bucket(max(0, seconds(build.finished - build.started)))
+    groups = [('all', '')] + [(d, getattr(build, d)) for d in DIMENSIONS]
+    return [dict(project=build.project_id, period=period, start=start,
+                 dimension=dimension, value=value, bucket=bucket)
+            for period, start in period_starts(build.finished)
+            for dimension, value in groups]
+
+def count_build(build, sign=1):
+    """Add `build` to its rollups, or take it away again if `sign` is -1."""
+    from .models import BuildRollup
+    duration = max(0, seconds(build.finished - build.started))
+    missing = [key for key in rollup_keys(build)
+               if not add_to_rollup(BuildRollup.objects.filter(**key), build, duration, sign)]
+    if sign > 0:
+        add_rollups(build, missing, duration)
+    else:
+        starts = [start for period, start in period_starts(build.finished)]
+        BuildRollup.objects.filter(project=build.project_id, start__in=starts,
+                                   builds__lte=0).delete()
+
+def add_to_rollup(rollup, build, duration, sign=1):
+    """Add `build` to the `rollup` queryset's row, returning whether there was one."""
+    # Atomic, so concurrent builds aren't miscounted.
+    return rollup.update(builds = F('builds') + sign,
+                         successes = F('successes') + (build.success and sign or 0),
+                         duration = F('duration') + sign * duration)
+
+def add_rollups(build, keys, duration):
+    """
+    Make the rollups at `keys` with `build` as their first build. Any that a
+    concurrent build has made since are added to instead.
+    """
+    from .models import BuildRollup
+    def add_to_existing(rollup):
+        add_to_rollup(BuildRollup.objects.filter(
+            project=rollup.project_id, period=rollup.period, start=rollup.start,
+            dimension=rollup.dimension, value=rollup.value, bucket=rollup.bucket),
+            build, duration)
+    bulk_insert_or_update(BuildRollup, [
+        BuildRollup(project_id=key['project'], period=key['period'], start=key['start'],
+                    dimension=key['dimension'], value=key['value'], bucket=key['bucket'],
+                    builds=1, successes=build.success and 1 or 0, duration=duration)
+        for key in keys
+    ], add_to_existing)
+
+def summarize(rollups):
+    """Pass rate and build durations, from the rows of one set of rollups."""
+    builds = sum(r.builds for r in rollups)
+    successes = sum(r.successes for r in rollups)
+    summary = {
+        'builds': builds,
+        'successes': successes,
+        'pass_rate': None,
+        'duration': {'mean': None},
+    }
+    if builds:
+        summary['pass_rate'] = float(successes) / builds
+        summary['duration']['mean'] = sum(r.duration for r in rollups) / builds
+    # Walk up through the buckets until each percentile's share of builds
+    # has been passed.
+    percentiles = list(PERCENTILES)
+    seen = 0
+    for rollup in sorted(rollups, key=lambda r: r.bucket):
+        seen += rollup.builds
+        while percentiles and seen >= percentiles[0][1] * builds:
+            summary['duration'][percentiles.pop(0)[0]] = bucket_limit(rollup.bucket)
+    for name, fraction in percentiles:
+        summary['duration'][name] = None
+    return summary
+
+def project_stats(project, period, count):
+    """
+    Summaries of `project`'s builds in each of the `count` most recent
+    periods that had any, newest first: all of them, and by arch and host.
+    """
+    from .models import BuildRollup
+    rollups = BuildRollup.objects.filter(project=project, period=period)
+    starts = list(rollups.filter(dimension='all').order_by('-start')
+                         .values_list('start', flat=True).distinct()[:count])
+    if not starts:
+        return []
+
+    groups = {}
+    for rollup in rollups.filter(start__gte=starts[-1]).order_by():
+        key = (rollup.start, rollup.dimension, rollup.value)
+        groups.setdefault(key, []).append(rollup)
+
+    stats = []
+    for start in starts:
+        summary = summarize(groups.get((start, 'all', ''), []))
+        summary['start'] = start.isoformat()
+        for dimension in DIMENSIONS:
+            summary[dimension] = dict((value, summarize(rows))
+                                      for (s, d, value), rows in groups.items()
+                                      if s == start and d == dimension)
+        stats.append(summary)
+    return stats
+
+def build_deleted(sender, instance, **kwargs):
+    # Incremental builds aren't counted until they're finished.
+    if not instance.in_progress:
+        count_build(instance, sign=-1)
+
+def connect_signals():
+    from .models import Build
+    post_delete.connect(build_deleted, sender=Build)
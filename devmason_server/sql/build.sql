@@ -0,0 +1,4 @@
+-- Build lists are a project's builds newest first: by finished time, with
+-- the id to break ties (see handle_cursor_builds), or just by id.
+CREATE INDEX devmason_server_build_project_finished ON devmason_server_build (project_id, finished, id);
+CREATE INDEX devmason_server_build_project_id ON devmason_server_build (project_id, id);
@@ -0,0 +1,6 @@
+-- Lets BuildRequest.objects.lease() find the longest waiting requests for an
+-- architecture without looking at any others, however many are queued.
+CREATE INDEX devmason_server_buildrequest_lease ON devmason_server_buildrequest (arch, available_at);
+
+-- A repository's build requests, newest first.
+CREATE INDEX devmason_server_buildrequest_repository_requested ON devmason_server_buildrequest (repository_id, requested);
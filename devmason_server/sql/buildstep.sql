@@ -0,0 +1,2 @@
+-- A build's steps are always read in the order they ran.
+CREATE INDEX devmason_server_buildstep_build_started ON devmason_server_buildstep (build_id, started, id);
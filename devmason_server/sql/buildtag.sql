@@ -0,0 +1,3 @@
+-- Each tag's builds in a project, newest first: the posting lists that
+-- devmason_server.tagindex intersects.
+CREATE INDEX devmason_server_buildtag_postings ON devmason_server_buildtag (project_id, tag_id, finished, build_id);
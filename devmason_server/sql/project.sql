@@ -0,0 +1,5 @@
+-- The project list is in name order.
+CREATE INDEX devmason_server_project_name ON devmason_server_project (name);
+
+-- Finds the project whose newest build is being deleted.
+CREATE INDEX devmason_server_project_latest_build ON devmason_server_project (latest_build_id);
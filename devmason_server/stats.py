@@ -0,0 +1,205 @@
+"""
+Per-view request statistics.
+
+`StatsMiddleware` times every request and counts the SQL it runs, and files
+the numbers under the name of the URL it was for -- `project_list`,
+`build_detail`, `xmlrpc` and so on. Each number is kept as a rolling window
+of the last `DEVMASON_STATS_WINDOW` requests to the view, in process memory,
+so they reflect recent traffic and cost nothing to keep. Staff can see them
+at the `view_stats` URL.
+"""
+
+import time
+import threading
+from collections import deque
+from django.conf import settings
+from django.core import urlresolvers
+from django.db import connections
+
+# What's recorded about each request.
+METRICS = ('time', 'queries', 'sql_time', 'render_time', 'size')
+
+class Histogram(object):
+    """The last `window` values of something, and a running count and total."""
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        values = sorted(self.values)
+        if not values:
+            return {'count': self.count, 'total': self.total}
+        def percentile(p):
+            return values[min(len(values) - 1, int(len(values) * p))]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'window': len(values),
+            'mean': float(sum(values)) / len(values),
+            'min': values[0],
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': values[-1],
+        }
+
+class ViewStats(object):
+    """A histogram of each of `METRICS` for each view."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def record(self, view, **values):
+        self.lock.acquire()
+        try:
+            if view not in self.views:
+                self.views[view] = dict((m, Histogram(self.window)) for m in METRICS)
+            for metric, value in values.items():
+                self.views[view][metric].add(value)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Summaries of every histogram, keyed by view and then metric."""
+        self.lock.acquire()
+        try:
+            return dict((view, dict((m, h.summary()) for m, h in metrics.items()))
+                        for view, metrics in self.views.items())
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.views.clear()
+        finally:
+            self.lock.release()
+
+view_stats = ViewStats(getattr(settings, 'DEVMASON_STATS_WINDOW', 1000))
+
+class QueryCounter(object):
+    """
+    Counts and times the queries run on this thread's database connections
+    between `start()` and `stop()`. Works whether or not DEBUG is on.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+    def start(self):
+        for connection in connections.all():
+            # Connections are thread-local, so this only affects this thread.
+            connection.cursor = self._wrap(connection.cursor)
+
+    def stop(self):
+        for connection in connections.all():
+            if 'cursor' in connection.__dict__:
+                del connection.cursor
+
+    def _wrap(self, cursor):
+        counter = self
+        def wrapped_cursor():
+            return CountingCursor(cursor(), counter)
+        return wrapped_cursor
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def _timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.counter.queries += 1
+            self.counter.time += time.time() - start
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+# Time spent rendering responses on each thread, for StatsMiddleware.
+_render = threading.local()
+
+def timed_render(render):
+    """Decorates an emitter's `render` to count towards the render time."""
+    def wrapper(self, request):
+        start = time.time()
+        try:
+            return render(self, request)
+        finally:
+            if hasattr(_render, 'time'):
+                _render.time += time.time() - start
+    wrapper.__name__ = render.__name__
+    wrapper.__doc__ = render.__doc__
+    return wrapper
+
+def _url_names(resolver, names):
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, urlresolvers.RegexURLResolver):
+            _url_names(pattern, names)
+        elif pattern.name:
+            names.setdefault(id(pattern.callback), pattern.name)
+    return names
+
+_view_names = {}
+
+def view_name(view_func):
+    """The name of the URL pattern `view_func` is for, or its module path."""
+    urlconf = urlresolvers.get_urlconf() or settings.ROOT_URLCONF
+    if urlconf not in _view_names:
+        _view_names[urlconf] = _url_names(urlresolvers.get_resolver(urlconf), {})
+    try:
+        return _view_names[urlconf][id(view_func)]
+    except KeyError:
+        return '%s.%s' % (view_func.__module__,
+                          getattr(view_func, '__name__', view_func.__class__.__name__))
+
+class StatsMiddleware(object):
+    """Records the cost of each request in `view_stats`."""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._stats = (view_name(view_func), time.time(), QueryCounter())
+        request._stats[2].start()
+        _render.time = 0.0
+
+    def process_response(self, request, response):
+        # Requests that never got as far as a view aren't counted.
+        if not hasattr(request, '_stats'):
+            return response
+        view, start, counter = request._stats
+        counter.stop()
+        del request._stats
+        # Don't read the content of streamed responses: that would use it up.
+        if response._is_string:
+            size = len(response.content)
+        else:
+            size = int(response.get('Content-Length', 0))
+        view_stats.record(view,
+            time = time.time() - start,
+            queries = counter.queries,
+            sql_time = counter.time,
+            render_time = getattr(_render, 'time', 0.0),
+            size = size,
+        )
+        return response
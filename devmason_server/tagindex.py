@@ -0,0 +1,263 @@
+"""
+Finding a project's builds by tag.
+
+django-tagging finds objects with all of a set of tags with a GROUP BY over
+every tagged item of every model, which gets slower with each build. The
+`BuildTag` table is a narrower index: for each project and tag, the builds
+with that tag in (finished, id) order -- a posting list. To find builds
+with all of several tags, `intersect` walks the lists together newest
+first, each one skipping ahead with an indexed seek to wherever the others
+have got to, so it reads little more than the builds it returns.
+
+Builds are indexed as they're saved (see `ingest.save_build`), and tags
+added or removed through django-tagging are picked up by signal handlers.
+Each project's `TagUsage` counts are kept up to date along with the index.
+"""
+
+import bisect
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_delete
+from tagging import settings as tagging_settings
+from tagging.models import Tag, TaggedItem
+from .bulk import bulk_insert, bulk_insert_or_update
+
+# Models are imported where they're used: models.py imports this module to
+# connect its signal handlers.
+
+# How many postings to read from the index at a time.
+CHUNK_SIZE = 100
+
+def index_build(build, tags):
+    """Index a new `build` -- which must have no tags yet -- under `tags`."""
+    from .models import BuildTag
+    bulk_insert(BuildTag, [
+        BuildTag(project_id=build.project_id, tag=tag, build=build, finished=build.finished)
+        for tag in tags
+    ])
+    count_usage(build.project_id, [tag.pk for tag in tags], build.finished)
+
+def count_usage(project_id, tag_ids, finished):
+    """Count one more build, finished at `finished`, for each of `tag_ids`."""
+    from .models import TagUsage
+    if not tag_ids:
+        return
+    usage = TagUsage.objects.filter(project=project_id, tag__in=tag_ids)
+    existing = set(usage.values_list('tag', flat=True))
+    if existing:
+        _add_usage(usage, finished)
+    add_usage(project_id, [tag_id for tag_id in tag_ids if tag_id not in existing], finished)
+
+def _add_usage(usage, finished):
+    # Atomic, so concurrent builds aren't miscounted.
+    usage.update(builds=F('builds') + 1)
+    usage.filter(last_used__lt=finished).update(last_used=finished)
+
+def add_usage(project_id, tag_ids, finished):
+    """
+    Count the first build for each of `tag_ids`. Tags that a concurrent
+    build got counted first are counted one more instead.
+    """
+    from .models import TagUsage
+    bulk_insert_or_update(TagUsage, [
+        TagUsage(project_id=project_id, tag_id=tag_id, builds=1, last_used=finished)
+        for tag_id in tag_ids
+    ], lambda new: _add_usage(TagUsage.objects.filter(project=project_id, tag=new.tag_id),
+                              finished))
+
+def uncount_usage(sender, instance, **kwargs):
+    """Count one fewer build for a `BuildTag` that has been deleted."""
+    from .models import BuildTag, TagUsage
+    usage = TagUsage.objects.filter(project=instance.project_id, tag=instance.tag_id)
+    usage.update(builds=F('builds') - 1)
+    usage.filter(builds__lte=0).delete()
+    # The newest build left with the tag is the first in its postings.
+    newest = BuildTag.objects.filter(project=instance.project_id, tag=instance.tag_id) \
+                             .order_by('-finished').values_list('finished', flat=True)[:1]
+    if newest:
+        usage.filter(last_used__gt=newest[0]).update(last_used=newest[0])
+
+class Postings(object):
+    """
+    One tag's builds in a project as (finished, build id) positions, newest
+    first, read from the index a chunk at a time.
+    """
+
+    def __init__(self, project_id, tag_id, chunk_size=CHUNK_SIZE):
+        from .models import BuildTag
+        # Ordering by 'build' would follow Build's ordering with a join;
+        # the column itself is what the index is on.
+        self.queryset = BuildTag.objects.filter(project=project_id, tag=tag_id) \
+                                        .order_by('-finished', '-devmason_server_buildtag.build_id') \
+                                        .values_list('finished', 'build')
+        self.chunk_size = chunk_size
+        # Positions read but not yet passed, oldest first so they can be
+        # bisected and popped; and whether the index has any more after them.
+        self.buffer = []
+        self.exhausted = False
+
+    def seek(self, position=None, inclusive=True):
+        """
+        The newest position at or before `position` (or strictly before it,
+        if not `inclusive`), or None if there isn't one. Positions must be
+        sought in order, newest first.
+        """
+        if position is not None:
+            # Forget what we've now passed.
+            if inclusive:
+                del self.buffer[bisect.bisect_right(self.buffer, position):]
+            else:
+                del self.buffer[bisect.bisect_left(self.buffer, position):]
+        if not self.buffer and not self.exhausted:
+            self._read(position, inclusive)
+        return self.buffer and self.buffer[-1] or None
+
+    def _read(self, position, inclusive):
+        queryset = self.queryset
+        if position is not None:
+            finished, build_id = position
+            if inclusive:
+                queryset = queryset.filter(Q(finished__lt=finished) |
+                                           Q(finished=finished, build__lte=build_id))
+            else:
+                queryset = queryset.filter(Q(finished__lt=finished) |
+                                           Q(finished=finished, build__lt=build_id))
+        rows = list(queryset[:self.chunk_size])
+        self.exhausted = len(rows) < self.chunk_size
+        rows.reverse()
+        self.buffer = rows
+
+def intersect(postings, after=None):
+    """
+    Yield the positions in every one of `postings`, newest first, starting
+    just after the position `after` if it's given.
+    """
+    if not postings:
+        return
+    position, inclusive = after, after is None
+    while True:
+        candidate = postings[0].seek(position, inclusive)
+        if candidate is None:
+            return
+        for p in postings[1:]:
+            found = p.seek(candidate)
+            if found is None:
+                return
+            if found != candidate:
+                # Skip everything newer than what this list has to offer.
+                position, inclusive = found, True
+                break
+        else:
+            yield candidate
+            position, inclusive = candidate, False
+
+class TaggedBuilds(object):
+    """
+    The builds of `project` with all of `tag_names`, newest first. Works
+    with a Paginator, and cursor pagination can ask for the builds
+    `after()` a position.
+    """
+
+    def __init__(self, project, tag_names):
+        self.project = project
+        names = set(n.strip() for n in tag_names if n.strip())
+        if tagging_settings.FORCE_LOWERCASE_TAGS:
+            names = set(n.lower() for n in names)
+        tag_ids = list(Tag.objects.filter(name__in=names).values_list('pk', flat=True))
+        # An unknown tag is on no builds, so nothing can match.
+        self.tag_ids = names and len(tag_ids) == len(names) and tag_ids or []
+        self._count = None
+
+    def positions(self, after=None):
+        postings = [Postings(self.project.pk, tag_id) for tag_id in self.tag_ids]
+        return intersect(postings, after)
+
+    def builds(self, positions):
+        """The builds at `positions`, in the same order."""
+        from .models import Build
+        ids = [build_id for finished, build_id in positions]
+        builds = Build.objects.filter(pk__in=ids).select_related('project', 'user').order_by()
+        by_pk = dict((b.pk, b) for b in builds)
+        return [by_pk[pk] for pk in ids if pk in by_pk]
+
+    def after(self, position, limit):
+        """Up to `limit` builds after the (finished, build id) `position`."""
+        positions = []
+        for p in self.positions(position):
+            positions.append(p)
+            if len(positions) >= limit:
+                break
+        return self.builds(positions)
+
+    def latest(self):
+        """The newest matching build, or None."""
+        builds = self.after(None, 1)
+        return builds and builds[0] or None
+
+    def matching(self):
+        """
+        The index entries of the matching builds as (finished, build id)
+        positions, newest first, in one query. The rarest tag's postings
+        are read in order, and each of the others is looked up by its
+        (build, tag) key, so counts and pages deep into the list are a
+        single indexed query rather than a walk from the start.
+        """
+        from .models import BuildTag, TagUsage
+        tag_ids = self.tag_ids
+        if len(tag_ids) > 1:
+            usage = dict(TagUsage.objects.filter(project=self.project.pk, tag__in=tag_ids)
+                                         .values_list('tag', 'builds'))
+            tag_ids = sorted(tag_ids, key=lambda tag_id: usage.get(tag_id, 0))
+        queryset = BuildTag.objects.filter(project=self.project.pk, tag=tag_ids[0])
+        for tag_id in tag_ids[1:]:
+            queryset = queryset.filter(build__tag_index__tag=tag_id)
+        return queryset.order_by('-finished', '-devmason_server_buildtag.build_id') \
+                       .values_list('finished', 'build')
+
+    def count(self):
+        if self._count is None:
+            self._count = self.tag_ids and self.matching().count() or 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError("TaggedBuilds only supports simple slices")
+        if not self.tag_ids:
+            return []
+        return self.builds(list(self.matching()[index.start or 0:index.stop]))
+
+def _is_build(item):
+    from .models import Build
+    return item.content_type_id == ContentType.objects.get_for_model(Build).pk
+
+def tag_added(sender, instance, created, **kwargs):
+    from .models import Build, BuildTag
+    if not created or not _is_build(instance):
+        return
+    try:
+        build = Build.objects.get(pk=instance.object_id)
+    except Build.DoesNotExist:
+        return
+    # Incremental builds are indexed when they're finished.
+    if build.in_progress:
+        return
+    if not BuildTag.objects.filter(build=build, tag=instance.tag_id):
+        BuildTag.objects.create(project_id=build.project_id, tag_id=instance.tag_id,
+                                build=build, finished=build.finished)
+        count_usage(build.project_id, [instance.tag_id], build.finished)
+
+def tag_removed(sender, instance, **kwargs):
+    from .models import BuildTag
+    if _is_build(instance):
+        BuildTag.objects.filter(build=instance.object_id, tag=instance.tag_id).delete()
+
+def connect_signals():
+    """Follow tags added and removed other than by `index_build`."""
+    from .models import BuildTag
+    post_save.connect(tag_added, sender=TaggedItem)
+    post_delete.connect(tag_removed, sender=TaggedItem)
+    # Deleting a build or project deletes its index entries along with it.
+    post_delete.connect(uncount_usage, sender=BuildTag)
@@ -1 +1,5 @@
-from .test_api import *
\ No newline at end of file
+from .test_api import *
+from .test_jsonstream import *
+from .test_fields import *
+from .test_queryplans import *
+from .test_stats import *
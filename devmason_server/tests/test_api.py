@@ -1,9 +1,40 @@
+import os
+import gzip
+import zlib
 import pprint
+import StringIO
 import difflib
+import datetime
+import shutil
+import tempfile
+import xmlrpclib
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core import urlresolvers
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.http import HttpRequest, HttpResponse, QueryDict
 from django.test import TestCase, Client
 from django.utils import simplejson
-from ..models import Build, Project
+from ..authcache import CredentialCache, credential_cache
+from ..buildqueue import BuildQueue
+from ..bulk import bulk_tag
+from ..handlers import PROJECT_PAGE_BUILDS
+from ..management.commands import ingest_builds
+from ..management.commands.ingest_builds import ingest
+from .. import compression, responsecache
+from .. import logstore, views
+from tagging.models import Tag
+from ..models import (Build, BuildLog, BuildStep, BuildRequest, BuildTag, Metric,
+                      Project, Repository, TagUsage, BuildRollup)
+from ..prefetch import BuildStream
+from ..responsecache import LRUCache, ResponseCache, response_cache
+from ..rollups import add_rollups, count_build, rollup_keys
+from ..stats import QueryCounter, view_name
+from ..tagindex import Postings, TaggedBuilds, add_usage, intersect
 
 class PonyTests(TestCase):
     urls = 'devmason_server.urls'
@@ -13,12 +44,30 @@ class PonyTests(TestCase):
         # Make this class's test client have a default Accept: header to
         # trigger the dispatching to API methods.
         self.client = Client(HTTP_ACCEPT='application/json')
+        response_cache.clear()
+        credential_cache.clear()
 
         # Tag us a build (this is hard from fixtures)
         b = Build.objects.get(pk=1)
         b.tags = 'python, django'
         b.save()
 
+    def assertQueryBudget(self, budget, url, method='get', *args, **kwargs):
+        """
+        Request `url`, failing if that runs more than `budget` queries.
+        Returns the response.
+        """
+        counter = QueryCounter()
+        counter.start()
+        try:
+            response = getattr(self.client, method)(url, *args, **kwargs)
+        finally:
+            counter.stop()
+        view = view_name(urlresolvers.resolve(url.split('?')[0])[0])
+        self.assert_(counter.queries <= budget, '%s (%s) ran %s queries, over its budget of %s'
+                                                % (url, view, counter.queries, budget))
+        return response
+
     def assertJsonEqual(self, response, expected):
         try:
             json = simplejson.loads(response.content)
@@ -515,6 +564,1341 @@ class BuildListTests(PonyTests):
         })
         """
 
+    def test_post_new_build_creates_steps_and_tags(self):
+        build = {
+            u'success': True,
+            u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+            u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500',
+            u'tags': [u'pony', u'rocks'],
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [
+                {u'name': u'step %s' % i, u'success': True, u'output': u'OK',
+                 u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+                 u'finished': u'Mon, 26 Oct 2009 16:23:00 -0500',
+                 u'command': u'make test'}
+                for i in range(250)
+            ],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+
+        b = Build.objects.get(pk=2)
+        self.assertEqual(sorted(t.name for t in b.tags), [u'pony', u'rocks'])
+        self.assertEqual(b.steps.count(), 250)
+        step = b.steps.get(name=u'step 0')
+        self.assertEqual(step.output, u'OK')
+        self.assertEqual(step.extra_info, {u'command': u'make test'})
+        self.assertEqual(step.started.minute, 22)
+
+    def test_post_invalid_step_creates_nothing(self):
+        build = {
+            u'success': True,
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [
+                {u'name': u'checkout', u'success': True},
+                {u'name': u'test'},
+            ],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Build.objects.count(), 1)
+
+class LogStorageTests(PonyTests):
+    def setUp(self):
+        super(LogStorageTests, self).setUp()
+        self.log_root = tempfile.mkdtemp()
+        settings.DEVMASON_LOG_ROOT = self.log_root
+
+    def tearDown(self):
+        del settings.DEVMASON_LOG_ROOT
+        shutil.rmtree(self.log_root)
+
+    def post_build(self, output):
+        build = {
+            u'success': True,
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [{u'name': u'test', u'success': True, u'output': output}],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+        return Build.objects.order_by('-pk')[0].steps.get()
+
+    def test_large_output_is_compressed_and_deduplicated(self):
+        output = u'test_pony (pony.tests.PonyTests) ... ok\n' * 5000
+        first = self.post_build(output)
+        second = self.post_build(output)
+
+        self.assertEqual(first.output, u'')
+        self.assertEqual(first.output_log_id, second.output_log_id)
+        log = first.output_log
+        self.assertEqual(log.codec, 'zlib')
+        self.assert_(log.stored_size < log.size / 10)
+        self.assertEqual(second.get_output(), output)
+
+    def test_small_output_stays_inline(self):
+        step = self.post_build(u'OK')
+        self.assertEqual(step.output, u'OK')
+        self.assertEqual(step.output_log, None)
+
+    def test_compact_build_logs(self):
+        output = u'x' * 5000
+        BuildStep.objects.filter(pk=1).update(output=output)
+        BuildStep.objects.filter(pk=2).update(output=output)
+        call_command('compact_build_logs', verbosity=0)
+
+        steps = BuildStep.objects.filter(pk__in=[1, 2])
+        self.assertEqual([s.output for s in steps], [u'', u''])
+        self.assertEqual(set(s.output_log_id for s in steps), set([BuildLog.objects.get().pk]))
+        self.assertEqual([s.get_output() for s in steps], [output, output])
+
+    def test_step_log(self):
+        lines = [u'line %d \u2713\n' % i for i in range(5000)]
+        old_size, logstore.CHECKPOINT_SIZE = logstore.CHECKPOINT_SIZE, 1000
+        try:
+            step = self.post_build(u''.join(lines))
+        finally:
+            logstore.CHECKPOINT_SIZE = old_size
+        self.assertEqual(step.output_log.line_index['lines'], 5000)
+        self.assert_(len(step.output_log.line_index['checkpoints']) > 50)
+
+        url = step.get_output_url()
+        data = u''.join(lines).encode('utf-8')
+        self.assertEqual(self.client.get(url).content, data)
+        self.assertEqual(self.client.get(url + '?tail=3').content,
+                         u''.join(lines[-3:]).encode('utf-8'))
+        for first in range(1, 5000, 97):
+            self.assertEqual(self.client.get(url + '?lines=%d-%d' % (first, first + 4)).content,
+                             u''.join(lines[first - 1:first + 4]).encode('utf-8'))
+        self.assertEqual(self.client.get(url + '?lines=4999-').content,
+                         u''.join(lines[-2:]).encode('utf-8'))
+
+        for start in range(0, len(data), 4999):
+            r = self.client.get(url, HTTP_RANGE='bytes=%d-%d' % (start, start + 99))
+            self.assertEqual(r.status_code, 206)
+            self.assertEqual(r['Content-Range'], 'bytes %d-%d/%d' % (
+                start, min(start + 99, len(data) - 1), len(data)))
+            self.assertEqual(r.content, data[start:start + 100])
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=-10').content, data[-10:])
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=%d-' % len(data)).status_code,
+                         416)
+        self.assertEqual(self.client.get(url + '?tail=lots').status_code, 400)
+
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=self.client.get(url)['ETag'])
+        self.assertEqual(r.status_code, 304)
+
+        # Logs stored before they were indexed are read from the start.
+        BuildLog.objects.update(line_index='')
+        self.assertEqual(self.client.get(url + '?tail=3').content,
+                         u''.join(lines[-3:]).encode('utf-8'))
+        call_command('compact_build_logs', verbosity=0)
+        self.assertEqual(BuildLog.objects.get().line_index['lines'], 5000)
+
+    def test_inline_step_log(self):
+        step = self.post_build(u'one\ntwo\nthree')
+        url = step.get_output_url()
+        self.assertEqual(self.client.get(url + '?tail=2').content, 'two\nthree')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=4-6').content, 'two')
+        self.assertEqual(self.client.get(url.replace('output', 'errout')).content, '')
+
+    def test_build_summary(self):
+        step = self.post_build(u'x\n' * 5000)
+        r = self.client.get('/pony/builds/%s?summary=1&format=json' % step.build_id)
+        result = simplejson.loads(r.content)['results'][0]
+        self.assert_('output' not in result)
+        self.assertEqual(result['output_size'], 10000)
+        self.assertEqual(result['errout_size'], 0)
+        self.assertEqual(result['links'][0]['href'], step.get_output_url())
+        r = self.client.get('/pony/builds/%s?summary=1' % step.build_id,
+                            HTTP_ACCEPT='text/html')
+        self.assertContains(r, step.get_output_url() + '?tail=200')
+        self.assertNotContains(r, 'x\nx\n')
+
+class StreamingBuildTests(LogStorageTests):
+    def setUp(self):
+        super(StreamingBuildTests, self).setUp()
+        settings.DEVMASON_STREAMING_THRESHOLD = 0
+        settings.DEVMASON_STREAMING_CHUNK_SIZE = 1024
+
+    def tearDown(self):
+        del settings.DEVMASON_STREAMING_THRESHOLD
+        del settings.DEVMASON_STREAMING_CHUNK_SIZE
+        super(StreamingBuildTests, self).tearDown()
+
+    def test_post_streamed_build(self):
+        output = u'Ran 1 test \u2713\n' * 10000
+        build = {
+            u'success': True,
+            u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+            u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500',
+            u'tags': [u'streamed'],
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [
+                {u'name': u'test', u'success': True, u'output': output, u'errout': u''},
+                {u'name': u'again', u'success': True, u'output': output},
+            ],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+
+        steps = list(Build.objects.get(pk=2).steps.all())
+        self.assertEqual(steps[0].get_output(), output)
+        self.assertEqual(steps[0].get_errout(), u'')
+        # Identical output is only stored once.
+        self.assertEqual(steps[0].output_log_id, steps[1].output_log_id)
+        self.assertEqual(BuildLog.objects.count(), 1)
+
+        r = self.client.get('/pony/builds/2?format=json')
+        self.assertEqual(simplejson.loads(r.content)['results'][0]['output'], output)
+
+    def test_post_malformed_streamed_build(self):
+        r = self.client.post('/pony/builds', data='{"success": true, "results": [{"output": "x"',
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Build.objects.count(), 1)
+        self.assertEqual(BuildLog.objects.count(), 0)
+
+class CursorPaginationTests(PonyTests):
+    def setUp(self):
+        super(CursorPaginationTests, self).setUp()
+        project = Project.objects.get(slug='pony')
+        started = datetime.datetime(2009, 10, 20, 12, 0)
+        # Two builds finishing at the same time, to check ties are broken.
+        for minutes in (1, 2, 2, 3, 4):
+            b = Build.objects.create(project=project, success=True, host='example.com',
+                                     arch='linux-i386', started=started,
+                                     finished=started + datetime.timedelta(minutes=minutes))
+            b.tags = 'python'
+
+    def walk(self, url):
+        seen = []
+        while url:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            json = simplejson.loads(r.content)
+            self.assert_('num_pages' not in json)
+            seen.extend(l['href'] for b in json['builds'] for l in b['links'] if l['rel'] == 'self')
+            next = [l['href'] for l in json['links'] if l['rel'] == 'next']
+            url = next and next[0] + '&format=json'
+        return seen
+
+    def test_walk_build_list(self):
+        self.assertEqual(self.walk('/pony/builds?after=&per_page=2&format=json'), [
+            '/pony/builds/6', '/pony/builds/5', '/pony/builds/4',
+            '/pony/builds/3', '/pony/builds/2', '/pony/builds/1',
+        ])
+
+    def test_walk_tag_detail(self):
+        self.assertEqual(self.walk('/pony/tags/python?after=&per_page=4&format=json'), [
+            '/pony/builds/6', '/pony/builds/5', '/pony/builds/4',
+            '/pony/builds/3', '/pony/builds/2', '/pony/builds/1',
+        ])
+
+    def test_count_is_optional(self):
+        r = self.client.get('/pony/builds?after=&per_page=2&format=json')
+        self.assert_('count' not in simplejson.loads(r.content))
+        r = self.client.get('/pony/builds?after=&per_page=2&count=1&format=json')
+        self.assertEqual(simplejson.loads(r.content)['count'], 6)
+
+    def test_invalid_cursor_gives_first_page(self):
+        r = self.client.get('/pony/builds?after=nonsense&per_page=2&format=json')
+        json = simplejson.loads(r.content)
+        self.assertEqual(json['builds'][0]['links'][0]['href'], '/pony/builds/6')
+
+class TagIndexTests(PonyTests):
+    def setUp(self):
+        super(TagIndexTests, self).setUp()
+        self.project = Project.objects.get(slug='pony')
+        started = datetime.datetime(2009, 10, 20, 12, 0)
+        self.builds = []
+        for minutes, tags in ((1, 'python'), (2, 'python, django'), (3, 'django'),
+                              (4, 'python, django, windows'), (5, 'python')):
+            b = Build.objects.create(project=self.project, success=True, host='example.com',
+                                     arch='linux-i386', started=started,
+                                     finished=started + datetime.timedelta(minutes=minutes))
+            b.tags = tags
+            self.builds.append(b)
+
+    def hrefs(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return [b['links'][0]['href'] for b in simplejson.loads(r.content)['builds']]
+
+    def test_all_tags_must_match(self):
+        expected = ['/pony/builds/5', '/pony/builds/3', '/pony/builds/1']
+        self.assertEqual(self.hrefs('/pony/tags/python;django?format=json'), expected)
+        self.assertEqual(self.hrefs('/pony/tags/django;python?after=&format=json'), expected)
+        self.assertEqual(self.hrefs('/pony/tags/python;django;windows?format=json'),
+                         ['/pony/builds/5'])
+
+    def test_unknown_tag_matches_nothing(self):
+        for url in ('/pony/tags/python;nonsense?format=json',
+                    '/pony/tags/python;nonsense/latest'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_latest(self):
+        r = self.client.get('/pony/tags/python;django/latest')
+        self.assertEqual(r.status_code, 302)
+        self.assert_(r['Location'].endswith('/pony/builds/5'))
+
+    def test_index_follows_tag_changes(self):
+        self.builds[3].tags = 'django'
+        self.assertEqual(self.hrefs('/pony/tags/python;django?format=json'),
+                         ['/pony/builds/3', '/pony/builds/1'])
+        self.builds[1].delete()
+        self.assertEqual(self.hrefs('/pony/tags/python;django?format=json'),
+                         ['/pony/builds/1'])
+
+    def test_intersect_across_chunks(self):
+        tags = dict((t.name, t.pk) for t in Tag.objects.all())
+        for chunk_size in (1, 2, 3):
+            postings = [Postings(self.project.pk, tags[name], chunk_size)
+                        for name in ('python', 'django')]
+            self.assertEqual([build_id for finished, build_id in intersect(postings)],
+                             [5, 3, 1])
+            postings = [Postings(self.project.pk, tags[name], chunk_size)
+                        for name in ('django', 'python')]
+            after = (self.builds[3].finished, self.builds[3].pk)
+            self.assertEqual([build_id for finished, build_id in intersect(postings, after)],
+                             [3, 1])
+
+    def test_counts_and_pages_dont_walk_the_index(self):
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            for tags, count, page, queries in ((['python'], 5, [5, 3], 1),
+                                               (['python', 'django'], 3, [3, 1], 2)):
+                builds = TaggedBuilds(self.project, tags)
+                connection.queries = []
+                self.assertEqual(builds.count(), count)
+                self.assertEqual(len(connection.queries), queries)
+                connection.queries = []
+                self.assertEqual([b.pk for b in builds[1:3]], page)
+                # The page, then its builds.
+                self.assertEqual(len(connection.queries), queries + 1)
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual(len(TaggedBuilds(self.project, ['python', 'nonsense'])), 0)
+
+    def test_rebuild_tag_index(self):
+        BuildTag.objects.all().delete()
+        call_command('rebuild_tag_index', verbosity=0, batch_size=2)
+        self.assertEqual(self.hrefs('/pony/tags/python;django?format=json'),
+                         ['/pony/builds/5', '/pony/builds/3', '/pony/builds/1'])
+
+class ManyBuildsTests(PonyTests):
+    """Twenty more builds, each with tags and steps."""
+
+    def setUp(self):
+        super(ManyBuildsTests, self).setUp()
+        project = Project.objects.get(slug='pony')
+        user = User.objects.get(username='testclient')
+        started = datetime.datetime(2009, 10, 20, 12, 0)
+        for i in range(20):
+            b = Build.objects.create(project=project, success=True, host='example.com',
+                                     arch='linux-i386', user=user, started=started,
+                                     finished=started + datetime.timedelta(minutes=i))
+            b.tags = 'python, django'
+            for name in ('checkout', 'test'):
+                BuildStep.objects.create(build=b, success=True, name=name,
+                                         started=started, finished=started)
+
+    def count_queries(self, url):
+        # The debug cursor only records queries when DEBUG is on.
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+class PrefetchTests(ManyBuildsTests):
+    def test_build_list_queries_are_constant(self):
+        self.assertEqual(self.count_queries('/pony/builds?per_page=2&format=json'),
+                         self.count_queries('/pony/builds?per_page=20&format=json'))
+
+    def test_cursor_queries_are_constant(self):
+        self.assertEqual(self.count_queries('/pony/builds?after=&per_page=2&format=json'),
+                         self.count_queries('/pony/builds?after=&per_page=20&format=json'))
+
+    def test_tag_detail_queries_are_constant(self):
+        self.assertEqual(self.count_queries('/pony/tags/python?per_page=2&format=json'),
+                         self.count_queries('/pony/tags/python?per_page=20&format=json'))
+
+    def test_project_page_queries_are_constant(self):
+        queries = self.count_queries('/pony?format=html')
+        Build.objects.filter(project__slug='pony')[0].delete()
+        self.assertEqual(self.count_queries('/pony?format=html'), queries)
+
+    def test_project_page_lists_newest_builds(self):
+        project = Project.objects.get(slug='pony')
+        for i in range(PROJECT_PAGE_BUILDS):
+            Build.objects.create(project=project, success=True, host='example.com',
+                                 arch='linux-i386', started=datetime.datetime(2009, 10, 1),
+                                 finished=datetime.datetime(2009, 10, 1))
+        r = self.client.get('/pony?format=html')
+        builds = project.builds.order_by('-finished', '-pk')
+        self.assertContains(r, 'images/pass.png', count=PROJECT_PAGE_BUILDS)
+        self.assertContains(r, builds[0].get_absolute_url())
+        self.assertNotContains(r, '"%s"' % builds[PROJECT_PAGE_BUILDS].get_absolute_url())
+        self.assertContains(r, '/pony/builds')
+
+    def test_prefetched_results_match(self):
+        r = self.client.get('/pony/builds?per_page=25&format=json')
+        for b in simplejson.loads(r.content)['builds']:
+            build = Build.objects.get(pk=b['links'][0]['href'].split('/')[-1])
+            self.assertEqual(b['tags'], [t.name for t in build.tags])
+            self.assertEqual([s['name'] for s in b['results']],
+                             [s.name for s in build.steps.all()])
+            self.assertEqual(b['client']['user'], build.user and build.user.username or '')
+
+class FieldSelectionTests(ManyBuildsTests):
+    def builds(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return simplejson.loads(r.content)['builds']
+
+    def test_fields(self):
+        for b in self.builds('/pony/builds?fields=success,links&format=json'):
+            self.assertEqual(sorted(b.keys()), ['links', 'success'])
+
+    def test_expand(self):
+        for b in self.builds('/pony/builds?expand=tags&format=json'):
+            self.assertEqual(sorted(b.keys()), ['finished', 'links', 'started',
+                                                'success', 'tags'])
+        for b in self.builds('/pony/builds?fields=success&expand=results&format=json'):
+            self.assertEqual(sorted(b.keys()), ['results', 'success'])
+
+    def test_unknown_fields_are_ignored(self):
+        everything = self.builds('/pony/builds?format=json')
+        self.assertEqual(self.builds('/pony/builds?fields=nonsense&format=json'), everything)
+
+    def test_other_representations_are_left_whole(self):
+        r = self.client.get('/pony/builds?fields=success&format=json')
+        project = simplejson.loads(r.content)['project']
+        self.assertEqual(sorted(project.keys()), ['links', 'name', 'owner'])
+
+    def test_unrequested_fields_cost_nothing(self):
+        # Leaving out steps and tags saves a query for each list of builds.
+        for url, lists in (('/pony/builds?format=json', 1),
+                           ('/pony/builds?after=&format=json', 1),
+                           ('/pony/tags/python?format=json', 1),
+                           ('/?format=json', 1)):
+            everything = self.count_queries(url)
+            self.assertEqual(self.count_queries(url + '&fields=success,finished'),
+                             everything - 2 * lists)
+            self.assertEqual(self.count_queries(url + '&expand=tags'), everything - lists)
+
+    def test_html_is_unaffected(self):
+        # Templates don't pick fields, so everything is still loaded up front.
+        self.assertEqual(self.count_queries('/pony/tags/python?format=html&fields=success'),
+                         self.count_queries('/pony/tags/python?format=html'))
+
+    def test_build_detail(self):
+        r = self.client.get('/pony/builds/1?fields=success,started&format=json')
+        self.assertEqual(sorted(simplejson.loads(r.content).keys()), ['started', 'success'])
+        everything = self.client.get('/pony/builds/1?format=json')
+        self.assertNotEqual(r['ETag'], everything['ETag'])
+
+class StreamingListTests(ManyBuildsTests):
+    def setUp(self):
+        super(StreamingListTests, self).setUp()
+        settings.DEVMASON_STREAMING_PAGE_SIZE = 100
+        BuildStep.objects.filter(name='test').update(
+            output=u'caf\u00e9 "quoted"\n\tand a \\ backslash',
+            extra_info='{"log": "\\n\\u2603"}')
+
+    def tearDown(self):
+        del settings.DEVMASON_STREAMING_PAGE_SIZE
+
+    def get(self, url, page_size):
+        settings.DEVMASON_STREAMING_PAGE_SIZE = page_size
+        response_cache.clear()
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return r
+
+    def test_streamed_output_is_unchanged(self):
+        for url in ('/pony/builds?per_page=30&format=json',
+                    '/pony/builds?per_page=7&page=2&format=json',
+                    '/pony/builds?after=&per_page=8&format=json',
+                    '/pony/tags/python?per_page=30&format=json',
+                    '/pony/tags/python;django?after=&format=json',
+                    '/pony/builds?fields=success&expand=results&format=json',
+                    '/pony/builds?callback=builds&format=json',
+                    '/pony/builds?callback=alert(1)%3Bx&format=json'):
+            whole = self.get(url, 1000)
+            self.assert_(whole._is_string)
+            streamed = self.get(url, 0)
+            self.failIf(streamed._is_string, url)
+            self.assertEqual(streamed.content, whole.content, url)
+
+    def test_invalid_callbacks_are_dropped(self):
+        r = self.get('/pony/builds?callback=alert(1)%3Bx&format=json', 0)
+        self.assertEqual(r.content[0], '{')
+        r = self.get('/pony/builds?callback=builds&format=json', 0)
+        self.assert_(r.content.startswith('builds('))
+
+    def test_only_long_pages_are_streamed(self):
+        self.assert_(self.get('/pony/builds?per_page=5&format=json', 5)._is_string)
+        self.failIf(self.get('/pony/builds?per_page=6&format=json', 5)._is_string)
+        self.assert_(self.get('/pony/builds?per_page=6&format=html', 5)._is_string)
+
+    def test_streamed_gzip(self):
+        settings.DEVMASON_STREAMING_PAGE_SIZE = 0
+        r = self.client.get('/pony/builds?per_page=30&format=json', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.assert_('Content-Length' not in r)
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(r.content)).read()
+        self.assertEqual(body, self.get('/pony/builds?per_page=30&format=json', 1000).content)
+
+    def test_steps_are_loaded_a_batch_at_a_time(self):
+        builds = list(Build.objects.order_by('pk'))
+        stream = BuildStream(builds, batch_size=3)
+        for i, build in enumerate(stream):
+            self.assertEqual(len(build.get_steps()), build.steps.count())
+            loaded = [b for b in builds if hasattr(b, '_prefetched_steps')]
+            self.assertEqual(loaded, builds[i // 3 * 3:i // 3 * 3 + 3])
+        self.failIf([b for b in builds if hasattr(b, '_prefetched_steps')])
+
+class ConditionalGetTests(PonyTests):
+    def test_build_detail_is_immutable(self):
+        r = self.client.get('/pony/builds/1?format=json')
+        self.assertEqual(r.status_code, 200)
+        self.assert_(r['ETag'].startswith('"'))
+        self.assert_('max-age=31536000' in r['Cache-Control'])
+        self.assert_('Last-Modified' in r)
+
+        r = self.client.get('/pony/builds/1?format=json', HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, '')
+
+    def test_etag_depends_on_format(self):
+        json = self.client.get('/pony/builds/1?format=json')
+        html = self.client.get('/pony/builds/1?format=html')
+        self.assertNotEqual(json['ETag'], html['ETag'])
+        r = self.client.get('/pony/builds/1?format=html', HTTP_IF_NONE_MATCH=json['ETag'])
+        self.assertEqual(r.status_code, 200)
+
+    def test_if_modified_since(self):
+        r = self.client.get('/pony/builds/1?format=json')
+        r = self.client.get('/pony/builds/1?format=json',
+                            HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+        self.assertEqual(r.status_code, 304)
+        r = self.client.get('/pony/builds/1?format=json',
+                            HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 2009 00:00:00 GMT')
+        self.assertEqual(r.status_code, 200)
+
+    def test_missing_build_has_no_validators(self):
+        r = self.client.get('/pony/builds/99?format=json')
+        self.assertEqual(r.status_code, 404)
+        self.assert_('ETag' not in r)
+
+    def test_build_list_changes_with_new_builds(self):
+        for url in ('/pony/builds?format=json', '/pony/tags?format=json',
+                    '/pony/tags/python?format=json'):
+            r = self.client.get(url)
+            etag = r['ETag']
+            self.assert_(etag.startswith('W/'))
+            self.assertEqual(r['Cache-Control'], 'max-age=0, must-revalidate')
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, 304)
+
+            b = Build.objects.create(project=Project.objects.get(slug='pony'), success=True,
+                                     host='example.com', arch='linux-i386',
+                                     started=datetime.datetime(2009, 10, 20, 12, 0),
+                                     finished=datetime.datetime(2009, 10, 20, 12, 5))
+            b.tags = 'python'
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, 200)
+            self.assertNotEqual(r['ETag'], etag)
+
+class ResponseCacheTests(PonyTests):
+    def setUp(self):
+        super(ResponseCacheTests, self).setUp()
+        settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS = True
+
+    def tearDown(self):
+        del settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS
+
+    def count_queries(self, url):
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            return r, len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+    def add_build(self):
+        return Build.objects.create(project=Project.objects.get(slug='pony'), success=False,
+                                    host='example.com', arch='linux-i386',
+                                    started=datetime.datetime(2009, 10, 20, 12, 0),
+                                    finished=datetime.datetime(2009, 10, 20, 12, 5))
+
+    def test_repeat_requests_are_cached(self):
+        for url in ('/?format=json', '/pony/builds?format=json', '/pony/builds/1?format=html'):
+            first, queries = self.count_queries(url)
+            self.assert_(queries > 0)
+            second, queries = self.count_queries(url)
+            self.assertEqual(queries, 0)
+            self.assertEqual(first.content, second.content)
+            self.assertEqual(first['Content-Type'], second['Content-Type'])
+
+    def test_cached_conditional_get(self):
+        r = self.client.get('/pony/builds/1?format=json')
+        r = self.client.get('/pony/builds/1?format=json', HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(r.status_code, 304)
+        self.assert_('ETag' in r)
+
+    def test_model_writes_invalidate(self):
+        self.client.get('/pony/builds?format=json')
+        self.client.get('/?format=json')
+        self.add_build()
+        r, queries = self.count_queries('/pony/builds?format=json')
+        self.assertEqual(len(simplejson.loads(r.content)['builds']), 2)
+        r, queries = self.count_queries('/?format=json')
+        self.assertEqual(len(simplejson.loads(r.content)['latest_builds']), 2)
+
+    def test_tag_writes_invalidate(self):
+        self.client.get('/pony/tags?format=json')
+        self.add_build().tags = 'windows'
+        r = self.client.get('/pony/tags?format=json')
+        self.assert_('windows' in simplejson.loads(r.content)['tags'])
+
+    def test_api_writes_invalidate(self):
+        auth = "Basic %s" % "newuser:password".encode("base64").strip()
+        r = self.client.put('/proj', data='{"name": "My Project"}',
+                            content_type="application/json", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(r.status_code, 201)
+        self.client.get('/proj?format=json')
+        r = self.client.put('/proj', data='{"name": "Renamed"}',
+                            content_type="application/json", HTTP_AUTHORIZATION=auth)
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get('/proj?format=json')
+        self.assertEqual(simplejson.loads(r.content)['name'], 'Renamed')
+
+    def test_lru_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_lru_timeout(self):
+        cache = LRUCache(2, timeout=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_nothing_is_cached_for_other_processes_to_miss(self):
+        # Without a shared backend, writes by other processes go unheard.
+        del settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS
+        try:
+            self.count_queries('/pony/builds?format=json')
+            r, queries = self.count_queries('/pony/builds?format=json')
+            self.assert_(queries > 0)
+        finally:
+            settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS = True
+
+    def test_shared_generations_reach_other_processes(self):
+        # Two processes' caches, sharing a backend.
+        backend = get_cache('locmem://')
+        web, worker = ResponseCache(), ResponseCache()
+        web.shared = worker.shared = backend
+        request = HttpRequest()
+        request.path, request.GET = '/pony/builds', QueryDict('')
+        key = web.make_key(request, 'pony', 'json')
+        web.set(key, HttpResponse('old'))
+        self.assertEqual(web.get(key).content, 'old')
+
+        worker.invalidate('pony')
+        key = web.make_key(request, 'pony', 'json')
+        self.assertEqual(web.get(key), None)
+
+class CompressionTests(PonyTests):
+    def setUp(self):
+        super(CompressionTests, self).setUp()
+        settings.DEVMASON_COMPRESS_MIN_SIZE = 100
+        settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS = True
+
+    def tearDown(self):
+        del settings.DEVMASON_COMPRESS_MIN_SIZE
+        del settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS
+
+    def get(self, url, accept_encoding='gzip, deflate', **extra):
+        return self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding, **extra)
+
+    def decode(self, response):
+        if response['Content-Encoding'] == 'gzip':
+            return gzip.GzipFile(fileobj=StringIO.StringIO(response.content)).read()
+        return zlib.decompress(response.content)
+
+    def test_gzip(self):
+        plain = self.get('/pony/builds?format=json', accept_encoding='')
+        self.assert_('Content-Encoding' not in plain)
+        for url in ('/pony/builds?format=json', '/pony/builds?format=html'):
+            r = self.get(url)
+            self.assertEqual(r['Content-Encoding'], 'gzip')
+            self.assert_('Accept-Encoding' in r['Vary'])
+            self.assertEqual(int(r['Content-Length']), len(r.content))
+            self.assertEqual(self.decode(r), self.get(url, accept_encoding='').content)
+
+    def test_negotiation(self):
+        for accept_encoding, encoding in (('deflate', 'deflate'),
+                                          ('gzip;q=0.5, deflate', 'deflate'),
+                                          ('x-gzip', 'gzip'),
+                                          ('*', 'gzip'),
+                                          ('*;q=0, deflate;q=0.1', 'deflate'),
+                                          ('gzip;q=0', None),
+                                          ('identity', None)):
+            r = self.get('/pony/builds?format=json', accept_encoding)
+            self.assertEqual(r.get('Content-Encoding', None), encoding, accept_encoding)
+            if encoding:
+                self.assertEqual(simplejson.loads(self.decode(r))['count'], 1)
+
+    def test_thresholds(self):
+        settings.DEVMASON_COMPRESS_MIN_SIZE = 1000000
+        self.assert_('Content-Encoding' not in self.get('/pony/builds?format=json'))
+        settings.DEVMASON_COMPRESS_MIN_SIZE = 100
+        settings.DEVMASON_COMPRESS_LEVEL = 0
+        try:
+            self.assert_('Content-Encoding' not in self.get('/pony/builds?format=json'))
+        finally:
+            del settings.DEVMASON_COMPRESS_LEVEL
+
+    def test_cached_entries_are_compressed_once(self):
+        deflated = []
+        def counting_deflate(data):
+            deflated.append(data)
+            return compression.deflate(data)
+        responsecache.deflate = counting_deflate
+        try:
+            bodies = [self.decode(self.get('/pony/builds?format=json', accept_encoding))
+                      for accept_encoding in ('gzip', 'deflate', 'gzip')]
+        finally:
+            responsecache.deflate = compression.deflate
+        self.assertEqual(len(deflated), 1)
+        self.assertEqual(bodies, [deflated[0]] * 3)
+
+    def test_conditional_get(self):
+        r = self.get('/pony/builds/1?format=json')
+        self.assert_(r['ETag'].endswith('-gzip"'))
+        self.assertNotEqual(r['ETag'], self.get('/pony/builds/1?format=json', '')['ETag'])
+        for accept_encoding in ('gzip', ''):
+            response_cache.clear()
+            self.assertEqual(self.get('/pony/builds/1?format=json', accept_encoding,
+                                      HTTP_IF_NONE_MATCH=r['ETag']).status_code, 304)
+
+    def test_step_logs_are_left_alone(self):
+        r = self.get('/pony/builds/1/steps/1/output')
+        self.assertEqual(r.status_code, 200)
+        self.assert_('Content-Encoding' not in r)
+
+class CredentialCacheTests(PonyTests):
+    def put(self, username='testclient', password='password'):
+        auth = "Basic %s" % ("%s:%s" % (username, password)).encode("base64").strip()
+        return self.client.put('/proj?format=json', data='{"name": "My Project"}',
+                               content_type="application/json", HTTP_AUTHORIZATION=auth)
+
+    def test_verified_credentials_are_cached(self):
+        self.assertEqual(self.put().status_code, 201)
+        self.assertEqual(credential_cache.stats(), {'entries': 1, 'hits': 0, 'misses': 1})
+        r = self.put()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(simplejson.loads(r.content)['owner'], 'testclient')
+        self.assertEqual(credential_cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1})
+
+    def test_bad_and_new_credentials_are_not_cached(self):
+        self.assertEqual(self.put(password='wrong').status_code, 403)
+        self.assertEqual(self.put(username='newuser').status_code, 201)
+        self.assertEqual(credential_cache.stats()['entries'], 0)
+
+    def test_password_change_invalidates(self):
+        self.put()
+        user = User.objects.get(username='testclient')
+        user.last_login = datetime.datetime.now()
+        user.save()
+        self.assertEqual(credential_cache.stats()['entries'], 1)
+        user.set_password('changed')
+        user.save()
+        self.assertEqual(credential_cache.stats()['entries'], 0)
+        self.assertEqual(self.put().status_code, 403)
+        self.assertEqual(self.put(password='changed').status_code, 200)
+
+    def test_deactivation_invalidates(self):
+        self.put()
+        user = User.objects.get(username='testclient')
+        user.is_active = False
+        user.save()
+        self.assertEqual(credential_cache.stats()['entries'], 0)
+
+    def test_bounds(self):
+        user = User.objects.get(username='testclient')
+        cache = CredentialCache(max_entries=2, ttl=300)
+        for header in ('a', 'b', 'c'):
+            cache.add(header, user)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c').username, 'testclient')
+        cache = CredentialCache(max_entries=2, ttl=-1)
+        cache.add('a', user)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats(), {'entries': 0, 'hits': 0, 'misses': 1})
+
+class AsyncIngestTests(PonyTests):
+    def setUp(self):
+        super(AsyncIngestTests, self).setUp()
+        self.queue_root = tempfile.mkdtemp()
+        self.log_root = tempfile.mkdtemp()
+        settings.DEVMASON_INGEST_QUEUE = self.queue_root
+        settings.DEVMASON_LOG_ROOT = self.log_root
+        settings.DEVMASON_ASYNC_INGEST = True
+
+    def tearDown(self):
+        del settings.DEVMASON_INGEST_QUEUE
+        del settings.DEVMASON_LOG_ROOT
+        del settings.DEVMASON_ASYNC_INGEST
+        shutil.rmtree(self.queue_root)
+        shutil.rmtree(self.log_root)
+
+    def post_build(self, slug='pony', **extra):
+        build = {
+            u'success': True,
+            u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+            u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500',
+            u'tags': [u'async'],
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [{u'name': u'test', u'success': True, u'output': u'ok'}],
+        }
+        build.update(extra)
+        return self.client.post('/%s/builds' % slug, data=simplejson.dumps(build),
+                                content_type='application/json')
+
+    def status(self, r):
+        return self.client.get(r['Location'] + '?format=json')
+
+    def test_queued_then_ingested(self):
+        r = self.post_build()
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(Build.objects.count(), 1)
+        status = self.status(r)
+        self.assertEqual(simplejson.loads(status.content)['status'], 'pending')
+
+        call_command('ingest_builds', once=True, verbosity=0)
+        build = Build.objects.order_by('-pk')[0]
+        self.assertEqual(Build.objects.count(), 2)
+        self.assertEqual([t.name for t in build.tags], ['async'])
+        self.assertEqual(build.steps.get().output, 'ok')
+        self.assertEqual(Project.objects.get(slug='pony').latest_build, build)
+
+        status = self.status(r)
+        self.assertEqual(status.status_code, 302)
+        self.assertEqual(status['Location'], 'http://testserver/pony/builds/%s' % build.pk)
+
+    def test_invalid_payload_is_rejected_up_front(self):
+        r = self.post_build(started=u'not a date')
+        self.assertEqual(r.status_code, 400)
+
+    def test_failed_ingestion_is_reported(self):
+        r = self.post_build()
+        Project.objects.get(slug='pony').delete()
+        Project.objects.create(name='Pony', slug='pony2')
+        # The entry refers to a project that's gone; the other still goes in.
+        self.post_build(slug='pony2')
+        call_command('ingest_builds', once=True, verbosity=0)
+        self.assertEqual(Build.objects.filter(project__slug='pony2').count(), 1)
+
+        entry_id = r['Location'].rsplit('/', 1)[1]
+        state, error = BuildQueue().status(entry_id)
+        self.assertEqual(state, 'failed')
+        self.assert_('DoesNotExist' in error)
+
+    def test_streamed_upload_is_queued(self):
+        output = u'Ran 1 test\n' * 10000
+        settings.DEVMASON_STREAMING_THRESHOLD = 0
+        try:
+            r = self.post_build(results=[{u'name': u'test', u'success': True, u'output': output},
+                                         {u'name': u'lint', u'success': True, u'output': u'ok'}])
+        finally:
+            del settings.DEVMASON_STREAMING_THRESHOLD
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(Build.objects.count(), 1)
+        # The big output went to log storage rather than into the queue.
+        self.assertEqual(BuildLog.objects.count(), 1)
+
+        call_command('ingest_builds', once=True, verbosity=0)
+        steps = list(Build.objects.order_by('-pk')[0].steps.all())
+        self.assertEqual(steps[0].output_log, BuildLog.objects.get())
+        self.assertEqual(steps[0].get_output(), output)
+        self.assertEqual(steps[1].get_output(), u'ok')
+
+    def test_committed_entry_isnt_ingested_again(self):
+        r = self.post_build()
+        # A worker commits the build, then dies before marking it done.
+        queue = BuildQueue()
+        [(entry_id, entry)] = queue.claim(10)
+        build = transaction.commit_on_success(ingest)(entry_id, entry)
+        queue.recover(-1)
+
+        call_command('ingest_builds', once=True, verbosity=0)
+        self.assertEqual(Build.objects.count(), 2)
+        self.assertEqual(queue.status(entry_id), ('done', build.pk))
+
+    def test_requeued_claim_belongs_to_its_new_worker(self):
+        self.post_build()
+        # The first worker is slow enough to be taken for dead.
+        slow, fast = BuildQueue(), BuildQueue()
+        [(entry_id, entry)] = slow.claim(10)
+        slow.recover(-1)
+        self.assertEqual([e for e, entry in fast.claim(10)], [entry_id])
+
+        build = transaction.commit_on_success(ingest)(entry_id, entry)
+        slow.complete(entry_id, build)
+        self.assert_(os.path.exists(fast.path('claimed', entry_id)))
+        fast.complete(entry_id, build)
+        self.assertEqual(fast.listdir('claimed'), [])
+        self.assertEqual(fast.status(entry_id), ('done', build.pk))
+        # Finishing an entry whose claim is already gone is harmless.
+        slow.complete(entry_id, build)
+
+    def test_workers_invalidate_other_processes(self):
+        # The web process and a worker, sharing a cache backend.
+        backend = get_cache('locmem://')
+        worker_cache = ResponseCache()
+        response_cache.shared = worker_cache.shared = backend
+        ingest_builds.response_cache = worker_cache
+        try:
+            self.assertEqual(simplejson.loads(self.client.get('/pony/builds?format=json').content)['count'], 1)
+            self.post_build()
+            call_command('ingest_builds', once=True, verbosity=0)
+            r = self.client.get('/pony/builds?format=json')
+        finally:
+            response_cache.shared = None
+            ingest_builds.response_cache = response_cache
+        self.assertEqual(simplejson.loads(r.content)['count'], 2)
+
+    def test_single_process_cache_is_refused(self):
+        settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS = True
+        try:
+            self.assertRaises(CommandError, ingest_builds.Command().handle_noargs, once=True)
+        finally:
+            del settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS
+
+    def test_unknown_entry(self):
+        r = self.client.get('/pony/builds/queued/12345-abc?format=json')
+        self.assertEqual(r.status_code, 404)
+
+class IncrementalBuildTests(LogStorageTests):
+    def setUp(self):
+        super(IncrementalBuildTests, self).setUp()
+        self.running_root = tempfile.mkdtemp()
+        settings.DEVMASON_RUNNING_LOG_ROOT = self.running_root
+        settings.DEVMASON_TAIL_TIMEOUT = 0
+
+    def tearDown(self):
+        del settings.DEVMASON_RUNNING_LOG_ROOT
+        del settings.DEVMASON_TAIL_TIMEOUT
+        shutil.rmtree(self.running_root)
+        super(IncrementalBuildTests, self).tearDown()
+
+    def post(self, url, data, **extra):
+        return self.client.post(url, data=simplejson.dumps(data),
+                                content_type='application/json', **extra)
+
+    def open_build(self, **extra):
+        r = self.post('/pony/builds', {
+            u'incremental': True,
+            u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+            u'tags': [u'live'],
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+        }, **extra)
+        self.assertEqual(r.status_code, 201)
+        return r['Location'].replace('http://testserver', '')
+
+    def start_step(self, progress, name, output=u'', **extra):
+        r = self.post(progress, {u'name': name, u'output': output,
+                                 u'started': u'Mon, 26 Oct 2009 16:23:00 -0500'}, **extra)
+        self.assertEqual(r.status_code, 201)
+        url = r['Location'].replace('http://testserver', '')
+        return int(url.split('/')[-2]), url
+
+    def test_incremental_build(self):
+        progress = self.open_build()
+        build = Build.objects.get(in_progress=True)
+        self.assertEqual(progress, '/pony/builds/%s/progress' % build.pk)
+
+        # Nowhere to be seen until it's finished.
+        r = self.client.get('/pony/builds?format=json')
+        self.assertEqual(simplejson.loads(r.content)['count'], 1)
+        r = self.client.get('/?format=json')
+        self.assertEqual(len(simplejson.loads(r.content)['latest_builds']), 1)
+        self.assertEqual(self.client.get('/pony/tags/live?format=json').status_code, 404)
+        r = self.client.get('/pony/builds/%s' % build.pk)
+        self.assertEqual(r.status_code, 302)
+        self.assert_(r['Location'].endswith(progress))
+
+        r = self.post(progress, {u'name': u'checkout', u'success': True, u'output': u'ok',
+                                 u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+                                 u'finished': u'Mon, 26 Oct 2009 16:23:00 -0500'})
+        self.assertEqual(r.status_code, 204)
+        self.assert_(r['Location'].endswith('/pony/builds/%s' % build.pk))
+
+        step_id, output_url = self.start_step(progress, u'test', output=u'one\n')
+        self.assertEqual(output_url, BuildStep.objects.get(pk=step_id).get_output_url())
+        r = self.post(progress, {u'id': step_id, u'output': u'two \u2713\n', u'errout': u'oops'})
+        self.assertEqual(r.status_code, 204)
+
+        r = self.client.get(output_url)
+        self.assertEqual(r.content, u'one\ntwo \u2713\n'.encode('utf-8'))
+        self.assertEqual(r['Cache-Control'], 'no-cache')
+        self.failIf(r.has_header('ETag'))
+        self.assertEqual(self.client.get(output_url + '?tail=1').content,
+                         u'two \u2713\n'.encode('utf-8'))
+
+        r = self.client.get(progress + '?format=json')
+        self.assertEqual(r.status_code, 200)
+        data = simplejson.loads(r.content)
+        self.assertEqual(data['tags'], [u'live'])
+        self.assertEqual([s['name'] for s in data['results']], [u'checkout', u'test'])
+        self.assert_('finished' in data['results'][0])
+        self.failIf('finished' in data['results'][1])
+        self.assertEqual(data['results'][1]['output_size'], 12)
+        self.assertEqual(self.client.get(progress).status_code, 200)
+
+        output = u'x' * 5000
+        r = self.post(progress, {u'id': step_id, u'output': output, u'success': True,
+                                 u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500',
+                                 u'tests': 12})
+        self.assertEqual(r.status_code, 204)
+        step = BuildStep.objects.get(pk=step_id)
+        self.failIf(step.in_progress)
+        self.assertEqual(step.get_output(), u'one\ntwo \u2713\n' + output)
+        self.assert_(step.output_log_id)
+        self.assertEqual(step.get_errout(), u'oops')
+        self.assertEqual(step.extra_info, {u'tests': 12})
+        self.assertEqual(os.listdir(self.running_root), [])
+        # Finished steps can't be changed.
+        self.assertEqual(self.post(progress, {u'id': step_id, u'output': u'x'}).status_code, 409)
+
+        r = self.client.delete(progress)
+        self.assertEqual(r.status_code, 204)
+        self.assert_(r['Location'].endswith('/pony/builds/%s' % build.pk))
+
+        build = Build.objects.get(pk=build.pk)
+        self.failIf(build.in_progress)
+        self.assert_(build.success)
+        self.assertEqual(build.finished, step.finished)
+        self.assertEqual(Project.objects.get(slug='pony').latest_build, build)
+        self.assertEqual(TagUsage.objects.get(tag__name='live').builds, 1)
+        r = self.client.get('/pony/tags/live?format=json')
+        self.assertEqual(simplejson.loads(r.content)['count'], 1)
+        r = self.client.get('/pony/builds?format=json')
+        self.assertEqual(simplejson.loads(r.content)['count'], 2)
+        r = self.client.get('/pony/builds/%s?format=json' % build.pk)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(simplejson.loads(r.content)['results'][1]['output'],
+                         u'one\ntwo \u2713\n' + output)
+
+        for method in ('get', 'delete'):
+            self.assertEqual(getattr(self.client, method)(progress).status_code, 410)
+        self.assertEqual(self.post(progress, {u'name': u'late'}).status_code, 410)
+
+    def test_unfinished_steps_fail(self):
+        progress = self.open_build()
+        step_id, output_url = self.start_step(progress, u'hang', output=u'waiting\n')
+        self.assertEqual(self.client.delete(progress).status_code, 204)
+        step = BuildStep.objects.get(pk=step_id)
+        self.failIf(step.in_progress)
+        self.failIf(step.success)
+        self.assertEqual(step.get_output(), u'waiting\n')
+        self.failIf(step.build.success)
+        self.assertEqual(step.build.finished, step.started)
+
+    def test_bad_steps(self):
+        progress = self.open_build()
+        self.assertEqual(self.post(progress, {u'output': u'no name'}).status_code, 400)
+        step_id, output_url = self.start_step(progress, u'test')
+        r = self.post(progress, {u'id': step_id, u'output': u'x', u'finished': u'whenever',
+                                 u'success': True})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.client.get(output_url).content, '')
+        self.assertEqual(self.post(progress, {u'id': 12345}).status_code, 404)
+
+    def test_only_the_builds_user_can_report(self):
+        auth = "Basic %s" % "testclient:password".encode("base64").strip()
+        progress = self.open_build(HTTP_AUTHORIZATION=auth)
+        self.assertEqual(Build.objects.get(in_progress=True).user.username, 'testclient')
+        self.assertEqual(self.post(progress, {u'name': u'test'}).status_code, 403)
+        self.assertEqual(self.client.delete(progress).status_code, 403)
+        self.start_step(progress, u'test', HTTP_AUTHORIZATION=auth)
+        r = self.client.delete(progress, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(r.status_code, 204)
+
+    def test_open_streamed(self):
+        settings.DEVMASON_STREAMING_THRESHOLD = 0
+        try:
+            progress = self.open_build()
+        finally:
+            del settings.DEVMASON_STREAMING_THRESHOLD
+        self.assertEqual(self.client.get(progress + '?format=json').status_code, 200)
+
+    def test_follow_log(self):
+        progress = self.open_build()
+        step_id, output_url = self.start_step(progress, u'test', output=u'one\n')
+
+        r = self.client.get(output_url + '?offset=0')
+        self.assertEqual(r.content, 'one\n')
+        self.assertEqual((r['X-Log-Offset'], r['X-Log-Running']), ('4', '1'))
+        self.assertEqual(r['Cache-Control'], 'no-cache')
+        r = self.client.get(output_url + '?offset=4')
+        self.assertEqual(r.content, '')
+        self.assertEqual((r['X-Log-Offset'], r['X-Log-Running']), ('4', '1'))
+
+        self.post(progress, {u'id': step_id, u'output': u'two\n'})
+        r = self.client.get(output_url + '?offset=4')
+        self.assertEqual(r.content, 'two\n')
+        self.assertEqual(r['X-Log-Offset'], '8')
+        self.assertEqual(self.client.get(output_url + '?offset=-1').status_code, 400)
+
+        self.post(progress, {u'id': step_id, u'output': u'three\n', u'success': True,
+                             u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500'})
+        r = self.client.get(output_url + '?offset=8')
+        self.assertEqual(r.content, 'three\n')
+        self.assertEqual((r['X-Log-Offset'], r['X-Log-Running']), ('14', '0'))
+
+    def test_log_events(self):
+        progress = self.open_build()
+        text = u'caf\xe9 \u2713\n' * 3
+        step_id, output_url = self.start_step(progress, u'test', output=text)
+
+        def events(**extra):
+            r = self.client.get(output_url, HTTP_ACCEPT='text/event-stream', **extra)
+            self.assertEqual(r['Content-Type'], 'text/event-stream')
+            return [dict(line.split(': ', 1) for line in event.split('\n'))
+                    for event in r.content.split('\n\n') if event]
+
+        old_size, views.READ_SIZE = views.READ_SIZE, 4
+        try:
+            # Pieces of output end with whole characters.
+            running = events()
+            self.assertEqual(u''.join(simplejson.loads(e['data']) for e in running), text)
+            self.assertEqual(int(running[-1]['id']), len(text.encode('utf-8')))
+            self.failIf([e for e in running if 'event' in e])
+
+            self.post(progress, {u'id': step_id, u'output': u'done\n', u'success': True,
+                                 u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500'})
+            finished = events(HTTP_LAST_EVENT_ID=running[-1]['id'])
+        finally:
+            views.READ_SIZE = old_size
+        self.assertEqual(u''.join(simplejson.loads(e['data']) for e in finished[:-1]), u'done\n')
+        self.assertEqual(finished[-1], {'event': 'end',
+                                        'data': str(len((text + u'done\n').encode('utf-8')))})
+
+class BuildRequestLeaseTests(PonyTests):
+    def setUp(self):
+        super(BuildRequestLeaseTests, self).setUp()
+        self.repo = Repository.objects.create(project=Project.objects.get(slug='pony'),
+                                              url='git://example.com/pony.git', type='git')
+        now = datetime.datetime.now()
+        for i, arch in enumerate(['', 'linux-i386', 'macosx', '', 'linux-i386']):
+            BuildRequest.objects.create(repository=self.repo, identifier='rev%s' % i, arch=arch,
+                                        requested=now - datetime.timedelta(minutes=10 - i))
+
+    def test_lease_oldest_for_arch(self):
+        leased = BuildRequest.objects.lease('linux-i386', 'worker1', 3)
+        self.assertEqual([r.identifier for r in leased], ['rev0', 'rev1', 'rev3'])
+        self.assertEqual(len(set(r.lease_token for r in leased)), 1)
+
+        # Nobody else gets the same requests.
+        leased = BuildRequest.objects.lease('linux-i386', 'worker2', 3)
+        self.assertEqual([r.identifier for r in leased], ['rev4'])
+        leased = BuildRequest.objects.lease('macosx', 'worker3', 3)
+        self.assertEqual([r.identifier for r in leased], ['rev2'])
+
+    def test_expired_leases_are_reclaimed(self):
+        first = BuildRequest.objects.lease('macosx', 'worker1', 1)[0]
+        BuildRequest.objects.filter(pk=first.pk).update(
+            available_at=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        second = BuildRequest.objects.lease('macosx', 'worker2', 1)[0]
+        self.assertEqual(first.pk, second.pk)
+
+        # The first worker's lease is gone.
+        self.failIf(BuildRequest.objects.complete(first.pk, first.lease_token))
+        self.assert_(BuildRequest.objects.complete(second.pk, second.lease_token))
+        leased = BuildRequest.objects.lease('macosx', 'worker3', 5)
+        self.failIf(first.pk in [r.pk for r in leased])
+
+    def claim(self, url, data, user='testclient:password'):
+        auth = 'Basic %s' % user.encode('base64').strip()
+        return self.client.post(url, content_type='application/json',
+                                data=simplejson.dumps(data), HTTP_AUTHORIZATION=auth)
+
+    def test_rest_claim(self):
+        r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w', 'count': 5})
+        self.assertEqual(r.status_code, 200)
+        leased = simplejson.loads(r.content)['build_requests']
+        self.assertEqual([(b['identifier'], b['project'], b['vcs']) for b in leased],
+                         [('rev0', 'pony', 'git'), ('rev2', 'pony', 'git'), ('rev3', 'pony', 'git')])
+
+        url = '/builds/claim/%s/complete' % leased[0]['id']
+        r = self.claim(url, {'lease_token': 'wrong'})
+        self.assertEqual(r.status_code, 409)
+        r = self.claim(url, {'lease_token': leased[0]['lease_token']})
+        self.assertEqual(r.status_code, 204)
+        self.assert_(BuildRequest.objects.get(pk=leased[0]['id']).completed)
+
+        r = self.claim('/builds/claim', {'worker': 'w'})
+        self.assertEqual(r.status_code, 400)
+
+    def test_rest_claim_requires_auth(self):
+        r = self.client.post('/builds/claim', content_type='application/json',
+                             data=simplejson.dumps({'arch': 'macosx', 'worker': 'w'}))
+        self.assertEqual(r.status_code, 401)
+        r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w'}, 'nobody:password')
+        self.assertEqual(r.status_code, 403)
+        r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w'}, 'testclient:wrong')
+        self.assertEqual(r.status_code, 403)
+
+        leased = BuildRequest.objects.lease('macosx', 'w', 1)[0]
+        r = self.client.post('/builds/claim/%s/complete' % leased.pk,
+                             content_type='application/json',
+                             data=simplejson.dumps({'lease_token': leased.lease_token}))
+        self.assertEqual(r.status_code, 401)
+        self.failIf(BuildRequest.objects.get(pk=leased.pk).completed)
+
+    def test_rest_claim_rejects_bad_counts(self):
+        for count in (0, -1, 'abc'):
+            r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w', 'count': count})
+            self.assertEqual(r.status_code, 400)
+        for lease_time in (-5, 0, '0', None):
+            r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w',
+                                             'lease_time': lease_time})
+            self.assertEqual(r.status_code, 400)
+        self.failIf(BuildRequest.objects.filter(completed__isnull=True)
+                                        .exclude(leased_by='').exists())
+        self.assertEqual(BuildRequest.objects.lease('macosx', 'w', 0), [])
+
+    def test_xmlrpc(self):
+        from ..views import check_should_build
+        info = {'package': 'pony', 'arch': 'macosx', 'host': 'example.com'}
+        self.assertEqual(check_should_build(info, True, 60)[0], True)
+        self.assertEqual(BuildRequest.objects.get(identifier='rev0').leased_by, 'example.com')
+
+        r = self.claim('/builds/claim', {'arch': 'macosx', 'worker': 'w', 'count': 5})
+        leased = simplejson.loads(r.content)['build_requests']
+        self.assertEqual([b['identifier'] for b in leased], ['rev2', 'rev3'])
+        self.assertEqual(check_should_build(info, True, 60)[0], False)
+
+        BuildRequest.objects.complete_leased_by('pony', 'example.com')
+        self.assert_(BuildRequest.objects.get(identifier='rev0').completed)
+
+    def test_xmlrpc_has_no_unauthenticated_leasing(self):
+        # XML-RPC calls carry no credentials, so leasing is REST-only.
+        methods = views.dispatcher.system_listMethods()
+        self.assert_('lease_build_requests' not in methods)
+        self.assert_('complete_build_request' not in methods)
+
+    def test_index_exists(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = 'devmason_server_buildrequest'")
+        self.assert_('devmason_server_buildrequest_lease' in [row[0] for row in cursor.fetchall()])
+
+class BuildRequestCoalescingTests(PonyTests):
+    def github_push(self, after, ref='refs/heads/master'):
+        payload = {
+            'repository': {'name': 'pony', 'url': 'http://github.com/example/pony'},
+            'ref': ref,
+            'after': after,
+        }
+        r = self.client.post('/builds/github', {'payload': simplejson.dumps(payload)})
+        self.assertEqual(r.status_code, 200)
+        return r
+
+    def test_redelivery_is_ignored(self):
+        self.github_push('a' * 40)
+        r = self.github_push('a' * 40)
+        self.assertEqual(r.content, 'Build Already Requested')
+        self.assertEqual(BuildRequest.objects.count(), 1)
+        self.assertEqual(Repository.objects.count(), 1)
+        self.assertEqual(Metric.get('build_requests.duplicate'), 1)
+
+    def test_newer_push_supersedes_pending(self):
+        self.github_push('a' * 40)
+        self.github_push('b' * 40)
+        self.github_push('c' * 40, ref='refs/heads/stable')
+        self.github_push('d' * 40)
+
+        pending = BuildRequest.objects.filter(available_at__isnull=False)
+        self.assertEqual(sorted(r.identifier for r in pending), ['c' * 40, 'd' * 40])
+        self.assertEqual(BuildRequest.objects.get(identifier='b' * 40).superseded_by.identifier,
+                         'd' * 40)
+        self.assertEqual(Metric.get('build_requests.superseded'), 2)
+
+    def test_leased_requests_are_not_superseded(self):
+        self.github_push('a' * 40)
+        leased = BuildRequest.objects.lease('linux-i386', 'worker', 1)
+        self.github_push('b' * 40)
+        self.assert_(BuildRequest.objects.complete(leased[0].pk, leased[0].lease_token))
+
+    def test_branch_deletion(self):
+        self.github_push('0' * 40)
+        self.assertEqual(BuildRequest.objects.count(), 0)
+
+class XMLRPCTests(PonyTests):
+    def call(self, method, *params):
+        r = self.client.post('/xmlrpc', xmlrpclib.dumps(params, method),
+                             content_type='text/xml')
+        self.assertEqual(r.status_code, 200)
+        return xmlrpclib.loads(r.content)[0][0]
+
+    def results(self, package, tags=('python2.6',), **info):
+        info = dict({'package': package, 'tags': list(tags), 'arch': 'linux-i386',
+                     'host': 'example.com', 'success': True}, **info)
+        return {'methodName': 'add_results', 'params': [info, [
+            {'name': 'test', 'status': 0, 'output': 'ok', 'command': 'python setup.py test'},
+        ]]}
+
+    def test_add_results(self):
+        self.assertEqual(self.call('add_results', *self.results('pony')['params']),
+                         'Processed Correctly')
+        build = Project.objects.get(slug='pony').latest_build
+        self.assertEqual(build.steps.get().extra_info['command'], 'python setup.py test')
+        self.assertEqual([t.name for t in build.tags], ['python2.6'])
+
+    def test_multicall(self):
+        calls = [self.results('pony'), self.results('New Package'), self.results('pony')]
+        self.assertEqual(self.call('system.multicall', calls), [['Processed Correctly']] * 3)
+        self.assertEqual(Build.objects.filter(project__slug='pony').count(), 3)
+        self.assertEqual(Build.objects.filter(project__slug='new-package').count(), 1)
+
+    def test_cache_is_invalidated_after_commit(self):
+        # A reader caches the new build after it's saved, but before its
+        # steps are and the call commits.
+        def read(sender, instance, **kwargs):
+            self.client.get('/pony/builds/%s?format=json' % instance.pk)
+        post_save.connect(read, sender=Build)
+        try:
+            self.call('add_results', *self.results('pony')['params'])
+        finally:
+            post_save.disconnect(read, sender=Build)
+        r = self.client.get('/pony/builds/2?format=json')
+        self.assertEqual(len(simplejson.loads(r.content)['results']), 1)
+
+    def test_bad_multicall_is_a_fault(self):
+        bad = self.results('pony')
+        del bad['params'][0]['tags']
+        self.assertRaises(xmlrpclib.Fault, self.call, 'system.multicall',
+                          [self.results('pony'), bad])
+
 class LatestBuildTests(PonyTests):
     def test_get_latest_build(self):
         r = self.client.get('/pony/builds/latest')
@@ -526,6 +1910,14 @@ class TagListTests(PonyTests):
         r = self.client.get('/pony/tags')
         self.assertJsonEqual(r, {
             u'tags': [u'django', u'python'],
+            u'usage': [
+                {u'tag': u'django',
+                 u'builds': 1,
+                 u'last_used': u'Mon, 19 Oct 2009 16:25:00 -0500'},
+                {u'tag': u'python',
+                 u'builds': 1,
+                 u'last_used': u'Mon, 19 Oct 2009 16:25:00 -0500'},
+            ],
             u'links': [
                 {u'allowed_methods': [u'GET'],
                  u'href': u'/pony/tags',
@@ -542,6 +1934,152 @@ class TagListTests(PonyTests):
             ]
         })
 
+    def usage(self):
+        r = self.client.get('/pony/tags?format=json')
+        return dict((u['tag'], (u['builds'], u['last_used']))
+                    for u in simplejson.loads(r.content)['usage'])
+
+    def test_usage_follows_builds(self):
+        response_cache.clear()
+        info = {'success': True, 'started': 'Tue, 20 Oct 2009 10:00:00 -0500',
+                'finished': 'Tue, 20 Oct 2009 11:00:00 -0500', 'tags': ['python', 'windows'],
+                'client': {'host': 'example.com', 'arch': 'win32', 'user': ''},
+                'results': []}
+        auth = "Basic %s" % "testclient:password".encode("base64").strip()
+        r = self.client.post('/pony/builds', data=simplejson.dumps(info),
+                             content_type='application/json', HTTP_AUTHORIZATION=auth)
+        self.assertEqual(r.status_code, 201)
+        self.assertEqual(self.usage(), {
+            u'django': (1, u'Mon, 19 Oct 2009 16:25:00 -0500'),
+            u'python': (2, u'Tue, 20 Oct 2009 11:00:00 -0500'),
+            u'windows': (1, u'Tue, 20 Oct 2009 11:00:00 -0500'),
+        })
+
+        for build in Build.objects.exclude(pk=1):
+            build.delete()
+        self.assertEqual(self.usage(), {
+            u'django': (1, u'Mon, 19 Oct 2009 16:25:00 -0500'),
+            u'python': (1, u'Mon, 19 Oct 2009 16:25:00 -0500'),
+        })
+
+        Build.objects.get(pk=1).tags = 'python'
+        self.assertEqual(self.usage(), {u'python': (1, u'Mon, 19 Oct 2009 16:25:00 -0500')})
+
+    def test_usage_added_concurrently_is_counted(self):
+        # Another build counted the tag after count_usage looked for it, so
+        # the insert clashes and falls back on counting it one more.
+        python = Tag.objects.get(name='python')
+        windows = Tag.objects.create(name='windows')
+        finished = datetime.datetime(2009, 10, 20, 11, 0)
+        add_usage(1, [windows.pk, python.pk], finished)
+        self.assertEqual(TagUsage.objects.get(tag=python).builds, 2)
+        self.assertEqual(TagUsage.objects.get(tag=python).last_used, finished)
+        self.assertEqual(TagUsage.objects.get(tag=windows).builds, 1)
+
+    def test_tag_created_concurrently_is_used(self):
+        # The tag is made by another build after bulk_tag looked for it.
+        build = Build.objects.create(project=Project.objects.get(slug='pony'), success=True,
+                                     started=datetime.datetime(2009, 10, 20, 11, 0),
+                                     finished=datetime.datetime(2009, 10, 20, 11, 5))
+        Tag.objects.filter = lambda **kwargs: []
+        try:
+            tags = bulk_tag(build, 'python')
+        finally:
+            del Tag.objects.filter
+        self.assertEqual(tags, [Tag.objects.get(name='python')])
+        self.assertEqual([t.name for t in build.tags], ['python'])
+
+    def test_rebuild_tag_index_recounts(self):
+        TagUsage.objects.all().delete()
+        call_command('rebuild_tag_index', verbosity=0)
+        self.assertEqual(self.usage(), {
+            u'django': (1, u'Mon, 19 Oct 2009 16:25:00 -0500'),
+            u'python': (1, u'Mon, 19 Oct 2009 16:25:00 -0500'),
+        })
+
+class ProjectStatsTests(PonyTests):
+    def post_build(self, success, started, minutes, arch='linux-i386', host='example.com'):
+        finished = started + datetime.timedelta(minutes=minutes)
+        build = {
+            'success': success,
+            'started': started.strftime('%a, %d %b %Y %H:%M:%S'),
+            'finished': finished.strftime('%a, %d %b %Y %H:%M:%S'),
+            'client': {'host': host, 'arch': arch},
+            'results': [],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+
+    def stats(self, query=''):
+        r = self.client.get('/pony/stats?format=json' + query)
+        self.assertEqual(r.status_code, 200)
+        return simplejson.loads(r.content)['stats']
+
+    def test_stats_by_day_and_week(self):
+        monday = datetime.datetime(2010, 3, 1, 12, 0)
+        self.post_build(True, monday, 3)
+        self.post_build(False, monday, 10, arch='win32', host='windows.example.com')
+        self.post_build(True, monday + datetime.timedelta(days=2), 3)
+
+        days = self.stats()
+        self.assertEqual([d['start'] for d in days], ['2010-03-03', '2010-03-01'])
+        self.assertEqual(days[1]['builds'], 2)
+        self.assertEqual(days[1]['pass_rate'], 0.5)
+        self.assertEqual(days[1]['duration']['mean'], 390.0)
+        # Durations are bucketed, so percentiles are a little over.
+        self.assert_(180 <= days[1]['duration']['p50'] < 180 * 1.2)
+        self.assert_(600 <= days[1]['duration']['p99'] < 600 * 1.2)
+        self.assertEqual(days[1]['arch']['win32']['pass_rate'], 0.0)
+        self.assertEqual(days[1]['arch']['linux-i386']['builds'], 1)
+        self.assertEqual(days[1]['host']['windows.example.com']['builds'], 1)
+
+        weeks = self.stats('&period=week')
+        self.assertEqual(len(weeks), 1)
+        self.assertEqual(weeks[0]['start'], '2010-03-01')
+        self.assertEqual(weeks[0]['builds'], 3)
+        self.assertEqual(weeks[0]['arch']['linux-i386']['pass_rate'], 1.0)
+
+        self.assertEqual(len(self.stats('&count=1')), 1)
+        r = self.client.get('/pony/stats?period=fortnight&format=json')
+        self.assertEqual(r.status_code, 400)
+        for count in ('0', '-1', 'abc', ''):
+            r = self.client.get('/pony/stats?format=json&count=' + count)
+            self.assertEqual(r.status_code, 400)
+
+    def test_rollup_added_concurrently_is_added_to(self):
+        # Another build made the rollups after count_build looked for them,
+        # so making them clashes and falls back on adding to them.
+        build = Build.objects.get(pk=1)
+        count_build(build)
+        keys = rollup_keys(build)
+        add_rollups(build, keys, 180.0)
+        self.assertEqual(BuildRollup.objects.count(), len(keys))
+        self.failIf(BuildRollup.objects.exclude(builds=2, successes=2, duration=360.0))
+
+    def test_deleted_builds_are_counted_out(self):
+        monday = datetime.datetime(2010, 3, 1, 12, 0)
+        self.post_build(True, monday, 3)
+        self.post_build(False, monday, 10, arch='win32')
+        Build.objects.filter(arch='win32')[0].delete()
+        days = self.stats()
+        self.assertEqual(days[0]['builds'], 1)
+        self.assertEqual(days[0]['arch'].keys(), ['linux-i386'])
+        self.assertEqual(BuildRollup.objects.filter(dimension='arch', value='win32').count(), 0)
+
+    def test_rebuild_build_stats(self):
+        self.assertEqual(self.stats(), [])
+        call_command('rebuild_build_stats', verbosity=0, batch_size=1)
+        days = self.stats()
+        self.assertEqual([d['start'] for d in days], ['2009-10-19'])
+        self.assertEqual(days[0]['builds'], 1)
+        self.assertEqual(days[0]['duration']['mean'], 180.0)
+
+    def test_html(self):
+        self.post_build(True, datetime.datetime(2010, 3, 1, 12, 0), 3)
+        r = self.client.get('/pony/stats', HTTP_ACCEPT='text/html')
+        self.assertContains(r, '2010-03-01')
+
 class TagDetailTests(PonyTests):
     def test_get_tag_detail(self):
         r = self.client.get('/pony/tags/django')
@@ -602,4 +2140,46 @@ class LatestTagsTests(PonyTests):
 
     def test_get_latest_tagged_build_404s_with_invalid_tags(self):
         r = self.client.get('/pony/tags/nope/latest')
-        self.assertEqual(r.status_code, 404)
\ No newline at end of file
+        self.assertEqual(r.status_code, 404)
+
+class LatestBuildPointerTests(PonyTests):
+    def post_build(self):
+        build = {
+            u'success': True,
+            u'started': u'Mon, 26 Oct 2009 16:22:00 -0500',
+            u'finished': u'Mon, 26 Oct 2009 16:25:00 -0500',
+            u'client': {u'host': u'example.com', u'user': u'', u'arch': u'linux-i386'},
+            u'results': [],
+        }
+        r = self.client.post('/pony/builds', data=simplejson.dumps(build),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+        return Build.objects.order_by('-pk')[0]
+
+    def test_post_updates_latest_build(self):
+        build = self.post_build()
+        self.assertEqual(Project.objects.get(slug='pony').latest_build, build)
+
+    def test_deleting_latest_build_keeps_project(self):
+        build = self.post_build()
+        build.delete()
+        project = Project.objects.get(slug='pony')
+        self.assertEqual(project.latest_build_id, 1)
+
+    def test_queryset_delete_keeps_project(self):
+        # Queryset deletes (and the admin's bulk delete) skip Build.delete.
+        build = self.post_build()
+        Build.objects.filter(pk=build.pk).delete()
+        project = Project.objects.get(slug='pony')
+        self.assertEqual(project.latest_build_id, 1)
+        self.assertEqual(project.builds.count(), 1)
+
+    def test_deleting_only_build_clears_pointer(self):
+        Build.objects.all().delete()
+        project = Project.objects.get(slug='pony')
+        self.assertEqual(project.latest_build_id, None)
+
+    def test_backfill_latest_builds(self):
+        Project.objects.update(latest_build_id=None)
+        call_command('backfill_latest_builds', verbosity=0)
+        self.assertEqual(Project.objects.get(slug='pony').latest_build_id, 1)
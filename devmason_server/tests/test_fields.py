@@ -0,0 +1,47 @@
+from django.db import connection
+from django.test import TestCase
+from ..models import Build
+
+class JSONFieldTests(TestCase):
+    fixtures = ['devmason_server_test_data']
+
+    def raw_extra_info(self, pk):
+        cursor = connection.cursor()
+        cursor.execute("SELECT extra_info FROM devmason_server_build WHERE id = %s", [pk])
+        return cursor.fetchone()[0]
+
+    def set_raw_extra_info(self, pk, text):
+        Build.objects.filter(pk=pk).update(extra_info=text)
+
+    def test_decoded_on_access(self):
+        self.set_raw_extra_info(1, '{"python": "2.6"}')
+        build = Build.objects.get(pk=1)
+        self.assertEqual(build.__dict__.get('extra_info'), None)
+        self.assertEqual(build.extra_info, {'python': '2.6'})
+
+    def test_unread_text_saved_untouched(self):
+        # Not how the encoder would write it, so a re-encode would show.
+        self.set_raw_extra_info(1, '{"b":1,   "a":2}')
+        build = Build.objects.get(pk=1)
+        build.success = False
+        build.save()
+        self.assertEqual(self.raw_extra_info(1), '{"b":1,   "a":2}')
+
+    def test_read_value_saved_encoded(self):
+        build = Build.objects.get(pk=1)
+        build.extra_info['python'] = '2.6'
+        build.save()
+        self.assertEqual(Build.objects.get(pk=1).extra_info['python'], '2.6')
+
+    def test_assigning_json_text(self):
+        build = Build(extra_info='{"a": [1, 2]}')
+        self.assertEqual(build.extra_info, {'a': [1, 2]})
+        self.assertEqual(Build().extra_info, {})
+
+    def test_python_literals(self):
+        self.set_raw_extra_info(1, "{u'a': u'b'}")
+        self.assertEqual(Build.objects.get(pk=1).extra_info, {'a': 'b'})
+
+        # Anything else is left alone rather than evaluated.
+        self.set_raw_extra_info(1, "__import__('os').getcwd()")
+        self.assertEqual(Build.objects.get(pk=1).extra_info, "__import__('os').getcwd()")
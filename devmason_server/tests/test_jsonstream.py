@@ -0,0 +1,38 @@
+from StringIO import StringIO
+from django.test import TestCase
+from django.utils import simplejson
+from ..jsonstream import JSONStreamReader, JSONStreamError
+
+DOCUMENTS = [
+    u'{}',
+    u'[]',
+    u' { "a" : [1, -2, 3.5, 1e3, true, false, null], "b": {"c": ""} } ',
+    u'{"text": "line\\nbreak \\"quoted\\" \\\\ \\/ \\t\\u00e9\\ud83d\\ude00"}',
+    u'{"unicode": "\u00e9\u4e2d\u6587", "nested": [[{"x": [{}]}]]}',
+]
+
+class JSONStreamReaderTests(TestCase):
+    def read(self, text, chunk_size):
+        reader = JSONStreamReader(StringIO(text.encode('utf-8')), chunk_size)
+        value = reader.read_value()
+        reader.finish()
+        return value
+
+    def test_matches_simplejson_at_any_chunk_size(self):
+        for doc in DOCUMENTS:
+            for chunk_size in (1, 2, 3, 7, 4096):
+                self.assertEqual(self.read(doc, chunk_size), simplejson.loads(doc))
+
+    def test_read_string_in_pieces(self):
+        output = u'x' * 1000 + u'\u00e9' * 1000
+        doc = simplejson.dumps({'output': output})
+        reader = JSONStreamReader(StringIO(doc), chunk_size=64)
+        pieces = []
+        for key in reader.iter_object():
+            reader.read_string(pieces.append)
+        self.assertEqual(u''.join(pieces), output)
+        self.assert_(max(len(p) for p in pieces) <= 64)
+
+    def test_invalid_documents(self):
+        for doc in (u'', u'{', u'{"a" 1}', u'[1,]', u'{"a": tru}', u'"abc', u'{} {}', u'"\\x"'):
+            self.assertRaises(JSONStreamError, self.read, doc, 2)
@@ -0,0 +1,314 @@
+"""
+Checks the query plans behind every URL.
+
+Each test makes a request against a seeded database while recording every
+query it issues, then asks SQLite to EXPLAIN QUERY PLAN each of them. Any
+query that scans the whole of one of the tables that grow with use, or has
+to sort rows in a temporary B-tree, fails the test -- so a handler change
+that needs a new index, or an index that goes missing, shows up here.
+"""
+
+import os
+import base64
+import shutil
+import datetime
+import tempfile
+import xmlrpclib
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, Client
+from django.utils import simplejson
+from ..models import Build, BuildRequest, BuildStep, Project, Repository
+from ..responsecache import response_cache
+
+# The tables that grow with every build; a scan of any other table only
+# ever touches a handful of rows.
+HOT_TABLES = (
+    'devmason_server_build',
+    'devmason_server_buildstep',
+    'devmason_server_buildrequest',
+    'devmason_server_buildlog',
+    'tagging_taggeditem',
+    'devmason_server_buildtag',
+    'devmason_server_buildrollup',
+)
+
+class RecordingCursor(object):
+    """Passes queries on to a real cursor, noting each one and its parameters."""
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        self.queries.append((sql, tuple(params or ())))
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def query_plan(sql, params):
+    """SQLite's plan for a query, as a list of its steps' descriptions."""
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+def plan_problems(sql, plan):
+    """The steps of the query plan for `sql` that won't scale."""
+    sorts = [step for step in plan if 'TEMP B-TREE' in step]
+    # A scan that already produces rows in the order asked for can stop as
+    # soon as it has LIMIT of them.
+    stops_early = ' LIMIT ' in sql and not sorts
+    problems = list(sorts)
+    for step in plan:
+        words = step.split()
+        if words[0] == 'SCAN':
+            # "SCAN TABLE t" on older SQLites, "SCAN t" on newer ones.
+            table = words[1] == 'TABLE' and words[2] or words[1]
+            if table in HOT_TABLES and 'INDEX' not in words and not stops_early:
+                problems.append(step)
+    return problems
+
+class QueryPlanTests(TransactionTestCase):
+    # Not a TestCase: the sqlite3 module commits before running anything
+    # but DML, EXPLAIN included, so each test's data can't be rolled back.
+    urls = 'devmason_server.urls'
+    fixtures = ['authtestdata', 'devmason_server_test_data']
+
+    def setUp(self):
+        self.client = Client(HTTP_ACCEPT='application/json')
+        response_cache.clear()
+        self.auth = 'Basic %s' % base64.b64encode('testclient:password')
+
+        project = Project.objects.get(slug='pony')
+        start = datetime.datetime(2010, 1, 1)
+        for i in range(30):
+            build = Build.objects.create(project=project, success=bool(i % 3),
+                                         started=start + datetime.timedelta(hours=i),
+                                         finished=start + datetime.timedelta(hours=i, minutes=5),
+                                         host='example.com', arch='linux-i386')
+            build.tags = i % 2 and 'python, django' or 'python'
+            for n in range(3):
+                BuildStep.objects.create(build=build, success=True, name='step %s' % n,
+                                         started=build.started + datetime.timedelta(minutes=n),
+                                         finished=build.started + datetime.timedelta(minutes=n + 1))
+        project.latest_build_id = build.pk
+        project.save()
+
+        self.repo = Repository.objects.create(project=project, type='git',
+                                              url='git://github.com/example/pony')
+        for i in range(10):
+            BuildRequest.objects.request(self.repo, 'rev%s' % i, i % 2 and 'master' or '')
+
+        self.queries = []
+
+    def record(self, method, url, *args, **kwargs):
+        """Make a request, recording the queries it makes."""
+        cursor = connection.cursor
+        connection.cursor = lambda: RecordingCursor(cursor(), self.queries)
+        try:
+            response = getattr(self.client, method)(url, *args, **kwargs)
+        finally:
+            del connection.cursor
+        self.assert_(response.status_code < 500, response.content)
+        return response
+
+    def assertPlansScale(self, tolerate=()):
+        """
+        Fail if any query recorded so far won't scale, apart from the plan
+        steps in `tolerate`.
+        """
+        self.assert_(self.queries)
+        failures = []
+        for sql, params in self.queries:
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            problems = [step for step in plan_problems(sql, query_plan(sql, params))
+                        if step not in tolerate]
+            if problems:
+                failures.append('%s\n    %s' % (sql, '\n    '.join(problems)))
+        if failures:
+            self.fail('Queries that won\'t scale:\n' + '\n'.join(failures))
+
+    def test_project_list(self):
+        self.record('get', '/')
+        self.assertPlansScale()
+
+    def test_project_detail(self):
+        self.record('get', '/pony')
+        self.record('get', '/pony?format=html')
+        self.assertPlansScale()
+
+    def test_project_build_list(self):
+        self.record('get', '/pony/builds?format=json')
+        self.record('get', '/pony/builds?page=2&per_page=5&format=json')
+        self.assertPlansScale()
+
+    def test_project_build_list_cursor(self):
+        r = self.record('get', '/pony/builds?after=&per_page=5&count=1&format=json')
+        next = [l['href'] for l in simplejson.loads(r.content)['links'] if l['rel'] == 'next']
+        self.record('get', next[0] + '&format=json')
+        self.assertPlansScale()
+
+    def test_project_build_list_post(self):
+        build = {
+            'success': True,
+            'started': 'Mon, 19 Oct 2009 16:22:00 -0500',
+            'finished': 'Mon, 19 Oct 2009 16:25:00 -0500',
+            'tags': ['python'],
+            'client': {'host': 'example.com', 'arch': 'linux-i386'},
+            'results': [{'success': True, 'name': 'test', 'output': 'ok',
+                         'started': 'Mon, 19 Oct 2009 16:22:00 -0500',
+                         'finished': 'Mon, 19 Oct 2009 16:25:00 -0500'}],
+        }
+        r = self.record('post', '/pony/builds', data=simplejson.dumps(build),
+                        content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 201)
+        self.assertPlansScale()
+
+    def test_build_detail(self):
+        build = Project.objects.get(slug='pony').latest_build
+        self.record('get', '/pony/builds/%s' % build.pk)
+        self.record('get', '/pony/builds/%s?summary=1' % build.pk)
+        self.record('get', '/pony/builds/%s?format=html' % build.pk)
+        self.assertPlansScale()
+
+    def test_step_log(self):
+        step = Project.objects.get(slug='pony').latest_build.steps.all()[0]
+        self.record('get', '/pony/builds/%s/steps/%s/output?tail=10' % (step.build_id, step.pk))
+        self.assertPlansScale()
+
+    def test_build_progress(self):
+        settings.DEVMASON_RUNNING_LOG_ROOT = tempfile.mkdtemp()
+        try:
+            r = self.record('post', '/pony/builds', simplejson.dumps({
+                'incremental': True,
+                'started': 'Mon, 19 Oct 2009 16:22:00 -0500',
+                'tags': ['python'],
+                'client': {'host': 'example.com', 'arch': 'linux-i386'},
+            }), content_type='application/json')
+            progress = r['Location']
+            r = self.record('post', progress, simplejson.dumps({'name': 'test', 'output': 'ok'}),
+                            content_type='application/json')
+            step_id = int(r['Location'].split('/')[-2])
+            self.record('get', progress + '?format=json')
+            self.record('get', '/pony/builds/%s/steps/%s/output?offset=0' % (
+                progress.split('/')[-2], step_id))
+            self.record('post', progress, simplejson.dumps({
+                'id': step_id, 'success': True, 'finished': 'Mon, 19 Oct 2009 16:25:00 -0500',
+            }), content_type='application/json')
+            self.record('delete', progress)
+        finally:
+            shutil.rmtree(settings.DEVMASON_RUNNING_LOG_ROOT)
+            del settings.DEVMASON_RUNNING_LOG_ROOT
+        self.assertPlansScale()
+
+    def test_latest_build(self):
+        self.record('get', '/pony/builds/latest')
+        self.assertPlansScale()
+
+    def test_queued_build(self):
+        settings.DEVMASON_INGEST_QUEUE = tempfile.mkdtemp()
+        try:
+            self.record('get', '/pony/builds/queued/1-unknown')
+            # Reading the queue doesn't make its directories.
+            self.assertEqual(os.listdir(settings.DEVMASON_INGEST_QUEUE), [])
+        finally:
+            shutil.rmtree(settings.DEVMASON_INGEST_QUEUE)
+            del settings.DEVMASON_INGEST_QUEUE
+        self.assertPlansScale()
+
+    def test_project_stats(self):
+        call_command('rebuild_build_stats', verbosity=0)
+        self.record('get', '/pony/stats?format=json')
+        self.record('get', '/pony/stats?period=week&format=json')
+        self.assertPlansScale()
+
+    def test_project_tag_list(self):
+        self.record('get', '/pony/tags')
+        self.assertPlansScale()
+
+    def test_tag_detail(self):
+        self.record('get', '/pony/tags/python;django?per_page=5&page=2&format=json')
+        self.record('get', '/pony/tags/python?after=&per_page=5&format=json')
+        self.assertPlansScale()
+
+    def test_latest_tagged_build(self):
+        self.record('get', '/pony/tags/django/latest')
+        self.assertPlansScale()
+
+    def test_claim_project(self):
+        self.client.login(username='testclient', password='password')
+        self.record('get', '/pony/claim')
+        self.assertPlansScale()
+
+    def test_view_stats(self):
+        self.client.login(username='testclient', password='password')
+        self.record('get', '/stats/views')
+        self.assertPlansScale()
+
+    def test_project_add(self):
+        self.record('post', '/add_project', {'name': 'Horse',
+                                             'source_repo': 'git://github.com/example/horse'})
+        self.assertPlansScale()
+
+    def webhook_payload(self):
+        return {'payload': simplejson.dumps({
+            'repository': {'name': 'pony', 'url': 'http://github.com/example/pony',
+                           'absolute_url': '/example/pony/'},
+            'ref': 'refs/heads/master',
+            'after': 'a' * 40,
+            'commits': [{'node': 'b' * 12, 'branch': 'default'}],
+        })}
+
+    def test_github_build(self):
+        self.record('post', '/builds/github', self.webhook_payload())
+        self.assertPlansScale()
+
+    def test_bitbucket_build(self):
+        self.record('post', '/builds/bitbucket', self.webhook_payload())
+        self.assertPlansScale()
+
+    def test_request_build(self):
+        self.record('post', '/builds/request',
+                    simplejson.dumps({'project': 'pony', 'identifier': 'c' * 40}),
+                    content_type='application/json')
+        self.assertPlansScale()
+
+    def lease(self):
+        r = self.client.post('/builds/claim',
+                             simplejson.dumps({'arch': 'linux-i386', 'worker': 'w1', 'count': 2}),
+                             content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        return simplejson.loads(r.content)['build_requests'][0]
+
+    def test_lease_build_requests(self):
+        self.record('post', '/builds/claim',
+                    simplejson.dumps({'arch': 'linux-i386', 'worker': 'w1', 'count': 2}),
+                    content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        self.assertPlansScale()
+
+    def test_complete_build_request(self):
+        leased = self.lease()
+        self.record('post', '/builds/claim/%s/complete' % leased['id'],
+                    simplejson.dumps({'lease_token': leased['lease_token']}),
+                    content_type='application/json', HTTP_AUTHORIZATION=self.auth)
+        self.assertPlansScale()
+
+    def test_xmlrpc(self):
+        info = {'package': 'pony', 'tags': ['python'], 'arch': 'linux-i386',
+                'host': 'example.com', 'success': True}
+        results = [{'name': 'test', 'status': 0, 'output': 'ok'}]
+        self.record('post', '/xmlrpc', xmlrpclib.dumps((info, results), 'add_results'),
+                    content_type='text/xml')
+        self.assertPlansScale()
+
+    def test_every_url_is_checked(self):
+        # Each named URL gets a test named after it.
+        names = set(p.name for p in urlresolvers.get_resolver(self.urls).url_patterns)
+        untested = [n for n in names if not hasattr(self, 'test_%s' % n)]
+        self.assertEqual(untested, [])
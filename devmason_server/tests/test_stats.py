@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import Client
+from django.utils import simplejson
+from ..models import Project
+from ..stats import Histogram, view_stats
+from .test_api import PonyTests
+
+class HistogramTests(PonyTests):
+    def test_rolling_window(self):
+        h = Histogram(10)
+        for value in range(100):
+            h.add(value)
+        summary = h.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['total'], sum(range(100)))
+        self.assertEqual(summary['window'], 10)
+        self.assertEqual((summary['min'], summary['p50'], summary['max']), (90, 95, 99))
+
+    def test_empty(self):
+        self.assertEqual(Histogram(10).summary(), {'count': 0, 'total': 0})
+
+class StatsMiddlewareTests(PonyTests):
+    def setUp(self):
+        super(StatsMiddlewareTests, self).setUp()
+        self.old_middleware = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES = tuple(self.old_middleware) + \
+                                      ('devmason_server.stats.StatsMiddleware',)
+        # A new client loads the middleware afresh.
+        self.client = Client(HTTP_ACCEPT='application/json')
+        view_stats.reset()
+        settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS = True
+
+    def tearDown(self):
+        settings.MIDDLEWARE_CLASSES = self.old_middleware
+        del settings.DEVMASON_RESPONSE_CACHE_SINGLE_PROCESS
+
+    def test_stats_by_url_name(self):
+        self.client.get('/pony/builds?format=json')
+        self.client.get('/pony/builds?format=json')
+        self.client.get('/pony/builds/1?format=json')
+        stats = view_stats.snapshot()
+        self.assertEqual(stats['project_build_list']['time']['count'], 2)
+        self.assertEqual(stats['build_detail']['time']['count'], 1)
+
+        build_list = stats['project_build_list']
+        self.assert_(build_list['queries']['max'] > 0)
+        self.assert_(build_list['size']['min'] > 0)
+        self.assert_(build_list['render_time']['max'] > 0)
+        # The second request was answered from the response cache.
+        self.assertEqual(build_list['queries']['min'], 0)
+
+    def test_endpoint_is_staff_only(self):
+        self.assertEqual(self.client.get('/stats/views').status_code, 403)
+
+        User.objects.filter(username='testclient').update(is_staff=True)
+        self.client.login(username='testclient', password='password')
+        self.client.get('/pony')
+        stats = simplejson.loads(self.client.get('/stats/views').content)
+        self.assertEqual(stats['project_detail']['time']['count'], 1)
+
+class QueryBudgetTests(PonyTests):
+    def test_read_budgets(self):
+        self.assertQueryBudget(6, '/?format=json')
+        self.assertQueryBudget(1, '/pony?format=json')
+        self.assertQueryBudget(8, '/pony/builds?format=json')
+        self.assertQueryBudget(6, '/pony/builds?after=&format=json')
+        self.assertQueryBudget(5, '/pony/builds/1?format=json')
+        self.assertQueryBudget(4, '/pony/tags?format=json')
+        self.assertQueryBudget(9, '/pony/tags/python?format=json')
+
+    def test_over_budget(self):
+        self.assertRaises(AssertionError, self.assertQueryBudget, 0, '/pony?format=json')
+
+class BenchmarkCommandTests(PonyTests):
+    def setUp(self):
+        super(BenchmarkCommandTests, self).setUp()
+        self.log_root = tempfile.mkdtemp()
+        settings.DEVMASON_LOG_ROOT = self.log_root
+
+    def tearDown(self):
+        del settings.DEVMASON_LOG_ROOT
+        shutil.rmtree(self.log_root)
+
+    def test_generate_and_benchmark(self):
+        call_command('generate_builds', projects=2, builds=30, steps=3, log_size=200,
+                     verbosity=0)
+        project = Project.objects.get(slug='generated-1')
+        self.assertEqual(project.builds.count(), 30)
+        self.assertEqual(project.latest_build.steps.count(), 3)
+        self.assert_(project.latest_build.tags)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('benchmark_reads', requests=2, output=path, verbosity=0)
+            report = simplejson.load(open(path))
+        finally:
+            os.unlink(path)
+        self.assertEqual(report['builds'], 30)
+        routes = set(r['route'] for r in report['results'])
+        self.assert_('tag_detail' in routes and 'build_detail' in routes)
+        for result in report['results']:
+            self.assertEqual(result['latency_ms']['count'], 2)
+            self.assert_('5' not in [s[0] for s in result['statuses']], result)
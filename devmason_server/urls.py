@@ -27,6 +27,20 @@ urlpatterns = patterns('',
         'devmason_server.views.xmlrpc',
         name='xmlrpc'
     ),
+    url(r'^stats/views$',
+        'devmason_server.views.stats',
+        name = 'view_stats'
+    ),
+    url(r'^builds/claim$',
+        Resource(handlers.BuildRequestLeaseHandler),
+        {'emitter_format': 'json'},
+        name = 'lease_build_requests'
+    ),
+    url(r'^builds/claim/(?P<request_id>\d+)/complete$',
+        Resource(handlers.BuildRequestCompleteHandler),
+        {'emitter_format': 'json'},
+        name = 'complete_build_request'
+    ),
     url(r'^(?P<slug>[\w-]+)$',
         Resource(handlers.ProjectHandler),
         name = 'project_detail'
@@ -43,10 +57,26 @@ urlpatterns = patterns('',
         Resource(handlers.BuildHandler),
         name = 'build_detail'
     ),
+    url(r'^(?P<slug>[\w-]+)/builds/(?P<build_id>\d+)/progress$',
+        Resource(handlers.BuildProgressHandler),
+        name = 'build_progress'
+    ),
+    url(r'^(?P<slug>[\w-]+)/builds/(?P<build_id>\d+)/steps/(?P<step_id>\d+)/(?P<stream>output|errout)$',
+        'devmason_server.views.step_log',
+        name = 'step_log'
+    ),
+    url(r'^(?P<slug>[\w-]+)/builds/queued/(?P<entry_id>[\w-]+)$',
+        Resource(handlers.QueuedBuildHandler),
+        name = 'queued_build'
+    ),
     url(r'^(?P<slug>[\w-]+)/builds/latest$',
         Resource(handlers.LatestBuildHandler),
         name = 'latest_build'
     ),
+    url(r'^(?P<slug>[\w-]+)/stats$',
+        Resource(handlers.ProjectStatsHandler),
+        name = 'project_stats'
+    ),
     url(r'^(?P<slug>[\w-]+)/tags$',
         Resource(handlers.ProjectTagListHandler),
         name = 'project_tag_list'
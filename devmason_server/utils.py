@@ -6,6 +6,7 @@ import unicodedata
 import re
 import time
 import datetime
+import hashlib
 import functools
 import mimeparse
 import email.utils
@@ -13,15 +14,24 @@ import piston.resource
 import piston.emitters
 import piston.handler
 import piston.utils
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.serializers.json import DateTimeAwareJSONEncoder
 from django.core import urlresolvers
 from django.http import (Http404, HttpResponse, HttpResponseRedirect,
-                         HttpResponseForbidden)
+                         HttpResponseForbidden, HttpResponseNotModified)
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.utils import dateformat
-from django.utils.http import urlencode
+from django.utils import dateformat, simplejson
+from django.utils.http import urlencode, http_date
+# Only in django-piston 0.2.3 and later, which is why setup.py asks for it.
+from piston.validate_jsonp import is_valid_jsonp_callback_value
+from .authcache import credential_cache
+from .compression import choose_encoding, compress_response, strip_encoding
+from .prefetch import BuildStream
+from .responsecache import response_cache, GLOBAL_SCOPE
+from .stats import timed_render
 
 # Try to use dateutil for maximum date-parsing niceness. Fall back to
 # hard-coded RFC2822 parsing if that's not possible.
@@ -33,6 +43,106 @@ except ImportError:
 class Resource(piston.resource.Resource):
     """Chooses an emitter based on mime types."""
 
+    def __call__(self, request, *args, **kwargs):
+        # Piston reads and parses the whole request body before calling the
+        # handler. Handlers that can read it incrementally get large uploads
+        # handed straight to them instead.
+        if request.method == 'POST' and hasattr(self.handler, 'create_streaming') \
+           and wants_streaming(request):
+            kwargs.pop('emitter_format', None)
+            response = self.handler.create_streaming(request, *args, **kwargs)
+        elif request.method == 'GET':
+            if getattr(self.handler, 'cache_responses', True):
+                response = self.cached_get(request, *args, **kwargs)
+            else:
+                response = self.get(request, *args, **kwargs)
+            return compress_response(request, response)
+        else:
+            response = super(Resource, self).__call__(request, *args, **kwargs)
+
+        # Writes through the API are committed by now, so this is the moment
+        # to drop anything cached for the project, even if the signals that
+        # fired mid-transaction let a reader cache what it saw in between.
+        if 200 <= response.status_code < 300:
+            response_cache.invalidate(kwargs.get('slug', GLOBAL_SCOPE))
+        return compress_response(request, response)
+
+    def get(self, request, *args, **kwargs):
+        if hasattr(self.handler, 'validators'):
+            return self.conditional_get(request, *args, **kwargs)
+        return super(Resource, self).__call__(request, *args, **kwargs)
+
+    def cached_get(self, request, *args, **kwargs):
+        """
+        Serve a GET from the response cache if we can, and cache it if not.
+        Entries are scoped to the project in the URL, if there is one; see
+        `devmason_server.responsecache`.
+        """
+        em_format = self.determine_emitter(request, *args, **dict(kwargs))
+        key = response_cache.make_key(request, kwargs.get('slug', GLOBAL_SCOPE), em_format)
+        # Entries are kept compressed, and handed out in whichever coding
+        # the client takes.
+        encoding = choose_encoding(request)
+        response = response_cache.get(key, encoding)
+        if response is None:
+            response = self.get(request, *args, **kwargs)
+            entry = response_cache.set(key, response)
+            if entry is not None:
+                response = response_cache.respond(entry, encoding)
+        elif response.has_header('ETag'):
+            last_modified = response.has_header('Last-Modified') and response['Last-Modified']
+            if not_modified(request, response['ETag'], last_modified):
+                not_modified_response = HttpResponseNotModified()
+                for header in ('ETag', 'Last-Modified', 'Cache-Control'):
+                    if response.has_header(header):
+                        not_modified_response[header] = response[header]
+                return not_modified_response
+        return response
+
+    def conditional_get(self, request, *args, **kwargs):
+        """
+        Handle a GET with ETag and Last-Modified validators, answering 304
+        Not Modified without running the handler if the client is up to date.
+
+        Handlers opt in with a `validators(request, *args, **kwargs)` method
+        returning an (etag, last_modified) pair -- or None if there's nothing
+        to validate against, say for a 404. Handlers marked `immutable` get
+        strong ETags and a long max-age; anything else gets weak ETags and
+        must be revalidated every time.
+        """
+        handler_kwargs = dict(kwargs)
+        em_format = self.determine_emitter(request, *args, **handler_kwargs)
+        validators = self.handler.validators(request, *args, **handler_kwargs)
+        if validators is None:
+            return super(Resource, self).__call__(request, *args, **kwargs)
+
+        token, last_modified = validators
+        # Each choice of fields is a representation of its own.
+        if 'fields' in request.GET or 'expand' in request.GET:
+            token = u'%s|fields=%s|expand=%s' % (token, request.GET.get('fields'),
+                                                 request.GET.get('expand'))
+        etag = '"%s"' % hashlib.md5((u'%s|%s' % (token, em_format)).encode('utf-8')).hexdigest()
+        if getattr(self.handler, 'immutable', False):
+            max_age = getattr(settings, 'DEVMASON_IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+            cache_control = 'public, max-age=%d' % max_age
+        else:
+            etag = 'W/' + etag
+            cache_control = 'max-age=0, must-revalidate'
+        if last_modified is not None:
+            last_modified = http_date(time.mktime(last_modified.timetuple()))
+
+        if not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = super(Resource, self).__call__(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = last_modified
+        response['Cache-Control'] = cache_control
+        return response
+
     def determine_emitter(self, request, *args, **kwargs):
         # First look for a format hardcoded into the URLconf
         em = kwargs.pop('emitter_format', None)
@@ -41,12 +151,156 @@ class Resource(piston.resource.Resource):
         if not em:
             em = request.GET.get('format', None)
 
-        # Finally fall back on HTML
-        return em or 'html'
+        # Finally fall back on HTML. Handlers get to know too; see
+        # `selected_fields`.
+        request.em_format = em or 'html'
+        return request.em_format
+
+def _strip_weak(etag):
+    # The gzip and identity versions of a response are weakly the same.
+    etag = strip_encoding(etag)
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+def not_modified(request, etag, last_modified):
+    """
+    Does the request's If-None-Match or If-Modified-Since show the client
+    already has the current representation? As in RFC 2616, If-None-Match
+    wins when both are given, and is compared weakly.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = [_strip_weak(e.strip()) for e in if_none_match.split(',')]
+        return '*' in etags or _strip_weak(etag) in etags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        since = email.utils.parsedate_tz(if_modified_since.split(';')[0])
+        modified = email.utils.parsedate_tz(last_modified)
+        if since and modified:
+            return email.utils.mktime_tz(modified) <= email.utils.mktime_tz(since)
+    return False
+
+def byte_range(request, size):
+    """
+    The single byte range in the request's Range header, as a (start, end)
+    pair with `end` exclusive, or None if there isn't one we understand --
+    in which case the whole thing should be sent. Raises ValueError if the
+    range can't be satisfied.
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            # A suffix: the last so many bytes.
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = last and min(int(last) + 1, size) or size
+    except ValueError:
+        return None
+    if not sep or start > end or (first and last and int(last) < start):
+        return None
+    if start >= size or end <= start:
+        raise ValueError("Unsatisfiable range %r" % header)
+    return start, end
+
+def _field_list(query, name):
+    if name not in query:
+        return None
+    return set(f.strip() for f in query[name].split(',') if f.strip())
+
+def requested_fields(query, handler):
+    """
+    The fields of `handler`'s representation that the request with GET
+    parameters `query` asks for, in order.
+
+    `?fields=` names the fields wanted. The fields that cost more to fill
+    in -- those in the handler's `expandable` -- can also be picked with
+    `?expand=`, which takes precedence; `?expand=` on its own keeps every
+    other field. A representation none of whose fields were asked for is
+    left whole, so that asking for some of a build's fields doesn't empty
+    out the projects alongside it.
+    """
+    fields = getattr(handler, 'fields', ())
+    wanted, expand = _field_list(query, 'fields'), _field_list(query, 'expand')
+    if wanted is not None and not wanted.intersection(fields):
+        wanted = None
+    if not fields or (wanted is None and expand is None):
+        return fields
+    expandable = getattr(handler, 'expandable', ())
+    chosen = []
+    for field in fields:
+        names = wanted
+        if field in expandable and expand is not None:
+            names = expand
+        if names is None or field in names:
+            chosen.append(field)
+    # Piston emits every model field for a handler with no fields at all.
+    return tuple(chosen) or fields
+
+class SelectedFields(object):
+    """A handler, as the emitter sees it, with only the requested `fields`."""
+
+    def __init__(self, handler, fields):
+        self.handler = handler
+        self.fields = fields
+
+    def __getattr__(self, attr):
+        return getattr(self.handler, attr)
+
+class FieldSelectingEmitter(object):
+    """
+    Mixin for emitters that emit only the fields asked for (see
+    `requested_fields`). Piston only calls a handler's method for a field
+    if the field is emitted, so nothing is worked out for fields that
+    aren't wanted.
+    """
+
+    def render(self, request):
+        self.query = request.GET
+        return super(FieldSelectingEmitter, self).render(request)
+
+    def in_typemapper(self, model, anonymous):
+        handler = super(FieldSelectingEmitter, self).in_typemapper(model, anonymous)
+        query = getattr(self, 'query', {})
+        if handler is None or ('fields' not in query and 'expand' not in query):
+            return handler
+        return SelectedFields(handler, requested_fields(query, handler))
+
+def request_emitter(request):
+    """The emitter class `request` will be answered with, or None."""
+    try:
+        emitter, ct = piston.emitters.Emitter.get(getattr(request, 'em_format', 'html'))
+    except ValueError:
+        return None
+    return emitter
+
+def selected_fields(request, handler):
+    """
+    The fields of `handler`'s representation that will be emitted for
+    `request`: `requested_fields` if its format picks fields, and all of
+    them if not -- templates use whatever they like.
+    """
+    emitter = request_emitter(request)
+    if emitter is None or not issubclass(emitter, FieldSelectingEmitter):
+        return getattr(handler, 'fields', ())
+    return requested_fields(request.GET, handler)
+
+def streams_builds(request):
+    """
+    Whether `request`'s format can write out a `BuildStream` as it goes,
+    rather than needing a list of builds.
+    """
+    return getattr(request_emitter(request), 'streams_builds', False)
 
 class HTMLTemplateEmitter(piston.emitters.Emitter):
     """Emit a resource using a good old fashioned template."""
 
+    @timed_render
     def render(self, request):
         if isinstance(self.data, HttpResponse):
             return self.data
@@ -63,6 +317,81 @@ class HTMLTemplateEmitter(piston.emitters.Emitter):
 
 piston.emitters.Emitter.register('html', HTMLTemplateEmitter, 'text/html')
 
+# Stands in for the builds of a `BuildStream` while the rest is rendered.
+STREAM_MARKER = u'devmason:streamed-builds'
+
+def _item_separator():
+    # What goes between the items of an indented list, before the newline:
+    # older simplejsons leave a trailing space.
+    text = simplejson.dumps([0, 0], indent=4)
+    return text[text.index('0') + 1:text.index('\n', text.index('0'))]
+
+ITEM_SEPARATOR = _item_separator()
+
+class JSONEmitter(FieldSelectingEmitter, piston.emitters.JSONEmitter):
+    """
+    Piston's JSON emitter, with its render time counted in view stats, and
+    only the fields asked for. A `BuildStream` in the response is streamed
+    out one build at a time.
+    """
+    streams_builds = True
+
+    @timed_render
+    def render(self, request):
+        if isinstance(self.data, dict):
+            for key, value in self.data.items():
+                if isinstance(value, BuildStream):
+                    self.query = request.GET
+                    return self.stream(request, key)
+        return super(JSONEmitter, self).render(request)
+
+    def dumps(self, data):
+        return simplejson.dumps(data, cls=DateTimeAwareJSONEncoder,
+                                ensure_ascii=False, indent=4)
+
+    def stream(self, request, key):
+        """
+        Render the response a piece at a time, serializing the builds of the
+        `BuildStream` under `key` one by one. The pieces add up to exactly
+        what piston would have rendered in one go.
+        """
+        data, builds = self.data, self.data[key]
+        # Everything else, with a marker where the builds go; the dict is
+        # changed in place so that its keys come out in the same order.
+        data[key] = STREAM_MARKER
+        try:
+            before, after = self.dumps(self.construct()).split(self.dumps(STREAM_MARKER), 1)
+        finally:
+            data[key] = builds
+        line = before[before.rfind('\n') + 1:]
+        indent = '\n' + ' ' * (len(line) - len(line.lstrip(' ')))
+        item_indent = indent + ' ' * 4
+
+        callback = request.GET.get('callback', None)
+        if not (callback and is_valid_jsonp_callback_value(callback)):
+            callback = None
+
+        def chunks():
+            if callback:
+                yield '%s(' % callback
+            yield before
+            separator = '['
+            for build in builds:
+                self.data = build
+                yield separator + item_indent + self.dumps(self.construct()).replace('\n', item_indent)
+                separator = ITEM_SEPARATOR
+            self.data = data
+            if separator == '[':
+                yield '[]'
+            else:
+                yield indent + ']'
+            yield after
+            if callback:
+                yield ')'
+        return chunks()
+
+piston.emitters.Emitter.register('json', JSONEmitter, 'application/json; charset=utf-8')
+
 class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
@@ -73,9 +402,15 @@ class HttpResponseUnauthorized(HttpResponse):
 class HttpResponseCreated(HttpResponseRedirect):
     status_code = 201
 
+class HttpResponseAccepted(HttpResponseRedirect):
+    status_code = 202
+
 class HttpResponseNoContent(HttpResponse):
     status_code = 204
 
+class HttpResponseConflict(HttpResponse):
+    status_code = 409
+
 def link(rel, to_handler, *args, **getargs):
     """
     Create a link resource - a dict with rel, href, and allowed_methods keys.
@@ -131,6 +466,28 @@ def _get_user(request):
 
     return user, password
 
+def _authenticate(request):
+    """
+    The user from the `Authorization` header, as `_get_user` finds them, and
+    whether their password is right. Existing users who check out are
+    remembered in `credential_cache`, so their password needn't be checked
+    again for a while.
+    """
+    header = request.META.get('HTTP_AUTHORIZATION')
+    if header:
+        user = credential_cache.get(header)
+        if user is not None:
+            user.is_new_user = False
+            return user, True
+
+    user, password = _get_user(request)
+    if not user or user.is_anonymous():
+        return user, False
+    verified = user.check_password(password)
+    if verified and not user.is_new_user:
+        credential_cache.add(header, user)
+    return user, verified
+
 def authentication_required(callback):
     """
     Require that a handler method be called with authentication.
@@ -143,10 +500,10 @@ def authentication_required(callback):
     """
     @functools.wraps(callback)
     def _view(self, request, *args, **kwargs):
-        user, password = _get_user(request)
+        user, verified = _authenticate(request)
         if not user or user.is_anonymous():
             return HttpResponseUnauthorized()
-        if not user.check_password(password):
+        if not verified:
             return HttpResponseForbidden()
         request.user = user
         return callback(self, request, *args, **kwargs)
@@ -161,15 +518,54 @@ def authentication_optional(callback):
     """
     @functools.wraps(callback)
     def _view(self, request, *args, **kwargs):
-        user, password = _get_user(request)
+        user, verified = _authenticate(request)
         if not user:
             return HttpResponseUnauthorized()
-        if user.is_authenticated() and not user.check_password(password):
+        if user.is_authenticated() and not verified:
             return HttpResponseForbidden()
         request.user = user
         return callback(self, request, *args, **kwargs)
     return _view
 
+def wants_streaming(request):
+    """
+    Should this request's body be streamed rather than parsed in one go?
+    True when it's at least `DEVMASON_STREAMING_THRESHOLD` bytes long; set
+    that to None to turn streaming off.
+    """
+    threshold = getattr(settings, 'DEVMASON_STREAMING_THRESHOLD', 1024 * 1024)
+    if threshold is None:
+        return False
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    return length >= threshold
+
+class LimitedReader(object):
+    """File-like wrapper that won't read past `limit` bytes of `stream`."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+def request_body(request):
+    """A file-like object for reading the raw request body incrementally."""
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    return LimitedReader(request.environ['wsgi.input'], length)
+
 def format_dt(dt):
     return dateformat.format(dt, 'r')
 
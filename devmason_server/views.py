@@ -3,20 +3,32 @@ try:
 except:
     import simplejson as json
 
+import sys
+import time
+import codecs
 import datetime
+import threading
+import xmlrpclib
 from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
 
-from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseRedirect
-from django.core.handlers.wsgi import WSGIRequest
+from django.conf import settings
+from django.shortcuts import render_to_response, get_object_or_404
+from django.db import transaction
+from django.http import (HttpResponse, HttpResponseForbidden, HttpResponseRedirect,
+                         HttpResponseBadRequest, HttpResponseNotModified)
 from django.template import RequestContext
 
 
-from devmason_server.models import Repository, BuildRequest, Project
-from devmason_server.handlers import ProjectBuildListHandler
-from devmason_server.utils import slugify
+from devmason_server.compression import compressed
+from devmason_server.models import Repository, BuildRequest, Project, BuildStep
+from devmason_server.ingest import ingest_build
+from devmason_server.logstore import LogReader, READ_SIZE
+from devmason_server.responsecache import response_cache
+from devmason_server.utils import slugify, byte_range, not_modified
 from devmason_server.forms import ProjectForm
+from devmason_server.stats import view_stats
 
+@compressed
 def add_project(request, template_name='devmason_server/add_project.html'):
     """
     Add project
@@ -51,60 +63,249 @@ def github_build(request):
     git_url = url.replace('http://', 'git://')
     hash = obj['after']
 
+    # A push that deletes a branch has nothing to build.
+    if hash.strip('0') == '':
+        return HttpResponse('Nothing to build')
+
+    branch = obj.get('ref', '')
+    if branch.startswith('refs/heads/'):
+        branch = branch[len('refs/heads/'):]
+
     project = Project.objects.get(slug=name)
     repo, created = Repository.objects.get_or_create(
          url=git_url,
-         project=project,
-         type='git',
+         defaults={'project': project, 'type': 'git'},
     )
-    brequest = BuildRequest.objects.create(
-        repository = repo,
-        identifier = hash,
-        requested = datetime.datetime.utcnow(),
-    )
-    return HttpResponse('Build Started')
+    brequest, created = BuildRequest.objects.request(repo, hash, branch)
+    return HttpResponse(created and 'Build Started' or 'Build Already Requested')
 
 def bitbucket_build(request):
     obj = json.loads(request.POST['payload'])
     rep = obj['repository']
     name = rep['name']
     url = "%s%s" % ("http://bitbucket.org",  rep['absolute_url'])
-    hash = obj['commits'][0]['node']
+    commit = obj['commits'][0]
+    hash = commit['node']
 
     project = Project.objects.get(slug=name)
     repo, created = Repository.objects.get_or_create(
          url=url,
-         project=project,
-         type='hg',
-    )
-    brequest = BuildRequest.objects.create(
-        repository = repo,
-        identifier = hash,
-        requested = datetime.datetime.utcnow(),
+         defaults={'project': project, 'type': 'hg'},
     )
-    return HttpResponse('Build Started')
+    brequest, created = BuildRequest.objects.request(repo, hash, commit.get('branch') or '')
+    return HttpResponse(created and 'Build Started' or 'Build Already Requested')
 
 def request_build(request):
     obj = json.loads(request.raw_post_data)
     project = obj['project']
     identifier = obj['identifier']
     repo = Repository.objects.get(project__slug=project)
-    brequest = BuildRequest.objects.create(
-        repository = repo,
-        identifier = identifier,
-        requested = datetime.datetime.utcnow(),
-    )
-    return HttpResponse('Build Started')
+    brequest, created = BuildRequest.objects.request(repo, identifier, obj.get('branch', ''))
+    return HttpResponse(created and 'Build Started' or 'Build Already Requested')
+
+@compressed
+def stats(request):
+    """Recent per-view request statistics, for staff. See devmason_server.stats."""
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(json.dumps(view_stats.snapshot(), sort_keys=True, indent=4),
+                        mimetype='application/json')
+
+def step_log(request, slug, build_id, step_id, stream):
+    """
+    A step's output or errout as plain text: all of it, the byte range in
+    the Range header, the last N lines with ?tail=N, or lines A to B
+    (counting from 1, inclusive) with ?lines=A-B or ?lines=A-.
+
+    Output of a running step can be followed as it's written, from a byte
+    offset; see `follow_log`.
+    """
+    step = get_object_or_404(BuildStep.objects.select_related(stream + '_log'),
+                             pk=step_id, build=build_id, build__project__slug=slug)
+    if 'offset' in request.GET or wants_events(request):
+        return follow_log(request, step, stream)
+    reader = LogReader.for_step(step, stream)
+
+    # Build output never changes once the step's finished, so its digest
+    # makes a strong ETag. Until then there's nothing to validate against.
+    etag = not step.in_progress and '"%s"' % reader.digest
+    max_age = getattr(settings, 'DEVMASON_IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+    def finish(response):
+        if etag:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'public, max-age=%d' % max_age
+        else:
+            response['Cache-Control'] = 'no-cache'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+    if etag and not_modified(request, etag, None):
+        return finish(HttpResponseNotModified())
+
+    mimetype = 'text/plain; charset=utf-8'
+    if 'tail' in request.GET or 'lines' in request.GET:
+        try:
+            if 'tail' in request.GET:
+                count = int(request.GET['tail'])
+                first = max(0, reader.lines - count)
+            else:
+                first, sep, last = request.GET['lines'].partition('-')
+                first = int(first) - 1
+                count = last and int(last) - first or None
+            if first < 0 or (count is not None and count < 0):
+                raise ValueError
+        except ValueError:
+            return HttpResponseBadRequest("tail must be a number of lines, "
+                                          "and lines a range like 10-20")
+        return finish(HttpResponse(reader.iter_lines(first, count), mimetype=mimetype))
+
+    try:
+        requested = byte_range(request, reader.size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % reader.size
+        return finish(response)
+    if requested is None:
+        response = HttpResponse(reader.iter_range(0, reader.size), mimetype=mimetype)
+    else:
+        start, end = requested
+        response = HttpResponse(reader.iter_range(start, end), mimetype=mimetype, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, reader.size)
+    response['Content-Length'] = str(requested and requested[1] - requested[0] or reader.size)
+    return finish(response)
+
+def wants_events(request):
+    return 'text/event-stream' in request.META.get('HTTP_ACCEPT', '')
+
+def tail_timeout():
+    """How long to hold a request following a running step's output open for."""
+    return getattr(settings, 'DEVMASON_TAIL_TIMEOUT', 30)
+
+def wait_for_output(step, stream, offset, timeout):
+    """
+    Wait up to `timeout` seconds for a running `step`'s `stream` to grow past
+    `offset` bytes, or for the step to finish. Returns the step as it is by
+    then, and a reader for the stream.
+    """
+    deadline = time.time() + timeout
+    interval = getattr(settings, 'DEVMASON_TAIL_INTERVAL', 0.5)
+    while True:
+        reader = LogReader.for_step(step, stream)
+        if reader.size > offset or not step.in_progress or time.time() >= deadline:
+            return step, reader
+        time.sleep(max(0, min(interval, deadline - time.time())))
+        # A running step's output has no file until there's some, and it's
+        # moved to log storage when the step finishes.
+        if not step.running_log(stream).exists():
+            step = BuildStep.objects.select_related(stream + '_log').get(pk=step.pk)
+
+def follow_log(request, step, stream):
+    """
+    Follow a step's output from the byte ?offset=N (0 by default), so that
+    viewers of a running step only ever fetch what they haven't seen yet.
+
+    A plain request waits up to `DEVMASON_TAIL_TIMEOUT` seconds for output
+    past the offset, and gets whatever there is by then. `X-Log-Offset` is
+    where to carry on from, and `X-Log-Running` is 0 once the step has
+    finished, when there's no more to come.
+
+    A request that accepts text/event-stream gets server-sent events
+    instead; see `log_events`.
+    """
+    try:
+        offset = int(request.GET.get('offset') or request.META.get('HTTP_LAST_EVENT_ID') or 0)
+        if offset < 0:
+            raise ValueError
+    except ValueError:
+        return HttpResponseBadRequest("offset must be a number of bytes")
+
+    if wants_events(request):
+        response = HttpResponse(log_events(step, stream, offset), mimetype='text/event-stream')
+    else:
+        step, reader = wait_for_output(step, stream, offset, tail_timeout())
+        end = max(offset, reader.size)
+        response = HttpResponse(reader.iter_range(offset, end),
+                                mimetype='text/plain; charset=utf-8')
+        response['Content-Length'] = str(end - offset)
+        response['X-Log-Offset'] = str(end)
+        response['X-Log-Running'] = step.in_progress and '1' or '0'
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def log_events(step, stream, offset):
+    """
+    A step's output from `offset` on as server-sent events, until the step
+    finishes or `DEVMASON_TAIL_TIMEOUT` runs out. Each event's data is a
+    piece of output as a JSON string, and its id is the offset after it, so
+    a client that reconnects carries on where it left off. An `end` event
+    says the step has finished.
+    """
+    deadline = time.time() + tail_timeout()
+    read_to = offset
+    while True:
+        step, reader = wait_for_output(step, stream, read_to, max(0, deadline - time.time()))
+        end = max(offset, min(reader.size, offset + READ_SIZE))
+        read_to = max(read_to, end)
+        finished = not step.in_progress and end >= reader.size
+        # Events only carry whole characters; the rest of one comes with
+        # the next event.
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        text = decoder.decode(''.join(reader.iter_range(offset, end)), finished)
+        offset = end - len(decoder.getstate()[0])
+        if text:
+            yield 'id: %d\ndata: %s\n\n' % (offset, json.dumps(text))
+        if finished:
+            yield 'event: end\ndata: %d\n\n' % offset
+            return
+        if end >= reader.size and time.time() >= deadline:
+            return
 
 ### Crazy XMLRPC stuff below here.
 
+class TransactionalDispatcher(SimpleXMLRPCDispatcher):
+    """
+    Notes when a call fails, so that the `xmlrpc` view can roll back the
+    whole request -- every call in a system.multicall included -- rather
+    than commit some of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimpleXMLRPCDispatcher.__init__(self, *args, **kwargs)
+        self.state = threading.local()
+
+    def _dispatch(self, method, params):
+        try:
+            return SimpleXMLRPCDispatcher._dispatch(self, method, params)
+        except:
+            self.state.failed = sys.exc_info()[1]
+            raise
+
 # Create a Dispatcher; this handles the calls and translates info to function maps
-dispatcher = SimpleXMLRPCDispatcher(allow_none=False, encoding=None) # Python 2.5
+dispatcher = TransactionalDispatcher(allow_none=False, encoding=None) # Python 2.5
 
+@transaction.commit_manually
 def xmlrpc(request):
     response = HttpResponse()
     if len(request.POST):
-        response.write(dispatcher._marshaled_dispatch(request.raw_post_data))
+        dispatcher.state.failed = None
+        response_cache.record()
+        try:
+            try:
+                result = dispatcher._marshaled_dispatch(request.raw_post_data)
+            except:
+                transaction.rollback()
+                raise
+            failed = dispatcher.state.failed
+            if failed is None:
+                transaction.commit()
+            else:
+                # All or nothing: don't report success for calls we've undone.
+                transaction.rollback()
+                fault = xmlrpclib.Fault(1, "%s:%s" % (failed.__class__.__name__, failed))
+                result = xmlrpclib.dumps(fault, methodresponse=True)
+        finally:
+            # Now that it's committed, drop anything a reader cached in between.
+            response_cache.replay()
+        response.write(result)
     else:
         response.write("<b>This is an XML-RPC Service.</b><br>")
         response.write("You need to invoke it using an XML-RPC Client!<br>")
@@ -153,30 +354,44 @@ def add_results(info, results):
                        }
         )
 
-    environ = {
-        'PATH_INFO': '/',
-        'QUERY_STRING': '',
-        'REQUEST_METHOD': 'GET',
-        'SCRIPT_NAME': '',
-        'SERVER_NAME': 'testserver',
-        'SERVER_PORT': 80,
-        'SERVER_PROTOCOL': 'HTTP/1.1',
-    }
-    r = WSGIRequest(environ)
-    r.data = build_dict
-    r.META['CONTENT_TYPE'] = 'application/json'
     package = unicode(info.get('package'))
-    try:
-        pro, created = Project.objects.get_or_create(name=package, slug=slugify(package))
-    except:
-        pass
-    ProjectBuildListHandler().create(r, package)
+    project, created = Project.objects.get_or_create(slug=slugify(package),
+                                                     defaults={'name': package})
+    ingest_build(project, build_dict)
+    # Requests leased through check_should_build have now been built.
+    BuildRequest.objects.complete_leased_by(slugify(package), info.get('host', ''))
     return "Processed Correctly"
 
 
 
-def check_should_build(client_info, True, reserve_time):
-    return (True, "We always build, now!")
+def check_should_build(client_info, reserve_build=True, reserve_time=0):
+    """
+    Should this client build now? If the package has build requests, only
+    when one is waiting, and it's leased to the client for `reserve_time`
+    seconds; it's marked built when the client reports its results.
+    """
+    package = unicode(client_info.get('package'))
+    try:
+        project = Project.objects.get(slug=slugify(package))
+    except Project.DoesNotExist:
+        return (True, "We always build new packages!")
+    if not project.repos.count():
+        return (True, "We always build, now!")
+
+    arch = client_info.get('arch', '')
+    if not reserve_build:
+        now = datetime.datetime.now()
+        pending = BuildRequest.objects.filter(repository__project=project, available_at__lte=now)
+        if pending.filter(arch__in=[arch, ''])[:1]:
+            return (True, "There are pending build requests")
+        return (False, "No pending build requests")
+
+    leased = BuildRequest.objects.lease(arch, client_info.get('host', ''), 1,
+                                        reserve_time or None, project=project)
+    if not leased:
+        return (False, "No pending build requests")
+    return (True, "Build request %s: %s" % (leased[0].pk, leased[0].identifier))
 
+dispatcher.register_multicall_functions()
 dispatcher.register_function(add_results, 'add_results')
 dispatcher.register_function(check_should_build, 'check_should_build')
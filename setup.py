@@ -8,7 +8,7 @@ setup(name='devmason_server',
       license = 'BSD',
       packages = ['devmason_server'],
       install_requires=['django-tagging>=0.3',
-                        'django-piston>=0.2.2',
-                        'django',
+                        'django-piston>=0.2.3',
+                        'django>=1.2',
                         'mimeparse>=0.1.2'],
 )